@@ -14,11 +14,13 @@
 # limitations under the License.
 
 import re
+import json
 import sys
 
 from charmhelpers.core import hookenv
 
 from charms.layer.kafka import KAFKA_APP_DATA
+from charms.layer.reassignment import progress
 
 
 def fail(msg):
@@ -43,3 +45,33 @@ def get_zookeepers():
 def get_kafkaport():
     config = hookenv.config()
     return config['port']
+
+
+def check_results(results):
+    '''
+    Fails the action when a per-topic result of the admin client holds an
+    error; results map topics to an error name or (error, message).
+    '''
+    errors = []
+    for topic, result in sorted(results.items()):
+        error, message = result if isinstance(result, tuple) else (result,
+                                                                   None)
+        if error:
+            errors.append('{}: {}{}'.format(
+                topic, error, ' ({})'.format(message) if message else ''))
+
+    if errors:
+        fail('Kafka request failed: {}'.format('; '.join(errors)))
+
+
+def report_reassignment(state, stuck_after):
+    '''
+    Sets the progress of a reassignment as action results, lists and
+    counts as Json.
+    '''
+    results = {}
+    for key, value in progress(state, stuck_after=stuck_after).items():
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        results[key] = '' if value is None else value
+    hookenv.function_set(results)
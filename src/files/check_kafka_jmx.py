@@ -1,16 +1,28 @@
 # /usr/bin/python3
 
 # Simple Kafka JMX Wrapper that uses Kafka's built in JMXTool for Nagios
+#
+# In snapshot mode (--metrics) every MBean listed in the metrics file is
+# read in a single JmxTool session and cached on disk for --ttl seconds, so
+# the checks of one polling cycle share a single JVM start.
 
+import os
 import sys
+import json
+import time
+import fcntl
 import logging
 import subprocess
+import tempfile
 
 from subprocess import check_output
 from argparse import ArgumentParser
 
 
-__version__ = (0, 1, 0)
+__version__ = (0, 3, 0)
+
+DEFAULT_SNAPSHOT = '/var/lib/nagios/kafka-jmx-snapshot.json'
+DEFAULT_TTL = 60
 
 log = logging.getLogger()
 logging.basicConfig(level=logging.ERROR)
@@ -30,27 +42,67 @@ def parse_cli():
     parser.add_argument('-w', '--warning', dest='warning')
     parser.add_argument('-c', '--critical', dest='critical')
     parser.add_argument('-a', '--attr', dest='attr')
-    parser.add_argument(
-        '-o', '--object-name',
-        dest='obj',
-        required=True
-    )
+    parser.add_argument('-o', '--object-name', dest='obj')
     parser.add_argument(
         '-r', '--run-path',
         dest='path',
         default='kafka.run-class'
     )
+    parser.add_argument('-u', '--jmx-url', dest='url')
+    parser.add_argument(
+        '-m', '--metrics',
+        dest='metrics',
+        help='JSON list of object names to collect in one JMX session'
+    )
+    parser.add_argument(
+        '-s', '--snapshot',
+        dest='snapshot',
+        default=DEFAULT_SNAPSHOT
+    )
+    parser.add_argument(
+        '-t', '--ttl',
+        dest='ttl',
+        type=int,
+        default=DEFAULT_TTL
+    )
+    parser.add_argument(
+        '--static',
+        action='store_true',
+        help='Read a snapshot written by the charm, no JMX is involved'
+    )
+    parser.add_argument(
+        '--collect',
+        action='store_true',
+        help='Refresh the snapshot and exit without evaluating a check'
+    )
+
+    args = parser.parse_args()
+    if not args.collect and not args.obj:
+        parser.error('--object-name is required unless --collect is given')
+    if args.collect and not args.metrics:
+        parser.error('--collect requires --metrics')
+    if args.static and (args.collect or args.metrics):
+        parser.error('--static excludes --collect and --metrics')
 
-    return parser.parse_args()
+    return args
 
 
-def call_jmx(path, obj, attr=''):
+def to_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def call_jmx(path, obj, attr='', url=None):
     cmd = [
         path, 'kafka.tools.JmxTool',
         '--one-time', '--report-format', 'csv',
         '--object-name', obj
     ]
 
+    if url:
+        cmd += ['--jmx-url', url]
     if attr:
         cmd += ['--attributes', attr]
 
@@ -64,6 +116,119 @@ def call_jmx(path, obj, attr=''):
         return int(line.split(',')[1])
 
 
+def collect_jmx(path, objects, url=None):
+    '''
+    Read every attribute of all the given MBeans in one JmxTool run and
+    return them as {object_name: {attribute: value}}.
+    '''
+    cmd = [path, 'kafka.tools.JmxTool', '--one-time', '--report-format', 'tsv']
+    if url:
+        cmd += ['--jmx-url', url]
+    for obj in objects:
+        cmd += ['--object-name', obj]
+
+    output = check_output(cmd, stderr=subprocess.PIPE)
+
+    metrics = {}
+    for line in output.decode('utf-8').splitlines():
+        if '\t' not in line:
+            continue
+        key, value = line.rsplit('\t', 1)
+        if ':' not in key:
+            # the "time" column
+            continue
+        obj, attr = key.rsplit(':', 1)
+        try:
+            value = to_number(value.strip().strip('"'))
+        except ValueError:
+            # skip non-numeric attributes such as RateUnit
+            continue
+        metrics.setdefault(obj, {})[attr] = value
+
+    return metrics
+
+
+def read_snapshot(snapshot, ttl, objects):
+    try:
+        with open(snapshot) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if time.time() - data.get('timestamp', 0) > ttl:
+        return None
+    if not set(objects) <= set(data.get('objects', [])):
+        return None
+
+    return data
+
+
+def write_snapshot(snapshot, objects, metrics):
+    data = {
+        'timestamp': time.time(),
+        'objects': sorted(objects),
+        'metrics': metrics,
+    }
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(snapshot))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, snapshot)
+
+    return data
+
+
+def load_snapshot(args, force=False):
+    '''
+    Return a snapshot no older than the TTL, refreshing it when needed. The
+    refresh happens under an exclusive lock, so checks started in the same
+    polling cycle wait for the first one instead of spawning more JVMs.
+    '''
+    with open(args.metrics) as f:
+        objects = json.load(f)
+
+    if not force:
+        data = read_snapshot(args.snapshot, args.ttl, objects)
+        if data:
+            return data
+
+    with open('{}.lock'.format(args.snapshot), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not force:
+            data = read_snapshot(args.snapshot, args.ttl, objects)
+            if data:
+                return data
+        metrics = collect_jmx(args.path, objects, args.url)
+        return write_snapshot(args.snapshot, objects, metrics)
+
+
+def canonical_name(obj):
+    '''
+    Returns the object name with its key properties sorted. JmxTool prints
+    them in the order the MBean was registered with, which need not be the
+    order of the check.
+    '''
+    domain, sep, keys = obj.partition(':')
+    return '{}:{}'.format(domain, ','.join(sorted(keys.split(','))))
+
+
+def lookup(data, obj, attr=None):
+    metrics = data['metrics']
+    attrs = metrics.get(obj)
+    if attrs is None:
+        wanted = canonical_name(obj)
+        attrs = next((values for name, values in metrics.items()
+                      if canonical_name(name) == wanted), None)
+    if not attrs:
+        return None
+    if attr:
+        return attrs.get(attr)
+    if 'Value' in attrs:
+        return attrs['Value']
+
+    return attrs[sorted(attrs)[0]]
+
+
 def parse_criteria(val, criteria_str):
     res = eval(criteria_str, {
         'val': val
@@ -75,10 +240,26 @@ def parse_criteria(val, criteria_str):
 def main():
     args = parse_cli()
 
-    if args.attr:
-        val = call_jmx(args.path, args.obj, args.attr)
+    if args.collect:
+        load_snapshot(args, force=True)
+        return 0
+
+    if args.static:
+        data = read_snapshot(args.snapshot, args.ttl, [])
+        val = lookup(data, args.obj, args.attr) if data else None
+        if val is None:
+            print('UNKNOWN - {} missing or older than {}s in {};'.format(
+                args.obj, args.ttl, args.snapshot))
+            return 3
+    elif args.metrics:
+        val = lookup(load_snapshot(args), args.obj, args.attr)
+        if val is None:
+            print('UNKNOWN - {} not found in JMX snapshot;'.format(args.obj))
+            return 3
+    elif args.attr:
+        val = call_jmx(args.path, args.obj, args.attr, args.url)
     else:
-        val = call_jmx(args.path, args.obj)
+        val = call_jmx(args.path, args.obj, url=args.url)
 
     status = 'OK'
     status_code = 0
@@ -0,0 +1,369 @@
+#!/usr/bin/python3
+
+# Resident Kafka metrics exporter.
+#
+# Keeps one long-running kafka.tools.JmxTool session attached to the local
+# broker and serves the latest values over HTTP in the Prometheus text
+# format. Metric names follow the <domain>_<type>_<attribute> convention
+# used by the bundled grafana dashboards; every other MBean key (name,
+# topic, request, ...) becomes a label.
+
+import re
+import sys
+import json
+import time
+import logging
+import threading
+import subprocess
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+__version__ = (0, 1, 0)
+
+log = logging.getLogger('kafka-exporter')
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s %(message)s'
+)
+
+BROKER_OBJECTS = [
+    'kafka.server:type=BrokerTopicMetrics,name=*',
+    'kafka.server:type=ReplicaManager,name=*',
+    'kafka.server:type=ReplicaFetcherManager,name=*,clientId=Replica',
+    'kafka.server:type=KafkaRequestHandlerPool,name=*',
+    'kafka.server:type=SessionExpireListener,name=*',
+    'kafka.server:type=DelayedOperationPurgatory,name=*,delayedOperation=*',
+    'kafka.controller:type=KafkaController,name=*',
+    'kafka.controller:type=ControllerStats,name=*',
+    'kafka.network:type=SocketServer,name=*',
+    'kafka.network:type=RequestChannel,name=*',
+    'kafka.log:type=LogFlushStats,name=*',
+    'java.lang:type=GarbageCollector,name=*',
+]
+
+REQUEST_TYPES = ['Produce', 'FetchConsumer', 'FetchFollower', 'Metadata',
+                 'OffsetCommit', 'OffsetFetch']
+
+TOPIC_PATTERN = 'kafka.server:type=BrokerTopicMetrics,name=*,topic={}'
+PARTITION_PATTERNS = [
+    'kafka.log:type=Log,name=*,topic={},partition=*',
+    'kafka.cluster:type=Partition,name=*,topic={},partition=*',
+]
+TOPIC_DISCOVERY = 'kafka.server:type=BrokerTopicMetrics,' \
+    'name=BytesInPerSec,topic=*'
+
+DEFAULTS = {
+    'listen_address': '0.0.0.0',
+    'port': 9308,
+    'run_path': '/usr/lib/kafka/bin/kafka-run-class.sh',
+    'jmx_url': 'service:jmx:rmi:///jndi/rmi://localhost:9999/jmxrmi',
+    'interval': 15,
+    'refresh': 300,
+    'topic_metrics': 'topic',
+    'topic_regex': '.*',
+    'max_topics': 100,
+    'extra_files': [],
+}
+
+
+def get_version():
+    return '.'.join(map(str, __version__))
+
+
+def parse_cli():
+    parser = ArgumentParser(
+        prog='kafka_exporter.py',
+        description='Prometheus exporter for the local Kafka broker',
+    )
+    parser.add_argument('--version', action='version', version=get_version())
+    parser.add_argument('-c', '--config', dest='config', required=True)
+
+    return parser.parse_args()
+
+
+def load_config(path):
+    settings = dict(DEFAULTS)
+    with open(path) as f:
+        settings.update(json.load(f))
+
+    return settings
+
+
+def to_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def parse_line(line):
+    '''
+    Parse one JmxTool tsv line into (object_name, attribute, value). Returns
+    None for the time column and non-numeric attributes.
+    '''
+    if '\t' not in line:
+        return None
+    key, value = line.rsplit('\t', 1)
+    if ':' not in key:
+        return None
+    obj, attr = key.rsplit(':', 1)
+    try:
+        return obj, attr, to_number(value.strip().strip('"'))
+    except ValueError:
+        return None
+
+
+def sanitize(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name).lower()
+
+
+def metric_name(obj, attr):
+    '''
+    Map an MBean attribute to a prometheus metric name and label set.
+    '''
+    domain, keys = obj.split(':', 1)
+    labels = {}
+    mbean_type = ''
+    for pair in keys.split(','):
+        if '=' not in pair:
+            continue
+        k, v = pair.split('=', 1)
+        if k == 'type':
+            mbean_type = v
+        else:
+            labels[k] = v.strip('"')
+
+    name = '_'.join(sanitize(p) for p in (domain, mbean_type, attr) if p)
+
+    return name, labels
+
+
+def format_metrics(values):
+    '''
+    Render {object_name: {attribute: value}} in the prometheus text format.
+    '''
+    families = {}
+    for obj, attrs in values.items():
+        for attr, value in attrs.items():
+            name, labels = metric_name(obj, attr)
+            families.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(families):
+        kind = 'counter' if name.endswith('_count') else 'gauge'
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in families[name]:
+            if labels:
+                label_str = ','.join(
+                    '{}="{}"'.format(
+                        sanitize(k),
+                        v.replace('\\', '\\\\').replace('"', '\\"')
+                    )
+                    for k, v in sorted(labels.items())
+                )
+                lines.append('{}{{{}}} {}'.format(name, label_str, value))
+            else:
+                lines.append('{} {}'.format(name, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+class Collector(object):
+    '''
+    Owns the resident JmxTool process and the most recent complete set of
+    values read from it. The process is restarted every `refresh` seconds
+    to pick up MBeans of topics created since it was started.
+    '''
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.values = {}
+        self.updated = 0
+        self.lock = threading.Lock()
+
+    def jmx_cmd(self, objects, one_time=False):
+        cmd = [
+            self.settings['run_path'], 'kafka.tools.JmxTool',
+            '--jmx-url', self.settings['jmx_url'],
+            '--report-format', 'tsv',
+        ]
+        if one_time:
+            cmd.append('--one-time')
+        else:
+            cmd += ['--reporting-interval',
+                    str(int(self.settings['interval']) * 1000)]
+        for obj in objects:
+            cmd += ['--object-name', obj]
+
+        return cmd
+
+    def select_topics(self):
+        '''
+        Pick the topics that get per-topic metrics: the ones matching
+        topic_regex, busiest first, capped at max_topics. This bounds the
+        number of MBeans read on every interval, whatever the number of
+        topics and partitions on the broker.
+        '''
+        mode = self.settings['topic_metrics']
+        if mode not in ('topic', 'partition'):
+            return []
+
+        output = subprocess.check_output(
+            self.jmx_cmd([TOPIC_DISCOVERY], one_time=True),
+            stderr=subprocess.DEVNULL
+        )
+        regex = re.compile(self.settings['topic_regex'])
+        counts = {}
+        for line in output.decode('utf-8').splitlines():
+            parsed = parse_line(line)
+            if not parsed or parsed[1] != 'Count':
+                continue
+            _, labels = metric_name(parsed[0], parsed[1])
+            topic = labels.get('topic')
+            if topic and regex.match(topic):
+                counts[topic] = parsed[2]
+
+        topics = sorted(counts, key=lambda t: counts[t], reverse=True)
+
+        return topics[:int(self.settings['max_topics'])]
+
+    def objects(self):
+        objects = list(BROKER_OBJECTS)
+        for request in REQUEST_TYPES:
+            objects.append(
+                'kafka.network:type=RequestMetrics,name=*,request={}'.format(
+                    request
+                )
+            )
+            objects.append(
+                'kafka.network:type=RequestMetrics,name=RequestsPerSec,'
+                'request={},*'.format(request)
+            )
+
+        try:
+            topics = self.select_topics()
+        except (subprocess.CalledProcessError, OSError) as e:
+            log.warning('topic discovery failed: %s', e)
+            topics = []
+
+        for topic in topics:
+            objects.append(TOPIC_PATTERN.format(topic))
+            if self.settings['topic_metrics'] == 'partition':
+                objects += [p.format(topic) for p in PARTITION_PATTERNS]
+
+        return objects
+
+    def run_once(self):
+        proc = subprocess.Popen(
+            self.jmx_cmd(self.objects()),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        deadline = time.time() + int(self.settings['refresh'])
+        frame = {}
+        try:
+            for raw in proc.stdout:
+                line = raw.decode('utf-8', 'replace').rstrip('\n')
+                if line.startswith('time\t'):
+                    # JmxTool prints "time" first, so it opens a reporting
+                    # interval and the one before it is complete. The
+                    # first "time" of a run has nothing to publish.
+                    if frame:
+                        with self.lock:
+                            self.values = frame
+                            self.updated = time.time()
+                    frame = {}
+                    if time.time() > deadline:
+                        break
+                    continue
+                parsed = parse_line(line)
+                if parsed:
+                    obj, attr, value = parsed
+                    frame.setdefault(obj, {})[attr] = value
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except OSError as e:
+                log.error('unable to run JmxTool: %s', e)
+            time.sleep(int(self.settings['interval']))
+
+    def extra_values(self):
+        '''
+        Merge snapshots published by the charm (same layout as the nagios
+        JMX snapshot) into the scrape output.
+        '''
+        values = {}
+        for path in self.settings['extra_files']:
+            try:
+                with open(path) as f:
+                    values.update(json.load(f).get('metrics', {}))
+            except (IOError, ValueError):
+                continue
+
+        return values
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+            age = time.time() - self.updated if self.updated else -1
+        values.update(self.extra_values())
+        body = format_metrics(values)
+        body += '# TYPE kafka_exporter_scrape_age_seconds gauge\n'
+        body += 'kafka_exporter_scrape_age_seconds {:.1f}\n'.format(age)
+
+        return body
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(collector):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = collector.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+    return MetricsHandler
+
+
+def main():
+    args = parse_cli()
+    settings = load_config(args.config)
+
+    collector = Collector(settings)
+    thread = threading.Thread(target=collector.run, daemon=True)
+    thread.start()
+
+    server = ThreadingHTTPServer(
+        (settings['listen_address'], int(settings['port'])),
+        make_handler(collector)
+    )
+    log.info('serving metrics on %s:%s', settings['listen_address'],
+             settings['port'])
+    server.serve_forever()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+
+# Resident consumer lag collector.
+#
+# Every interval, lists the consumer groups coordinated by the local broker
+# (plus the groups named in the thresholds, wherever they are coordinated),
+# fetches their committed offsets and the log end offsets of the partitions
+# they consume, one ListOffsets request per partition leader, and writes
+# per-group and per-topic lag to a snapshot in the layout of the nagios JMX
+# snapshot. Lag in time is read off the history of log end offsets kept in
+# memory: it is how long ago the log end was at the committed offset.
+#
+# With a mirror configured the group of the MirrorMaker service is followed
+# the same way on the source cluster, with its throughput from the growth
+# of its committed offsets.
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import tempfile
+
+from argparse import ArgumentParser
+from bisect import bisect_right
+from collections import deque
+
+from kafka_admin import KafkaAdmin, KafkaAdminError, ssl_context
+
+
+__version__ = (0, 2, 0)
+
+log = logging.getLogger('kafka-lag')
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s %(message)s'
+)
+
+GROUP_OBJECT = 'kafka.charm:type=ConsumerLag,group={}'
+TOPIC_OBJECT = 'kafka.charm:type=ConsumerLag,group={},topic={}'
+STATUS_OBJECT = 'kafka.charm:type=ConsumerLagStatus'
+MIRROR_OBJECT = 'kafka.charm:type=MirrorMaker'
+
+# thresholds entry applying to every group not listed by name
+ALL_GROUPS = '*'
+
+DEFAULTS = {
+    'bootstrap': 'localhost:9093',
+    'broker_id': 0,
+    'cafile': None,
+    'certfile': None,
+    'keyfile': None,
+    'interval': 60,
+    'history': 3600,
+    'timeout': 30,
+    'snapshot': '/var/lib/kafka-charm/consumer-lag.json',
+    'thresholds': {},
+    'mirror': None,
+}
+
+
+def get_version():
+    return '.'.join(map(str, __version__))
+
+
+def parse_cli():
+    parser = ArgumentParser(
+        prog='kafka_lag.py',
+        description='Consumer lag collector for the local Kafka broker',
+    )
+    parser.add_argument('--version', action='version', version=get_version())
+    parser.add_argument('-c', '--config', dest='config', required=True)
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help='Collect once, print the snapshot and exit'
+    )
+
+    return parser.parse_args()
+
+
+def load_config(path):
+    settings = dict(DEFAULTS)
+    with open(path) as f:
+        settings.update(json.load(f))
+
+    return settings
+
+
+def label(value):
+    '''
+    Keeps a group or topic name from breaking the object name syntax.
+    '''
+    return re.sub(r'[,=:"*?]', '_', value)
+
+
+def lag_seconds(samples, committed, now):
+    '''
+    Returns how long ago the log end offset was at committed, from the
+    (time, log end offset) samples, oldest first. Before the first sample
+    the average rate over the samples is extrapolated.
+    '''
+    if not samples or committed >= samples[-1][1]:
+        return 0.0
+
+    offsets = [offset for _, offset in samples]
+    i = bisect_right(offsets, committed)
+    if i == 0:
+        (t0, o0), (t1, o1) = samples[0], samples[-1]
+        if o1 > o0 and t1 > t0:
+            return now - (t0 - (o0 - committed) * (t1 - t0) / (o1 - o0))
+        return now - t0
+
+    # the log end passed committed between samples i - 1 and i
+    (t0, o0), (t1, o1) = samples[i - 1], samples[i]
+    return now - (t0 + (committed - o0) * (t1 - t0) / float(o1 - o0))
+
+
+def status(lag, seconds, thresholds):
+    '''
+    Returns 2 past a critical threshold, 1 past a warning one, else 0.
+    '''
+    for level, suffix in ((2, 'crit'), (1, 'warn')):
+        limit = thresholds.get(suffix)
+        if limit is not None and lag >= limit:
+            return level
+        limit = thresholds.get('{}_seconds'.format(suffix))
+        if limit is not None and seconds >= limit:
+            return level
+
+    return 0
+
+
+class LagCollector(object):
+    def __init__(self, settings):
+        self.settings = settings
+        self.history = {}
+        self.mirror_history = {}
+        self.mirror_last = None
+
+    def admin(self, bootstrap=None, use_ssl=True):
+        s = self.settings
+        context = None
+        if use_ssl:
+            context = ssl_context(s['cafile'], s['certfile'], s['keyfile'])
+        return KafkaAdmin(
+            bootstrap or s['bootstrap'],
+            context,
+            timeout=s['timeout']
+        )
+
+    def coordinators(self, admin):
+        '''
+        Returns {group: coordinator} for the local groups and the named
+        ones.
+        '''
+        local = self.settings['broker_id']
+        groups = {g: local for g in admin.list_groups(local)}
+        for group in self.settings['thresholds']:
+            if group != ALL_GROUPS and group not in groups:
+                try:
+                    groups[group] = admin.find_coordinator(group)
+                except KafkaAdminError as e:
+                    log.warning('no coordinator for %s: %s', group, e)
+
+        return groups
+
+    def record(self, history, ends, now):
+        '''
+        Adds the log end offsets to history, dropping samples older than
+        the history window and partitions no longer consumed.
+        '''
+        horizon = now - self.settings['history']
+        for key in set(history) - set(ends):
+            del history[key]
+        for key, offset in ends.items():
+            samples = history.setdefault(key, deque())
+            samples.append((now, offset))
+            while len(samples) > 2 and samples[1][0] < horizon:
+                samples.popleft()
+
+    def collect(self):
+        '''
+        Returns the snapshot metrics of one collection.
+        '''
+        started = time.time()
+        with self.admin() as admin:
+            admin.metadata([])
+            committed, failed = {}, 0
+            for group, node_id in sorted(self.coordinators(admin).items()):
+                try:
+                    committed[group] = admin.offset_fetch(group, node_id)
+                except KafkaAdminError as e:
+                    log.warning('cannot fetch offsets of %s: %s', group, e)
+                    failed += 1
+            keys = set()
+            for offsets in committed.values():
+                keys.update(offsets)
+            ends = admin.end_offsets(keys)
+
+        now = time.time()
+        self.record(self.history, ends, now)
+        thresholds = self.settings['thresholds']
+        metrics = {}
+        counts = [0, 0, 0]
+        for group, offsets in committed.items():
+            topics = {}
+            for key, offset in offsets.items():
+                if key not in ends:
+                    continue
+                lag = max(0, ends[key] - offset)
+                seconds = lag_seconds(self.history[key], offset, now)
+                entry = topics.setdefault(key[0], [0, 0.0, 0])
+                entry[0] += lag
+                entry[1] = max(entry[1], seconds)
+                entry[2] += 1
+            if not topics:
+                continue
+
+            lag = sum(t[0] for t in topics.values())
+            seconds = max(t[1] for t in topics.values())
+            level = status(lag, seconds, thresholds.get(
+                group, thresholds.get(ALL_GROUPS, {})))
+            counts[level] += 1
+            metrics[GROUP_OBJECT.format(label(group))] = {
+                'Lag': lag,
+                'LagSeconds': round(seconds, 1),
+                'Partitions': sum(t[2] for t in topics.values()),
+                'Status': level,
+            }
+            for topic, (topic_lag, topic_seconds, _) in topics.items():
+                metrics[TOPIC_OBJECT.format(label(group), label(topic))] = {
+                    'Lag': topic_lag,
+                    'LagSeconds': round(topic_seconds, 1),
+                }
+
+        metrics[STATUS_OBJECT] = {
+            'Groups': sum(counts),
+            'Warning': counts[1],
+            'Critical': counts[2],
+            'Failed': failed,
+            'Status': 2 if counts[2] else 1 if counts[1] else 0,
+            'CollectSeconds': round(now - started, 3),
+        }
+        if self.settings['mirror']:
+            metrics[MIRROR_OBJECT] = self.collect_mirror()
+
+        return metrics
+
+    def collect_mirror(self):
+        '''
+        Returns the lag and throughput of the MirrorMaker group on the
+        source cluster. An unreachable source is critical.
+        '''
+        mirror = self.settings['mirror']
+        try:
+            with self.admin(mirror['bootstrap'], mirror['ssl']) as admin:
+                admin.metadata([])
+                committed = admin.offset_fetch(
+                    mirror['group'], admin.find_coordinator(mirror['group']))
+                ends = admin.end_offsets(committed)
+        except (KafkaAdminError, OSError) as e:
+            log.warning('cannot follow the mirror group %s on %s: %s',
+                        mirror['group'], mirror['bootstrap'], e)
+            self.mirror_last = None
+            return {'Failed': 1, 'Status': 2}
+
+        now = time.time()
+        self.record(self.mirror_history, ends, now)
+        keys = [key for key in committed if key in ends]
+        lag = sum(max(0, ends[key] - committed[key]) for key in keys)
+        seconds = max([lag_seconds(self.mirror_history[key], committed[key],
+                                   now) for key in keys] or [0.0])
+
+        # records per second mirrored and written to the source since the
+        # last collection, over the partitions seen both times
+        mirrored = produced = 0.0
+        if self.mirror_last:
+            then, last_committed, last_ends = self.mirror_last
+            elapsed = max(now - then, 1)
+            mirrored = sum(committed[k] - last_committed[k] for k in keys
+                           if k in last_committed) / elapsed
+            produced = sum(ends[k] - last_ends[k] for k in keys
+                           if k in last_ends) / elapsed
+        self.mirror_last = (now, committed, ends)
+
+        return {
+            'Lag': lag,
+            'LagSeconds': round(seconds, 1),
+            'Partitions': len(keys),
+            'RecordsPerSecond': round(max(0.0, mirrored), 1),
+            'SourceRecordsPerSecond': round(max(0.0, produced), 1),
+            'Failed': 0,
+            'Status': status(lag, seconds, mirror['thresholds']),
+        }
+
+    def write(self, metrics):
+        path = self.settings['snapshot']
+        data = {
+            'timestamp': time.time(),
+            'objects': sorted(metrics),
+            'metrics': metrics,
+        }
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+        return data
+
+    def run(self):
+        while True:
+            started = time.time()
+            try:
+                self.write(self.collect())
+            except (KafkaAdminError, OSError) as e:
+                log.error('unable to collect consumer lag: %s', e)
+            time.sleep(max(
+                1, int(self.settings['interval']) - (time.time() - started)))
+
+
+def main():
+    args = parse_cli()
+    settings = load_config(args.config)
+    collector = LagCollector(settings)
+
+    if args.once:
+        print(json.dumps(collector.write(collector.collect()), indent=2))
+        return 0
+
+    log.info('collecting consumer lag every %ss', settings['interval'])
+    collector.run()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
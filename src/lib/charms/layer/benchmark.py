@@ -0,0 +1,469 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import json
+import time
+import itertools
+
+from collections import OrderedDict
+from subprocess import run, PIPE, STDOUT, TimeoutExpired
+
+from charmhelpers.core import hookenv
+
+from charms.layer.kafka import (Kafka, KAFKA_BIN, KAFKA_APP_DATA,
+                                config_digest, effective_config, read_file)
+
+BENCHMARK_DIR = '/var/lib/kafka-charm/benchmarks'
+
+# peer relation used to gather the results of distributed runs
+PEER_RELATION = 'cluster'
+
+SSL_PROPERTIES = os.path.join(KAFKA_APP_DATA, 'client-ssl.properties')
+
+# matrix dimensions: action parameter, result key and type
+DIMENSIONS = (
+    ('record-sizes', 'record_size', int),
+    ('partitions', 'partitions', int),
+    ('replication', 'replication', int),
+    ('acks', 'acks', str),
+    ('compression', 'compression', str),
+    ('batch-sizes', 'batch_size', int),
+    ('linger-ms', 'linger_ms', int),
+)
+
+# final line of kafka-producer-perf-test.sh
+PRODUCER_SUMMARY = re.compile(
+    r'(\d+) records sent, ([\d.]+) records/sec \(([\d.]+) MB/sec\), '
+    r'([\d.]+) ms avg latency, ([\d.]+) ms max latency, '
+    r'(\d+) ms 50th, (\d+) ms 95th, (\d+) ms 99th, (\d+) ms 99.9th'
+)
+
+
+# figures compared by compare(): (section, key, True if higher is better)
+METRICS = (
+    ('producer', 'records_per_sec', True),
+    ('producer', 'mb_per_sec', True),
+    ('producer', 'avg_latency_ms', False),
+    ('producer', 'p50_latency_ms', False),
+    ('producer', 'p95_latency_ms', False),
+    ('producer', 'p99_latency_ms', False),
+    ('producer', 'p999_latency_ms', False),
+    ('producer', 'max_latency_ms', False),
+    ('consumer', 'records_per_sec', True),
+    ('consumer', 'mb_per_sec', True),
+)
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def parse_list(value, cast):
+    '''
+    Parses a comma separated matrix parameter.
+    '''
+    try:
+        items = [cast(v.strip()) for v in str(value).split(',') if v.strip()]
+    except ValueError:
+        raise BenchmarkError('invalid list: {}'.format(value))
+    if not items:
+        raise BenchmarkError('empty list: {}'.format(value))
+    return items
+
+
+def matrix(params):
+    '''
+    Returns every combination of the dimensions given in params as
+    comma separated lists, as ordered dicts keyed by result key.
+    '''
+    keys = [key for _, key, _ in DIMENSIONS]
+    values = [parse_list(params[name], cast) for name, _, cast in DIMENSIONS]
+
+    return [OrderedDict(zip(keys, combo))
+            for combo in itertools.product(*values)]
+
+
+def parse_producer(output):
+    '''
+    Returns the throughput and latency figures of the producer summary.
+    '''
+    matches = PRODUCER_SUMMARY.findall(output)
+    if not matches:
+        return None
+
+    fields = [float(v) for v in matches[-1]]
+    return OrderedDict((
+        ('records', int(fields[0])),
+        ('records_per_sec', fields[1]),
+        ('mb_per_sec', fields[2]),
+        ('avg_latency_ms', fields[3]),
+        ('max_latency_ms', fields[4]),
+        ('p50_latency_ms', fields[5]),
+        ('p95_latency_ms', fields[6]),
+        ('p99_latency_ms', fields[7]),
+        ('p999_latency_ms', fields[8]),
+    ))
+
+
+def parse_consumer(output):
+    '''
+    Returns the figures of the kafka-consumer-perf-test.sh csv summary.
+    '''
+    lines = [row.strip() for row in output.splitlines() if row.strip()]
+    for i, line in enumerate(lines[:-1]):
+        if not line.startswith('start.time'):
+            continue
+        header = [h.strip() for h in line.split(',')]
+        values = [v.strip() for v in lines[i + 1].split(',')]
+        if len(values) < len(header):
+            return None
+        row = dict(zip(header, values))
+        try:
+            return OrderedDict((
+                ('records', int(float(row['data.consumed.in.nMsg']))),
+                ('records_per_sec', float(row['nMsg.sec'])),
+                ('mb', float(row['data.consumed.in.MB'])),
+                ('mb_per_sec', float(row['MB.sec'])),
+                ('fetch_records_per_sec',
+                 float(row.get('fetch.nMsg.sec', row['nMsg.sec']))),
+                ('fetch_mb_per_sec',
+                 float(row.get('fetch.MB.sec', row['MB.sec']))),
+            ))
+        except (KeyError, ValueError):
+            return None
+
+    return None
+
+
+def run_tool(cmd, timeout):
+    try:
+        result = run(cmd, stdout=PIPE, stderr=STDOUT, timeout=timeout)
+    except TimeoutExpired:
+        raise BenchmarkError('{} timed out after {}s'.format(
+            os.path.basename(cmd[0]), timeout))
+
+    output = result.stdout.decode('utf-8', 'replace')
+    if result.returncode:
+        raise BenchmarkError('{} failed: {}'.format(
+            os.path.basename(cmd[0]), output.strip()[-500:]))
+    return output
+
+
+def run_producer(topic, messages, combo, throughput=-1, timeout=600):
+    cmd = [
+        os.path.join(KAFKA_BIN, 'kafka-producer-perf-test.sh'),
+        '--topic', topic,
+        '--num-records', str(messages),
+        '--record-size', str(combo['record_size']),
+        '--throughput', str(throughput),
+        '--producer.config', SSL_PROPERTIES,
+        '--producer-props',
+        'acks={}'.format(combo['acks']),
+        'compression.type={}'.format(combo['compression']),
+        'batch.size={}'.format(combo['batch_size']),
+        'linger.ms={}'.format(combo['linger_ms']),
+    ]
+    result = parse_producer(run_tool(cmd, timeout))
+    if not result:
+        raise BenchmarkError('no summary in producer output')
+    return result
+
+
+def run_consumer(bootstrap, topic, messages, timeout=600):
+    cmd = [
+        os.path.join(KAFKA_BIN, 'kafka-consumer-perf-test.sh'),
+        '--broker-list', bootstrap,
+        '--topic', topic,
+        '--messages', str(messages),
+        '--consumer.config', SSL_PROPERTIES,
+        '--timeout', str(timeout * 1000),
+    ]
+    result = parse_consumer(run_tool(cmd, timeout))
+    if not result:
+        raise BenchmarkError('no summary in consumer output')
+    return result
+
+
+def save(record, directory=BENCHMARK_DIR):
+    '''
+    Persists a benchmark record as <id>.json and returns its path.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}.json'.format(record['id']))
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp, path)
+    return path
+
+
+def server_config_hash():
+    '''
+    Digest of the effective server.properties, unaffected by ordering and
+    comments, identifying the broker configuration a run was made with.
+    '''
+    path = os.path.join(KAFKA_APP_DATA, 'server.properties')
+    return config_digest(effective_config(path, read_file(path)))
+
+
+def new_record(params, name=None, group=None):
+    '''
+    Returns an empty benchmark record for a run started now, tagged with
+    the broker version and configuration.
+    '''
+    now = time.time()
+    return OrderedDict((
+        ('id', time.strftime('%Y%m%d-%H%M%S', time.gmtime(now))),
+        ('name', name or None),
+        ('group', group or None),
+        ('timestamp', now),
+        ('unit', hookenv.local_unit()),
+        ('kafka_version', Kafka().version()),
+        ('config_hash', server_config_hash()),
+        ('params', params),
+        ('results', []),
+    ))
+
+
+def records(directory=BENCHMARK_DIR):
+    '''
+    Returns the saved benchmark records, oldest first.
+    '''
+    if not os.path.isdir(directory):
+        return []
+
+    found = []
+    for entry in sorted(os.listdir(directory)):
+        if not entry.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, entry)) as f:
+                found.append(json.load(f, object_pairs_hook=OrderedDict))
+        except (IOError, OSError, ValueError):
+            hookenv.log('Ignoring unreadable benchmark {}'.format(entry))
+
+    return sorted(found, key=lambda r: r['timestamp'])
+
+
+def load(ref, directory=BENCHMARK_DIR):
+    '''
+    Returns the record with id ref, else the latest one named ref; 'latest'
+    is the most recent run.
+    '''
+    history = records(directory)
+    if ref == 'latest':
+        matches = history
+    else:
+        matches = ([r for r in history if r['id'] == ref] or
+                   [r for r in history if r.get('name') == ref])
+    if not matches:
+        raise BenchmarkError('no benchmark {}'.format(ref))
+
+    return matches[-1]
+
+
+def change(old, new):
+    if not old:
+        return None
+    return (new - old) * 100.0 / old
+
+
+def compare(baseline, run, tolerance):
+    '''
+    Compares the results of run with the baseline runs of the same config.
+    A throughput drop or a latency increase of more than tolerance percent
+    is a regression. Returns (comparisons, regressions).
+    '''
+    base = {json.dumps(r['config'], sort_keys=True): r
+            for r in baseline['results'] if 'error' not in r}
+
+    comparisons, regressions = [], []
+    for result in run['results']:
+        key = json.dumps(result['config'], sort_keys=True)
+        entry = OrderedDict((('config', result['config']),))
+        comparisons.append(entry)
+        if 'error' in result:
+            entry['status'] = 'failed'
+            continue
+        if key not in base:
+            entry['status'] = 'no baseline'
+            continue
+
+        entry['status'] = 'ok'
+        entry['metrics'] = OrderedDict()
+        for section, metric, higher_better in METRICS:
+            old = base[key].get(section, {}).get(metric)
+            new = result.get(section, {}).get(metric)
+            if old is None or new is None:
+                continue
+            pct = change(old, new)
+            regressed = pct is not None and (
+                pct < -tolerance if higher_better else pct > tolerance)
+            name = '{}.{}'.format(section, metric)
+            entry['metrics'][name] = OrderedDict((
+                ('baseline', old),
+                ('value', new),
+                ('change_pct', None if pct is None else round(pct, 2)),
+                ('regression', regressed),
+            ))
+            if regressed:
+                entry['status'] = 'regression'
+                regressions.append('{} {}: {} -> {} ({:+.1f}%)'.format(
+                    json.dumps(result['config'], sort_keys=True), name,
+                    old, new, pct))
+
+    return comparisons, regressions
+
+
+def wait_until(start_at):
+    '''
+    Sleeps until the epoch start_at, returning how late (in seconds) the
+    caller already was, 0 if it was on time.
+    '''
+    delay = start_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+        return 0
+    return -delay
+
+
+def check_group(group):
+    if not re.match(r'^[\w.-]+$', group or ''):
+        raise BenchmarkError(
+            'group must only hold letters, digits, ".", "-" and "_"')
+
+
+def peer_key(group):
+    return 'benchmark-{}'.format(group)
+
+
+def publish(record):
+    '''
+    Shares the record of a distributed run with the other units.
+    '''
+    data = json.dumps(OrderedDict(
+        (k, v) for k, v in record.items() if k != 'params'
+    ))
+    for rid in hookenv.relation_ids(PEER_RELATION):
+        hookenv.relation_set(rid, {peer_key(record['group']): data})
+
+
+def group_records(group, directory=BENCHMARK_DIR):
+    '''
+    Returns the records of a distributed run published by the peers, plus
+    the latest local one, keyed by unit.
+    '''
+    found = OrderedDict()
+    local = [r for r in records(directory)
+             if r.get('group') == group and r['unit'] != 'cluster']
+    if local:
+        found[hookenv.local_unit()] = local[-1]
+
+    for rid in hookenv.relation_ids(PEER_RELATION):
+        for unit in hookenv.related_units(rid):
+            data = hookenv.relation_get(peer_key(group), unit, rid)
+            if not data:
+                continue
+            try:
+                found[unit] = json.loads(data, object_pairs_hook=OrderedDict)
+            except ValueError:
+                hookenv.log('Ignoring bad benchmark data from {}'.format(
+                    unit))
+
+    return found
+
+
+def weighted(values):
+    '''
+    Mean of (value, weight) pairs.
+    '''
+    total = sum(w for _, w in values)
+    if not total:
+        return None
+    return sum(v * w for v, w in values) / total
+
+
+def merge_section(sections, latency=True):
+    '''
+    Merges the producer or consumer figures of several units which ran at
+    the same time: throughputs add up, latencies are weighted by the number
+    of records each unit sent, and the maximum is the worst of all units.
+    Without the raw histograms the merged percentiles are estimates; the
+    worst unit is reported next to each of them.
+    '''
+    merged = OrderedDict()
+    merged['records'] = sum(s['records'] for s in sections)
+    for key in ('records_per_sec', 'mb_per_sec', 'mb',
+                'fetch_records_per_sec', 'fetch_mb_per_sec'):
+        if all(key in s for s in sections):
+            merged[key] = round(sum(s[key] for s in sections), 3)
+    if not latency:
+        return merged
+
+    for key in ('avg_latency_ms', 'p50_latency_ms', 'p95_latency_ms',
+                'p99_latency_ms', 'p999_latency_ms'):
+        if all(key in s for s in sections):
+            merged[key] = round(weighted(
+                [(s[key], s['records']) for s in sections]), 2)
+            merged['{}_worst'.format(key)] = max(s[key] for s in sections)
+    if all('max_latency_ms' in s for s in sections):
+        merged['max_latency_ms'] = max(s['max_latency_ms'] for s in sections)
+
+    return merged
+
+
+def aggregate(group, unit_records):
+    '''
+    Builds a cluster-wide record from the records of a distributed run,
+    matching the results of every unit by matrix entry.
+    '''
+    record = OrderedDict((
+        ('id', 'group-{}'.format(group)),
+        ('name', group),
+        ('group', group),
+        ('timestamp', min(r['timestamp'] for r in unit_records.values())),
+        ('unit', 'cluster'),
+        ('units', sorted(unit_records)),
+        ('kafka_version', ','.join(sorted(set(
+            str(r.get('kafka_version')) for r in unit_records.values())))),
+        ('config_hash', ','.join(sorted(set(
+            str(r.get('config_hash')) for r in unit_records.values())))),
+        ('results', []),
+    ))
+
+    configs = OrderedDict()
+    for unit, unit_record in unit_records.items():
+        for result in unit_record['results']:
+            key = json.dumps(result['config'], sort_keys=True)
+            configs.setdefault(key, (result['config'], []))[1].append(
+                (unit, result))
+
+    for config, results in configs.values():
+        entry = OrderedDict((('config', config),
+                             ('units', len(results))))
+        errors = ['{}: {}'.format(u, r['error'])
+                  for u, r in results if 'error' in r]
+        if errors:
+            entry['error'] = '; '.join(errors)
+        else:
+            entry['producer'] = merge_section(
+                [r['producer'] for _, r in results])
+            entry['consumer'] = merge_section(
+                [r['consumer'] for _, r in results], latency=False)
+        record['results'].append(entry)
+
+    return record
@@ -0,0 +1,283 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import ssl
+import time
+import socket
+
+from subprocess import check_output, CalledProcessError, STDOUT
+
+from charmhelpers.core import hookenv
+
+from charms.layer.kafka import (KAFKA_APP_DATA, KAFKA_BIN,
+                                get_ingress_address, parse_properties,
+                                read_file)
+
+# Broker settings Kafka can update at runtime for the whole cluster, see
+# "Updating Broker Configs" in the Kafka documentation.
+CLUSTER_WIDE = frozenset((
+    'compression.type',
+    'log.cleaner.backoff.ms',
+    'log.cleaner.dedupe.buffer.size',
+    'log.cleaner.delete.retention.ms',
+    'log.cleaner.io.buffer.load.factor',
+    'log.cleaner.io.buffer.size',
+    'log.cleaner.io.max.bytes.per.second',
+    'log.cleaner.min.cleanable.ratio',
+    'log.cleaner.min.compaction.lag.ms',
+    'log.cleanup.policy',
+    'log.flush.interval.messages',
+    'log.flush.interval.ms',
+    'log.index.interval.bytes',
+    'log.index.size.max.bytes',
+    'log.message.downconversion.enable',
+    'log.message.timestamp.difference.max.ms',
+    'log.message.timestamp.type',
+    'log.preallocate',
+    'log.retention.bytes',
+    'log.retention.hours',
+    'log.retention.minutes',
+    'log.retention.ms',
+    'log.roll.hours',
+    'log.roll.jitter.hours',
+    'log.roll.jitter.ms',
+    'log.roll.ms',
+    'log.segment.bytes',
+    'log.segment.delete.delay.ms',
+    'max.connections.per.ip',
+    'max.connections.per.ip.overrides',
+    'message.max.bytes',
+    'metric.reporters',
+    'min.insync.replicas',
+    'unclean.leader.election.enable',
+))
+
+# Cluster wide settings sized from the hardware of each host (see
+# sizing.broker_threads), applied per broker so every unit keeps its own.
+HOST_SIZED = frozenset((
+    'background.threads',
+    'log.cleaner.threads',
+    'num.io.threads',
+    'num.network.threads',
+    'num.recovery.threads.per.data.dir',
+    'num.replica.fetchers',
+))
+
+# Settings which can only be updated per broker. Listener changes are left
+# to a restart as the charm also manages the opened ports.
+PER_BROKER = frozenset((
+    'ssl.keystore.type',
+    'ssl.keystore.location',
+    'ssl.keystore.password',
+    'ssl.key.password',
+    'ssl.truststore.type',
+    'ssl.truststore.location',
+    'ssl.truststore.password',
+    'ssl.enabled.protocols',
+    'ssl.cipher.suites',
+    'ssl.secure.random.implementation',
+    'ssl.client.auth',
+))
+
+# listeners whose keystore the broker serves; SSL settings are updated per
+# listener, with the listener.name.<name>. prefix. The replication listener
+# joins them when it uses SSL, see ssl_listeners().
+SSL_LISTENERS = ('ssl',)
+
+KEYSTORE_KEYS = ('ssl.keystore.type', 'ssl.keystore.location',
+                 'ssl.keystore.password', 'ssl.key.password')
+
+
+class BrokerConfigError(Exception):
+    pass
+
+
+def classify(changes):
+    '''
+    Splits {key: value} changes into cluster wide dynamic, per broker
+    dynamic and read-only (restart needed) settings. Settings sized per
+    host count as per broker ones.
+    '''
+    cluster, broker, static = {}, {}, {}
+    for key, value in changes.items():
+        if key in CLUSTER_WIDE:
+            cluster[key] = value
+        elif key in PER_BROKER or key in HOST_SIZED:
+            broker[key] = value
+        else:
+            static[key] = value
+
+    return cluster, broker, static
+
+
+def ssl_listeners():
+    '''
+    Returns the names of the SSL listeners of server.properties.
+    '''
+    server = parse_properties(
+        read_file(os.path.join(KAFKA_APP_DATA, 'server.properties')))
+    protocols = dict(
+        item.split(':', 1)
+        for item in server.get('listener.security.protocol.map', '').split(',')
+        if ':' in item
+    )
+    names = list(SSL_LISTENERS)
+    for listener in server.get('listeners', '').split(','):
+        name = listener.split('://', 1)[0].strip()
+        if (name.lower() not in names and
+                protocols.get(name, name) == 'SSL'):
+            names.append(name.lower())
+
+    return tuple(names)
+
+
+def listener_configs(configs, listeners=None):
+    '''
+    Prefixes SSL settings with every SSL listener name, the only form under
+    which brokers accept them as dynamic configs.
+    '''
+    if listeners is None:
+        listeners = ssl_listeners()
+    prefixed = {}
+    for key, value in configs.items():
+        if key.startswith('ssl.'):
+            for name in listeners:
+                prefixed['listener.name.{}.{}'.format(name, key)] = value
+        else:
+            prefixed[key] = value
+
+    return prefixed
+
+
+def format_configs(configs):
+    '''
+    Formats configs for --add-config; values holding commas are bracketed.
+    '''
+    items = []
+    for key in sorted(configs):
+        value = str(configs[key])
+        if ',' in value:
+            value = '[{}]'.format(value)
+        items.append('{}={}'.format(key, value))
+
+    return ','.join(items)
+
+
+def alter_configs(entity_type, changes, name=None):
+    '''
+    Applies {key: value} changes through kafka-configs.sh to the entity
+    name of entity_type (brokers or topics), or to the entity default when
+    name is None. None values remove the dynamic setting.
+    '''
+    if not changes:
+        return
+
+    config = hookenv.config()
+    cmd = [
+        os.path.join(KAFKA_BIN, 'kafka-configs.sh'),
+        '--bootstrap-server', '{}:{}'.format(
+            get_ingress_address('listener'), config['port']),
+        '--command-config',
+        os.path.join(KAFKA_APP_DATA, 'client-ssl.properties'),
+        '--entity-type', entity_type,
+    ]
+    if name is None:
+        cmd += ['--entity-default']
+    else:
+        cmd += ['--entity-name', str(name)]
+    cmd += ['--alter']
+
+    added = {k: v for k, v in changes.items() if v is not None}
+    deleted = sorted(k for k, v in changes.items() if v is None)
+    if added:
+        cmd += ['--add-config', format_configs(added)]
+    if deleted:
+        cmd += ['--delete-config', ','.join(deleted)]
+
+    try:
+        check_output(cmd, stderr=STDOUT)
+    except CalledProcessError as e:
+        raise BrokerConfigError(e.output.decode('utf-8', 'replace'))
+
+
+def alter_broker_configs(changes, broker_id=None):
+    '''
+    Applies {key: value} changes to broker_id or as the cluster wide
+    default when broker_id is None. None values remove the dynamic setting
+    so the broker falls back to server.properties.
+    '''
+    alter_configs('brokers', changes, broker_id)
+
+
+def alter_topic_configs(topic, changes):
+    alter_configs('topics', changes, topic)
+
+
+def reload_keystore(broker_id, location, password):
+    '''
+    Makes the broker reload its listener keystore. Altering the config,
+    even to the same location, has the broker read the file again.
+    '''
+    alter_broker_configs(listener_configs({
+        'ssl.keystore.type': 'PKCS12',
+        'ssl.keystore.location': location,
+        'ssl.keystore.password': password,
+        'ssl.key.password': password,
+    }), broker_id)
+
+
+def drop_keystore_configs(broker_id):
+    '''
+    Removes the dynamic keystore settings so server.properties applies.
+    '''
+    alter_broker_configs(listener_configs(
+        {key: None for key in KEYSTORE_KEYS}), broker_id)
+
+
+def served_certificate(host, port, timeout=10):
+    '''
+    Returns the DER certificate the listener at host:port presents.
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        with context.wrap_socket(sock) as tls:
+            return tls.getpeercert(binary_form=True)
+
+
+def wait_for_certificate(host, port, crt_pem, timeout=30):
+    '''
+    Waits until the listener serves the certificate crt_pem, raising
+    BrokerConfigError after timeout seconds.
+    '''
+    # the leaf certificate, the file may carry the chain after it
+    start = crt_pem.index(ssl.PEM_HEADER)
+    end = crt_pem.index(ssl.PEM_FOOTER) + len(ssl.PEM_FOOTER)
+    expected = ssl.PEM_cert_to_DER_cert(crt_pem[start:end])
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if served_certificate(host, port) == expected:
+                return
+            error = 'old certificate still served'
+        except (OSError, ssl.SSLError) as e:
+            error = str(e)
+        if time.time() > deadline:
+            raise BrokerConfigError(
+                'new certificate not served on {}:{}: {}'.format(
+                    host, port, error))
+        time.sleep(1)
@@ -0,0 +1,240 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Disk usage of the log dirs per topic and partition, read with scandir
+# instead of du. Partition dirs whose mtime did not change since the last
+# scan are served from a cache, only their active segment is stat'ed again.
+
+import os
+import json
+import time
+
+from collections import OrderedDict
+
+USAGE_CACHE = '/var/lib/kafka-charm/disk-usage.json'
+
+# usage samples kept to project the growth of each filesystem
+HISTORY_DAYS = 14
+HISTORY_SAMPLES = 500
+# samples closer than this to the latest are too noisy to project from
+MIN_PROJECTION_SECONDS = 3600
+
+
+def partition_key(name):
+    '''
+    Returns (topic, partition) for a partition dir name, None for other
+    entries such as partitions being deleted or moved between log dirs.
+    '''
+    topic, sep, index = name.rpartition('-')
+    if not sep or not topic or not index.isdigit():
+        return None
+    return topic, int(index)
+
+
+def allocated(st):
+    return st.st_blocks * 512
+
+
+def scan_partition(path, cached=None):
+    '''
+    Returns the usage of a partition dir and whether it was read in full:
+    allocated bytes, segment count and mtimes of the oldest and newest
+    segments.
+    '''
+    mtime = os.stat(path).st_mtime_ns
+    if cached and cached['mtime'] == mtime:
+        entry = dict(cached)
+        try:
+            if entry['active']:
+                st = os.stat(os.path.join(path, entry['active']))
+                entry['bytes'] = entry['sealed'] + allocated(st)
+                entry['newest'] = st.st_mtime
+            return entry, False
+        except OSError:
+            # changed within the mtime granularity, read it in full
+            pass
+
+    files = []
+    with os.scandir(path) as entries:
+        for e in entries:
+            if e.is_file(follow_symlinks=False):
+                files.append((e.name, e.stat(follow_symlinks=False)))
+
+    # segment names are zero padded base offsets, the last one is written
+    segments = sorted((name, st) for name, st in files
+                      if name.endswith('.log'))
+    active = segments[-1][0] if segments else None
+    sealed = sum(allocated(st) for name, st in files if name != active)
+    mtimes = [st.st_mtime for _, st in segments]
+
+    return {
+        'mtime': mtime,
+        'active': active,
+        'sealed': sealed,
+        'bytes': sealed + (allocated(segments[-1][1]) if segments else 0),
+        'segments': len(segments),
+        'oldest': min(mtimes) if mtimes else None,
+        'newest': max(mtimes) if mtimes else None,
+    }, True
+
+
+def scan(log_dirs, cache):
+    '''
+    Scans the partition dirs of log_dirs, reusing the cached entries of
+    unchanged dirs. Returns {path: entry} with 'topic', 'partition' and
+    'log_dir' set, and the number of dirs read in full.
+    '''
+    partitions, scanned = {}, 0
+    for log_dir in log_dirs:
+        try:
+            entries = list(os.scandir(log_dir))
+        except OSError:
+            continue
+        for e in entries:
+            key = partition_key(e.name)
+            if not key or not e.is_dir(follow_symlinks=False):
+                continue
+            try:
+                entry, full = scan_partition(e.path, cache.get(e.path))
+            except OSError:
+                # removed while scanning
+                continue
+            entry.update(topic=key[0], partition=key[1], log_dir=log_dir)
+            partitions[e.path] = entry
+            scanned += full
+
+    return partitions, scanned
+
+
+def topic_usage(partitions):
+    '''
+    Aggregates the partition entries per topic, largest first.
+    '''
+    topics = {}
+    for entry in partitions.values():
+        topic = topics.setdefault(entry['topic'], OrderedDict((
+            ('bytes', 0), ('partitions', 0), ('segments', 0),
+            ('oldest', None), ('newest', None))))
+        topic['bytes'] += entry['bytes']
+        topic['partitions'] += 1
+        topic['segments'] += entry['segments']
+        if entry['oldest'] is not None:
+            topic['oldest'] = min(topic['oldest'] or entry['oldest'],
+                                  entry['oldest'])
+            topic['newest'] = max(topic['newest'] or entry['newest'],
+                                  entry['newest'])
+
+    return OrderedDict(sorted(topics.items(),
+                              key=lambda item: (-item[1]['bytes'], item[0])))
+
+
+def project(samples, free, now):
+    '''
+    Returns the growth in bytes per day from the oldest sample at least
+    MIN_PROJECTION_SECONDS old, and the days until free is used up, None
+    when unknown or not growing.
+    '''
+    old = [s for s in samples if now - s['time'] >= MIN_PROJECTION_SECONDS]
+    if not old:
+        return None, None
+
+    first, last = old[0], samples[-1]
+    days = (last['time'] - first['time']) / 86400.0
+    if days <= 0:
+        return None, None
+    growth = (last['used'] - first['used']) / days
+    if growth <= 0:
+        return int(growth), None
+
+    return int(growth), round(free / growth, 1)
+
+
+def filesystems(log_dirs, partitions, history, now):
+    '''
+    Returns the usage of the filesystems holding log_dirs, with the kafka
+    bytes on each and the growth projected from history, {key: [{'time',
+    'used'}]}, to which the current usage is appended.
+    '''
+    devices = OrderedDict()
+    for log_dir in log_dirs:
+        try:
+            devices.setdefault(os.stat(log_dir).st_dev, []).append(log_dir)
+        except OSError:
+            continue
+
+    result = OrderedDict()
+    for dirs in devices.values():
+        key = ','.join(dirs)
+        vfs = os.statvfs(dirs[0])
+        size = vfs.f_blocks * vfs.f_frsize
+        free = vfs.f_bavail * vfs.f_frsize
+        used = size - vfs.f_bfree * vfs.f_frsize
+
+        samples = [s for s in history.get(key, [])
+                   if now - s['time'] <= HISTORY_DAYS * 86400]
+        samples.append({'time': now, 'used': used})
+        history[key] = samples[-HISTORY_SAMPLES:]
+        growth, days = project(history[key], free, now)
+
+        result[key] = OrderedDict((
+            ('size', size),
+            ('used', used),
+            ('free', free),
+            ('kafka-bytes', sum(p['bytes'] for p in partitions.values()
+                                if p['log_dir'] in dirs)),
+            ('growth-per-day', growth),
+            ('days-until-full', days),
+        ))
+
+    return result
+
+
+def load_cache(path=USAGE_CACHE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_cache(cache, path=USAGE_CACHE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+
+def disk_usage(log_dirs, path=USAGE_CACHE):
+    '''
+    Scans log_dirs incrementally and returns the partitions, topics and
+    filesystems with scan statistics, updating the cache at path.
+    '''
+    started = time.time()
+    cache = load_cache(path)
+    partitions, scanned = scan(log_dirs, cache.get('partitions', {}))
+    history = cache.get('history', {})
+    now = time.time()
+    result = OrderedDict((
+        ('partitions', partitions),
+        ('topics', topic_usage(partitions)),
+        ('filesystems', filesystems(log_dirs, partitions, history, now)),
+        ('scanned', scanned),
+        ('cached', len(partitions) - scanned),
+        ('elapsed', round(now - started, 3)),
+    ))
+    save_cache({'partitions': partitions, 'history': history}, path)
+
+    return result
@@ -0,0 +1,102 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import shutil
+
+from charmhelpers.core import host, hookenv
+from charmhelpers.core.templating import render
+
+from charms.layer.kafka import KAFKA_APP_DATA, KAFKA_BIN
+from charms.layer.host_tuning import TUNING_SNAPSHOT
+from charms.layer.lag import LAG_SNAPSHOT
+from charms.layer.leaders import LEADER_SNAPSHOT
+
+EXPORTER_APP = 'kafka-exporter'
+EXPORTER_SERVICE = '{}.service'.format(EXPORTER_APP)
+EXPORTER_UNIT = '/etc/systemd/system/{}'.format(EXPORTER_SERVICE)
+EXPORTER_HOME = '/usr/local/lib/{}'.format(EXPORTER_APP)
+EXPORTER_CONFIG = os.path.join(KAFKA_APP_DATA, 'exporter.json')
+
+JMX_URL = 'service:jmx:rmi:///jndi/rmi://localhost:{}/jmxrmi'
+
+# snapshots written by the charm itself which the exporter merges into its
+# output, see extra_values() in files/kafka_exporter.py
+EXPORTER_EXTRA_FILES = [LEADER_SNAPSHOT, LAG_SNAPSHOT, TUNING_SNAPSHOT]
+
+
+class Exporter(object):
+    def settings(self):
+        '''
+        Returns the exporter settings derived from the charm config.
+        '''
+        config = hookenv.config()
+        return {
+            'port': config['exporter_port'],
+            'run_path': os.path.join(KAFKA_BIN, 'kafka-run-class.sh'),
+            'jmx_url': JMX_URL.format(config['kafka_jmx_port']),
+            'interval': config['exporter_interval'],
+            'topic_metrics': config['exporter_topic_metrics'],
+            'topic_regex': config['exporter_topic_regex'] or '.*',
+            'max_topics': config['exporter_max_topics'],
+            'extra_files': EXPORTER_EXTRA_FILES,
+        }
+
+    def install(self, settings):
+        '''
+        Installs the exporter script, its settings and the systemd unit, then
+        (re)starts the service.
+        '''
+        os.makedirs(EXPORTER_HOME, mode=0o755, exist_ok=True)
+        shutil.copy(
+            os.path.join(hookenv.charm_dir(), 'files', 'kafka_exporter.py'),
+            os.path.join(EXPORTER_HOME, 'kafka_exporter.py')
+        )
+
+        host.write_file(
+            EXPORTER_CONFIG,
+            json.dumps(settings, indent=2).encode('utf-8'),
+            perms=0o644
+        )
+
+        render(
+            source=EXPORTER_SERVICE,
+            target=EXPORTER_UNIT,
+            owner='root',
+            perms=0o644,
+            context={
+                'exporter_home': EXPORTER_HOME,
+                'exporter_config': EXPORTER_CONFIG,
+            }
+        )
+
+        host.service('daemon-reload', '')
+        host.service('enable', EXPORTER_SERVICE)
+        host.service_restart(EXPORTER_SERVICE)
+
+    def remove(self):
+        '''
+        Stops the exporter and removes its systemd unit.
+        '''
+        if not os.path.exists(EXPORTER_UNIT):
+            return
+        host.service_stop(EXPORTER_SERVICE)
+        host.service('disable', EXPORTER_SERVICE)
+        os.remove(EXPORTER_UNIT)
+        host.service('daemon-reload', '')
+
+    def is_running(self):
+        return host.service_running(EXPORTER_SERVICE)
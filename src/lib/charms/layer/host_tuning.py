@@ -0,0 +1,393 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Kernel tuning of the broker host: sysctls through sysctl.d, the I/O
+# scheduler and readahead of the disks behind the log dirs through udev
+# rules and transparent hugepages through a oneshot unit run at boot.
+
+import os
+import json
+import time
+
+from collections import OrderedDict
+from subprocess import check_call, CalledProcessError
+
+from charmhelpers.core import host, hookenv, unitdata
+from charmhelpers.core.templating import render
+
+TUNING_APP = 'kafka-host-tuning'
+TUNING_SERVICE = '{}.service'.format(TUNING_APP)
+TUNING_UNIT = '/etc/systemd/system/{}'.format(TUNING_SERVICE)
+SYSCTL_FILE = '/etc/sysctl.d/60-kafka-charm.conf'
+UDEV_RULES = '/etc/udev/rules.d/60-kafka-charm.rules'
+THP_DIR = '/sys/kernel/mm/transparent_hugepage'
+
+TUNING_SNAPSHOT = '/var/lib/kafka-charm/host-tuning.json'
+TUNING_OBJECT = 'kafka.charm:type=HostTuning'
+# what was applied and the drift found since, for show-tuning
+TUNING_KEY = 'kafka.host_tuning'
+
+PROFILE_OFF = 'off'
+
+# settings shared by the profiles: no swapping of the heap, room for the
+# index mmaps of many segments and socket buffers large enough for the
+# window of fast, long links
+COMMON_SYSCTLS = OrderedDict([
+    ('vm.swappiness', '1'),
+    ('vm.max_map_count', '262144'),
+    ('net.core.rmem_max', '16777216'),
+    ('net.core.wmem_max', '16777216'),
+    ('net.ipv4.tcp_rmem', '4096 87380 16777216'),
+    ('net.ipv4.tcp_wmem', '4096 65536 16777216'),
+    ('net.ipv4.tcp_window_scaling', '1'),
+    ('net.ipv4.tcp_slow_start_after_idle', '0'),
+    ('net.core.somaxconn', '4096'),
+    ('net.core.netdev_max_backlog', '16384'),
+])
+
+# limits the profiles only ever raise, a host set higher keeps its values
+MINIMUM_SYSCTLS = frozenset((
+    'vm.max_map_count',
+    'net.core.rmem_max',
+    'net.core.wmem_max',
+    'net.ipv4.tcp_rmem',
+    'net.ipv4.tcp_wmem',
+    'net.core.somaxconn',
+    'net.core.netdev_max_backlog',
+))
+
+# throughput lets the page cache absorb large bursts of writes before
+# flushing, latency flushes early and often to avoid long write stalls.
+# Schedulers are in order of preference, the first one the kernel offers
+# is used, and readahead is in KiB.
+PROFILES = {
+    'throughput': {
+        'sysctl': OrderedDict([
+            ('vm.dirty_background_ratio', '5'),
+            ('vm.dirty_ratio', '60'),
+            ('vm.dirty_expire_centisecs', '3000'),
+        ]),
+        'transparent_hugepage': 'madvise',
+        'scheduler': {
+            'rotational': ('mq-deadline', 'deadline'),
+            'solid': ('mq-deadline', 'deadline', 'none', 'noop'),
+        },
+        'read_ahead_kb': {'rotational': 4096, 'solid': 1024},
+    },
+    'latency': {
+        'sysctl': OrderedDict([
+            ('vm.dirty_background_ratio', '2'),
+            ('vm.dirty_ratio', '10'),
+            ('vm.dirty_expire_centisecs', '1000'),
+        ]),
+        'transparent_hugepage': 'never',
+        'scheduler': {
+            'rotational': ('mq-deadline', 'deadline'),
+            'solid': ('none', 'noop', 'mq-deadline', 'deadline'),
+        },
+        'read_ahead_kb': {'rotational': 1024, 'solid': 128},
+    },
+}
+
+
+class HostTuningError(ValueError):
+    pass
+
+
+def read_sys(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def selected(value):
+    '''
+    Returns the bracketed choice of a sysfs selection such as
+    "noop [deadline] cfq", or the value itself when there is none.
+    '''
+    if value and '[' in value:
+        return value[value.index('[') + 1:value.index(']')]
+    return value
+
+
+def choices(value):
+    return (value or '').replace('[', '').replace(']', '').split()
+
+
+def sysctl_path(key):
+    return os.path.join('/proc/sys', key.replace('.', '/'))
+
+
+def at_least(current, wanted):
+    '''
+    Returns wanted raised to current field by field, for sysctls holding
+    one or more numbers.
+    '''
+    try:
+        fields = [int(v) for v in current.split()]
+        minimum = [int(v) for v in wanted.split()]
+    except (AttributeError, ValueError):
+        return wanted
+    if len(fields) != len(minimum):
+        return wanted
+
+    return ' '.join(str(max(f, m)) for f, m in zip(fields, minimum))
+
+
+def disks(sys_path):
+    '''
+    Returns the names of the disks behind the block device at sys_path:
+    the device itself, the disk of a partition or the disks under a device
+    mapper or md device.
+    '''
+    slaves = os.path.join(sys_path, 'slaves')
+    if os.path.isdir(slaves) and os.listdir(slaves):
+        names = set()
+        for slave in os.listdir(slaves):
+            names.update(disks(os.path.realpath(os.path.join(slaves, slave))))
+        return names
+
+    if not os.path.isdir(os.path.join(sys_path, 'queue')):
+        # a partition, its disk is the parent
+        sys_path = os.path.dirname(sys_path)
+        if not os.path.isdir(os.path.join(sys_path, 'queue')):
+            return set()
+
+    return {os.path.basename(sys_path)}
+
+
+def block_devices(paths):
+    '''
+    Returns the disks holding the given paths, leaving out file systems
+    without a block device (tmpfs, overlay, network mounts).
+    '''
+    names = set()
+    for path in paths:
+        try:
+            dev = os.stat(path).st_dev
+        except OSError:
+            continue
+        sys_path = '/sys/dev/block/{}:{}'.format(os.major(dev), os.minor(dev))
+        if os.path.exists(sys_path):
+            names.update(disks(os.path.realpath(sys_path)))
+
+    return sorted(names)
+
+
+def device_tuning(profile, device):
+    '''
+    Returns the queue settings of the profile for device, the scheduler
+    being the first of the profile the kernel offers for it.
+    '''
+    queue = os.path.join('/sys/block', device, 'queue')
+    kind = ('rotational' if read_sys(os.path.join(queue, 'rotational')) == '1'
+            else 'solid')
+    tuning = OrderedDict()
+    available = choices(read_sys(os.path.join(queue, 'scheduler')))
+    for scheduler in profile['scheduler'][kind]:
+        if scheduler in available:
+            tuning['scheduler'] = scheduler
+            break
+    tuning['read_ahead_kb'] = str(profile['read_ahead_kb'][kind])
+
+    return tuning
+
+
+def udev_rules(devices):
+    lines = ['# Written by the kafka charm, see the tuning_profile option.']
+    for device, tuning in sorted(devices.items()):
+        attrs = ', '.join('ATTR{{queue/{}}}="{}"'.format(key, value)
+                          for key, value in tuning.items())
+        lines.append('ACTION=="add|change", SUBSYSTEM=="block", '
+                     'KERNEL=="{}", {}'.format(device, attrs))
+
+    return '\n'.join(lines) + '\n'
+
+
+def drift(settings):
+    '''
+    Returns {setting: (current, wanted)} for every value of settings the
+    host does not have.
+    '''
+    found = OrderedDict()
+    for key, wanted in settings['sysctl'].items():
+        current = read_sys(sysctl_path(key))
+        if current is None or current.split() != wanted.split():
+            found[key] = (current, wanted)
+
+    thp = settings['transparent_hugepage']
+    if thp:
+        current = selected(read_sys(os.path.join(THP_DIR, 'enabled')))
+        if current is not None and current != thp:
+            found['transparent_hugepage'] = (current, thp)
+
+    for device, tuning in settings['devices'].items():
+        for key, wanted in tuning.items():
+            current = read_sys(os.path.join('/sys/block', device, 'queue',
+                                            key))
+            if key == 'scheduler':
+                current = selected(current)
+            if current != wanted:
+                found['{}.{}'.format(device, key)] = (current, wanted)
+
+    return found
+
+
+def write_snapshot(settings, found, path=TUNING_SNAPSHOT):
+    '''
+    Writes the drift in the layout of the nagios JMX snapshot.
+    '''
+    metrics = {TUNING_OBJECT: {
+        'Drift': len(found),
+        'Settings': (len(settings['sysctl']) +
+                     sum(len(t) for t in settings['devices'].values()) +
+                     (1 if settings['transparent_hugepage'] else 0)),
+        'Devices': len(settings['devices']),
+    }}
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump({'timestamp': time.time(), 'objects': sorted(metrics),
+                   'metrics': metrics}, f)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+class HostTuning(object):
+    def settings(self, log_dirs):
+        '''
+        Returns the tuning of the tuning_profile option for this host, the
+        queue settings covering the disks behind log_dirs.
+        '''
+        config = hookenv.config()
+        name = config['tuning_profile']
+        if name == PROFILE_OFF:
+            return None
+        if name not in PROFILES:
+            raise HostTuningError('unknown tuning_profile {}, expected {}'
+                                  .format(name, ', '.join(
+                                      sorted(PROFILES) + [PROFILE_OFF])))
+
+        profile = PROFILES[name]
+        sysctls = OrderedDict(COMMON_SYSCTLS)
+        sysctls.update(profile['sysctl'])
+        for key in MINIMUM_SYSCTLS & set(sysctls):
+            sysctls[key] = at_least(read_sys(sysctl_path(key)), sysctls[key])
+        thp = profile['transparent_hugepage']
+        if thp not in choices(read_sys(os.path.join(THP_DIR, 'enabled'))):
+            thp = None
+
+        return {
+            'profile': name,
+            'sysctl': sysctls,
+            'transparent_hugepage': thp,
+            'devices': OrderedDict(
+                (device, device_tuning(profile, device))
+                for device in block_devices(log_dirs)),
+        }
+
+    def install(self, settings):
+        '''
+        Writes the sysctl.d file, the udev rules and the boot unit, applies
+        them right away and returns the drift left afterwards.
+        '''
+        content = ['# Written by the kafka charm, see the tuning_profile '
+                   'option.']
+        content += ['{} = {}'.format(k, v)
+                    for k, v in settings['sysctl'].items()]
+        host.write_file(SYSCTL_FILE,
+                        '\n'.join(content + ['']).encode('utf-8'),
+                        perms=0o644)
+        try:
+            # -e skips keys this kernel does not know
+            check_call(['sysctl', '-e', '-p', SYSCTL_FILE])
+        except CalledProcessError as e:
+            hookenv.log('Some sysctls were not applied: {}'.format(e),
+                        hookenv.WARNING)
+
+        host.write_file(UDEV_RULES,
+                        udev_rules(settings['devices']).encode('utf-8'),
+                        perms=0o644)
+        try:
+            check_call(['udevadm', 'control', '--reload-rules'])
+            for device in settings['devices']:
+                check_call(['udevadm', 'trigger', '--action=change',
+                            '--subsystem-match=block',
+                            '--sysname-match={}'.format(device)])
+            check_call(['udevadm', 'settle'])
+        except CalledProcessError as e:
+            hookenv.log('Cannot apply the udev rules: {}'.format(e),
+                        hookenv.WARNING)
+
+        thp = settings['transparent_hugepage']
+        if thp:
+            render(
+                source=TUNING_SERVICE,
+                target=TUNING_UNIT,
+                owner='root',
+                perms=0o644,
+                context={'thp_dir': THP_DIR, 'transparent_hugepage': thp}
+            )
+            host.service('daemon-reload', '')
+            host.service('enable', TUNING_SERVICE)
+            host.service_restart(TUNING_SERVICE)
+        else:
+            self.remove_unit()
+
+        return self.check(settings)
+
+    def check(self, settings):
+        '''
+        Compares the host with settings, records the drift for show-tuning
+        and the nagios check and returns it.
+        '''
+        found = drift(settings)
+        for key, (current, wanted) in found.items():
+            hookenv.log('Host tuning drift: {} is {}, expected {}'.format(
+                key, current, wanted), hookenv.WARNING)
+
+        write_snapshot(settings, found)
+        kv = unitdata.kv()
+        kv.set(TUNING_KEY, {
+            'profile': settings['profile'],
+            'settings': settings,
+            'drift': {k: {'current': c, 'expected': w}
+                      for k, (c, w) in found.items()},
+            'checked': time.time(),
+        })
+        kv.flush()
+
+        return found
+
+    def remove_unit(self):
+        if not os.path.exists(TUNING_UNIT):
+            return
+        host.service('disable', TUNING_SERVICE)
+        os.remove(TUNING_UNIT)
+        host.service('daemon-reload', '')
+
+    def remove(self):
+        '''
+        Removes the tuning files. Running values stay until the next boot,
+        the charm does not know what they were before.
+        '''
+        for path in (SYSCTL_FILE, UDEV_RULES, TUNING_SNAPSHOT):
+            if os.path.exists(path):
+                os.remove(path)
+        self.remove_unit()
+        unitdata.kv().unset(TUNING_KEY)
@@ -14,7 +14,9 @@
 # limitations under the License.
 
 import os
+import json
 import shutil
+import hashlib
 import re
 import socket
 import time
@@ -22,19 +24,37 @@ import time
 from pathlib import Path
 from base64 import b64encode, b64decode
 
-from charmhelpers.core import host, hookenv
+from charmhelpers.core import host, hookenv, unitdata
 from charmhelpers.core.templating import render
 
 from charms.reactive.relations import RelationBase
 
 from charms import apt
 
+from charms.layer import sizing
+from charms.layer.kafka_admin import KafkaAdmin, ssl_context
+
 KAFKA_APP = 'kafka'
 KAFKA_SERVICE = '{}.service'.format(KAFKA_APP)
 KAFKA_APP_DATA = '/etc/{}'.format(KAFKA_APP)
 KAFKA_SERVICE_CONF = '/etc/systemd/system/{}.d'.format(KAFKA_SERVICE)
 KAFKA_BIN = '/usr/lib/kafka/bin/'
 
+CLIENT_FILES = ('consumer.properties', 'producer.properties',
+                'connect-standalone.properties',
+                'connect-distributed.properties',
+                'client-ssl.properties')
+# files read by the broker at startup, changing them requires a restart
+RESTART_FILES = ('server.properties', 'broker.env', 'kafka-server-start.sh')
+
+# consumers fetch from a replica in their own rack (KIP-392, Kafka 2.4)
+RACK_AWARE_SELECTOR = (
+    'org.apache.kafka.common.replica.RackAwareReplicaSelector')
+FOLLOWER_FETCHING_VERSION = (2, 4)
+
+# listener of the replication binding, see replication_plan()
+REPLICATION_LISTENER = 'REPLICATION'
+
 
 def caKeystore():
     return os.path.join(
@@ -66,7 +86,7 @@ def keyPath(cert_type):
 def keystore(cert_type):
     return os.path.join(
         KAFKA_APP_DATA,
-        "kafka.{}.jks".format(cert_type)
+        "kafka.{}.p12".format(cert_type)
     )
 
 
@@ -78,10 +98,10 @@ def keystoreSecret():
 
 
 class Kafka(object):
-    def install(self, zk_units=[], log_dir='logs'):
+    def context(self, zk_units=[], log_dirs=['logs']):
         '''
-        Generates client-ssl.properties and server.properties with the current
-        system state.
+        Returns the template context for the current system state, or None
+        while no zookeeper is known.
         '''
         zks = []
         for unit in zk_units or self.get_zks():
@@ -89,27 +109,64 @@ class Kafka(object):
             zks.append('%s:%s' % (ip, unit['port']))
 
         if not zks:
-            return
+            return None
         else:
             zks.sort()
             zk_connect = ','.join(zks)
 
         config = hookenv.config()
-        context = {
+        extraconfig = b64decode(config['extra_config']).decode("utf-8")
+        bind_addr = hookenv.unit_private_ip()
+        broker_tuning = sizing.broker_tuning(
+            log_dirs, bind_addr, parse_properties(extraconfig))
+        if config['heap_auto']:
+            jvm = sizing.broker_jvm(
+                config['heap_max_mb'], config['gc_pause_target_ms'])
+        else:
+            jvm = {'heap_opts': config['service_environment']}
+
+        rack = broker_rack()
+        replica_selector = None
+        if (rack and config['follower_fetching'] and
+                version_at_least(self.version(), FOLLOWER_FETCHING_VERSION)
+                and version_at_least(
+                    config.get('inter_broker_protocol_version') or
+                    self.version(), FOLLOWER_FETCHING_VERSION)):
+            replica_selector = RACK_AWARE_SELECTOR
+
+        replication, inter_broker = replication_plan()
+
+        return {
             'broker_id': os.environ['JUJU_UNIT_NAME'].split('/', 1)[1],
+            'broker_rack': rack,
+            'replication_port': (config['replication_port']
+                                 if replication else None),
+            'replication_addr': (get_ingress_address('replication')
+                                 if replication else None),
+            'replication_protocol': config['replication_protocol'],
+            'replication_network_threads':
+                config['replication_network_threads'],
+            'replication_inter_broker': inter_broker,
+            'replica_selector': replica_selector,
             'port': config['port'],
             'zookeeper_connection_string': zk_connect,
-            'log_dirs': log_dir,
+            'log_dirs': ','.join(log_dirs),
+            'broker_tuning': broker_tuning,
+            'extra_config': extraconfig,
             'keystore_password': keystore_password(),
+            'password_encoder_secret': password_encoder_secret(),
             'ca_keystore': caKeystore(),
             'server_keystore': keystore('server'),
             'client_keystore': keystore('client'),
-            'bind_addr': hookenv.unit_private_ip(),
+            'bind_addr': bind_addr,
             'adv_bind_addr': get_ingress_address('listener'),
             'auto_create_topics': config['auto_create_topics'],
             'default_partitions': config['default_partitions'],
             'default_replication_factor': config['default_replication_factor'],
-            'service_environment': config['service_environment'],
+            'service_environment': jvm['heap_opts'],
+            'jvm_performance_opts': jvm.get('jvm_performance_opts'),
+            'jvm_tuning': jvm,
+            'gc_log': config['heap_auto'],
             'service_parameter': config['service_parameter'],
             'kafka_jmx_port': config['kafka_jmx_port'],
             'kafka_jmx_opts': config['kafka_jmx_opts'],
@@ -119,44 +176,152 @@ class Kafka(object):
                 config.get('log_message_format_version'),
         }
 
-        if log_dir:
+    def render_server_properties(self, context):
+        '''
+        Returns the content of server.properties: the template followed by
+        extra_config, whose entries win as the later definitions.
+        '''
+        return render(
+            source='server.properties',
+            target=None,
+            context=context
+        ) + context['extra_config']
+
+    def render_files(self, context):
+        '''
+        Renders every file managed by install() in memory. Returns a list of
+        (target, content, perms).
+        '''
+        files = []
+        for file_config in CLIENT_FILES:
+            files.append((
+                os.path.join(KAFKA_APP_DATA, file_config),
+                render(source=file_config, target=None, context=context),
+                0o400
+            ))
+
+        files.append((
+            os.path.join(KAFKA_APP_DATA, 'broker.env'),
+            render(source='broker.env', target=None, context=context),
+            0o644
+        ))
+        files.append((
+            os.path.join(KAFKA_APP_DATA, 'server.properties'),
+            self.render_server_properties(context),
+            0o644
+        ))
+        files.append((
+            os.path.join(KAFKA_BIN, 'kafka-server-start.sh'),
+            render(source='kafka-server-start.sh', target=None,
+                   context=context),
+            0o755
+        ))
+
+        return files
+
+    def diff(self, files):
+        '''
+        Compares rendered files with the effective config stored when they
+        were last written. Returns {target: (changed keys, new config)} for
+        every file whose effective config differs or which is missing.
+        '''
+        rendered = unitdata.kv().get('kafka.rendered', {})
+        changed = {}
+        for target, content, perms in files:
+            new = effective_config(target, content)
+            stored = rendered.get(target)
+            if stored and os.path.exists(target):
+                if stored['digest'] == config_digest(new):
+                    continue
+                old = stored.get('config', {})
+            else:
+                old = digest_values(
+                    effective_config(target, read_file(target)))
+                if os.path.exists(target) and old == digest_values(new):
+                    continue
+            changed[target] = (
+                set(changed_keys(old, digest_values(new))), new)
+
+        return changed
+
+    def pending_changes(self, zk_units=[], log_dirs=['logs']):
+        '''
+        Compares the configuration that install() would write with the one
+        in place. Returns the changed server properties as {key: new value},
+        None for removed keys, and the other broker files which differ.
+        '''
+        context = self.context(zk_units, log_dirs)
+        if not context:
+            return {}, []
+
+        server_conf = os.path.join(KAFKA_APP_DATA, 'server.properties')
+        changes = {}
+        changed_files = []
+        for target, (keys, new) in self.diff(
+                self.render_files(context)).items():
+            if target == server_conf:
+                changes = {key: new.get(key) for key in keys}
+            elif os.path.basename(target) in RESTART_FILES:
+                changed_files.append(target)
+
+        return changes, changed_files
+
+    def install(self, zk_units=[], log_dirs=['logs']):
+        '''
+        Generates client-ssl.properties and server.properties with the current
+        system state. Every entry of log_dirs becomes one log.dirs directory.
+
+        Files are rendered in memory and only written when their effective
+        config changed. Returns {target: changed keys} for the written files,
+        the keys being empty for files which are not properties files.
+        '''
+        context = self.context(zk_units, log_dirs)
+        if not context:
+            return {}
+
+        kv = unitdata.kv()
+        kv.set('kafka.tuning', {
+            'broker': context['broker_tuning'],
+            'jvm': context['jvm_tuning'],
+        })
+
+        for log_dir in log_dirs:
             os.makedirs(log_dir, mode=0o755, exist_ok=True)
             shutil.chown(log_dir, user='kafka')
 
-        for file_config in ('consumer.properties', 'producer.properties',
-                            'connect-standalone.properties',
-                            'connect-distributed.properties',
-                            'client-ssl.properties'
-                            ):
-            render(
-                source=file_config,
-                target=os.path.join(KAFKA_APP_DATA, file_config),
-                owner='root',
-                perms=0o400,
-                context=context
-            )
-
-        for file_config in ('server.properties', 'broker.env'):
-            render(
-                source=file_config,
-                target=os.path.join(KAFKA_APP_DATA, file_config),
+        files = self.render_files(context)
+        changed = self.diff(files)
+        rendered = kv.get('kafka.rendered', {})
+        written = {}
+        for target, content, perms in files:
+            if target not in changed:
+                continue
+            host.write_file(
+                target,
+                content.encode('utf-8'),
                 owner='root',
-                perms=0o644,
-                context=context
+                perms=perms
             )
-
-        render(
-            source='kafka-server-start.sh',
-            target=os.path.join(KAFKA_BIN, 'kafka-server-start.sh'),
-            owner='root',
-            perms=0o755,
-            context=context
-        )
-
-        extraconfig = b64decode(config['extra_config']).decode("utf-8")
-        with open(os.path.join(KAFKA_APP_DATA, 'server.properties'), "a") as outfile:
-            outfile.write(extraconfig)
-            outfile.close()
+            keys, new = changed[target]
+            entry = {'digest': config_digest(new)}
+            if is_properties(target):
+                # value digests only, server.properties holds passwords
+                entry['config'] = digest_values(new)
+            rendered[target] = entry
+            written[target] = sorted(keys)
+            hookenv.log('Updated {}: {}'.format(
+                target, ', '.join(written[target]) or 'content changed'))
+        kv.set('kafka.rendered', rendered)
+
+        return written
+
+    def restart_needed(self, written):
+        '''
+        Tells whether files written by install() require a broker restart.
+        Client configuration files do not.
+        '''
+        return any(os.path.basename(target) in RESTART_FILES
+                   for target in written)
 
     def daemon_reload(self):
         '''
@@ -237,6 +402,126 @@ def keystore_password():
     return password
 
 
+def password_encoder_secret():
+    '''
+    Returns the secret the broker encrypts dynamic password configs with
+    in Zookeeper. It must not change once passwords have been stored.
+    '''
+    path = os.path.join(KAFKA_APP_DATA, 'password-encoder.secret')
+    if not os.path.isfile(path):
+        with os.fdopen(
+                os.open(path, os.O_WRONLY | os.O_CREAT, 0o440),
+                'wb') as f:
+            f.write(b64encode(os.urandom(32)))
+    return Path(path).read_text().rstrip()
+
+
+def bootstrap_servers():
+    '''
+    Returns the bootstrap servers clients on this unit connect to, as
+    written in client-ssl.properties.
+    '''
+    properties = parse_properties(
+        read_file(os.path.join(KAFKA_APP_DATA, 'client-ssl.properties')))
+
+    return properties.get('bootstrap.servers') or '{}:{}'.format(
+        get_ingress_address('listener'), hookenv.config()['port'])
+
+
+def admin_client(timeout=60):
+    '''
+    Returns a KafkaAdmin connected over the SSL listener with the client
+    certificate of this unit.
+    '''
+    return KafkaAdmin(
+        bootstrap_servers().split(',')[0],
+        ssl_context(caPath(), crtPath('client'), keyPath('client')),
+        timeout=timeout
+    )
+
+
+def get_log_dirs():
+    '''
+    Returns the list of directories used for log.dirs: the log_dir config
+    option (comma separated) if set, otherwise one directory per attached
+    logs storage.
+    '''
+    config_dirs = hookenv.config()['log_dir']
+    if config_dirs:
+        return [d.strip() for d in config_dirs.split(',') if d.strip()]
+
+    kv = unitdata.kv()
+    log_dirs = kv.get('kafka.storage.log_dirs')
+    if log_dirs is None:
+        # storage attached by a previous charm revision
+        log_dir = kv.get('kafka.storage.log_dir')
+        log_dirs = [log_dir] if log_dir else []
+
+    return sorted(log_dirs)
+
+
+def read_file(path):
+    try:
+        return Path(path).read_text()
+    except (IOError, OSError):
+        return ''
+
+
+def is_properties(path):
+    return path.endswith(('.properties', '.env'))
+
+
+def effective_config(path, content):
+    '''
+    Returns what a file means to its reader: the parsed key/values for
+    properties and env files, so that ordering, comments and duplicate keys
+    do not count as changes, and the content itself for anything else.
+    '''
+    if is_properties(path):
+        return parse_properties(content)
+    return {'': content}
+
+
+def config_digest(config):
+    return hashlib.sha256(
+        json.dumps(config, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def digest_values(config):
+    return {
+        key: hashlib.sha256(value.encode('utf-8')).hexdigest()
+        for key, value in config.items()
+    }
+
+
+def changed_keys(old, new):
+    '''
+    Returns {key: new value} for keys which differ, None for removed keys.
+    '''
+    return {
+        key: new.get(key)
+        for key in set(old) | set(new)
+        if key and old.get(key) != new.get(key)
+    }
+
+
+def parse_properties(text):
+    '''
+    Parses the content of a java properties file into a dict, later
+    definitions winning like they do for the broker.
+    '''
+    properties = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith(('#', '!')):
+            continue
+        key, sep, value = line.partition('=')
+        properties[key.strip()] = value.strip()
+
+    return properties
+
+
 def resolve_private_address(addr):
     IP_pat = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
     contains_IP_pat = re.compile(r'\d{1,3}[-.]\d{1,3}[-.]\d{1,3}[-.]\d{1,3}')
@@ -260,6 +545,75 @@ def resolve_private_address(addr):
         return contained.groups(0).replace('-', '.')
 
 
+def broker_rack():
+    '''
+    Returns the rack of the broker: the broker_rack option, else the Juju
+    availability zone of the unit. The zone is remembered for the contexts
+    where Juju does not set it. None when neither is known.
+    '''
+    rack = hookenv.config()['broker_rack']
+    if rack:
+        return rack
+
+    kv = unitdata.kv()
+    zone = os.environ.get('JUJU_AVAILABILITY_ZONE')
+    if zone and zone != kv.get('kafka.availability_zone'):
+        kv.set('kafka.availability_zone', zone)
+        kv.flush()
+    return zone or kv.get('kafka.availability_zone')
+
+
+def replication_state(properties):
+    '''
+    Returns (whether the replication listener is defined, whether brokers
+    replicate over it) for the server.properties mapping properties.
+    '''
+    listeners = properties.get('listeners') or ''
+    return ('{}://'.format(REPLICATION_LISTENER) in listeners,
+            properties.get('inter.broker.listener.name') ==
+            REPLICATION_LISTENER)
+
+
+def peer_replication():
+    '''
+    Returns the replication state published by every peer, see
+    replication_state().
+    '''
+    states = []
+    for rid in hookenv.relation_ids('cluster'):
+        for unit in hookenv.related_units(rid):
+            data = hookenv.relation_get(rid=rid, unit=unit) or {}
+            states.append((data.get('replication-listener') == 'true',
+                           data.get('replication-inter-broker') == 'true'))
+    return states
+
+
+def replication_plan():
+    '''
+    Returns (whether to define the replication listener, whether brokers
+    replicate over it). A broker can only use the listener once every other
+    broker has it, so switching takes two rolling restarts: with
+    replication_listener set the listener is added first and used once all
+    peers publish it; when unset the listener is kept for as long as a peer
+    still replicates over it.
+    '''
+    peers = peer_replication()
+    if hookenv.config()['replication_listener']:
+        return True, all(listener for listener, _ in peers)
+    return any(used for _, used in peers), False
+
+
+def version_at_least(version, minimum):
+    '''
+    Compares the major and minor numbers of a version string such as
+    2.2.1-1 with minimum, a tuple. Unknown versions are not.
+    '''
+    match = re.match(r'(\d+)\.(\d+)', version or '')
+    if not match:
+        return False
+    return tuple(int(n) for n in match.groups()) >= minimum
+
+
 def get_ingress_address(binding):
     try:
         network_info = hookenv.network_get(binding)
@@ -0,0 +1,819 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Minimal Kafka admin client speaking the wire protocol directly, so the
+# charm and its actions do not have to start a JVM per kafka-topics call.
+# Only the standard library is used; request versions are the ones
+# supported by Kafka 2.x brokers.
+
+import ssl
+import socket
+import struct
+
+API_PRODUCE = 0
+API_FETCH = 1
+API_LIST_OFFSETS = 2
+API_METADATA = 3
+API_OFFSET_FETCH = 9
+API_FIND_COORDINATOR = 10
+API_LIST_GROUPS = 16
+API_CREATE_TOPICS = 19
+API_DELETE_TOPICS = 20
+API_DESCRIBE_CONFIGS = 32
+API_ALTER_CONFIGS = 33
+API_DESCRIBE_LOG_DIRS = 35
+API_CREATE_PARTITIONS = 37
+API_ELECT_PREFERRED_LEADERS = 43
+
+# ListOffsets timestamp asking for the log end offset
+LATEST_TIMESTAMP = -1
+EARLIEST_TIMESTAMP = -2
+
+RESOURCE_TOPIC = 2
+RESOURCE_BROKER = 4
+
+# DescribeConfigs v1 config sources
+SOURCE_DYNAMIC_TOPIC = 1
+SOURCE_DYNAMIC_BROKER = 2
+SOURCE_DYNAMIC_DEFAULT_BROKER = 3
+SOURCE_STATIC_BROKER = 4
+SOURCE_DEFAULT = 5
+
+ERRORS = {
+    -1: 'UNKNOWN_SERVER_ERROR',
+    1: 'OFFSET_OUT_OF_RANGE',
+    3: 'UNKNOWN_TOPIC_OR_PARTITION',
+    2: 'CORRUPT_MESSAGE',
+    5: 'LEADER_NOT_AVAILABLE',
+    6: 'NOT_LEADER_FOR_PARTITION',
+    7: 'REQUEST_TIMED_OUT',
+    10: 'MESSAGE_TOO_LARGE',
+    14: 'COORDINATOR_LOAD_IN_PROGRESS',
+    15: 'COORDINATOR_NOT_AVAILABLE',
+    16: 'NOT_COORDINATOR',
+    17: 'INVALID_TOPIC_EXCEPTION',
+    18: 'RECORD_LIST_TOO_LARGE',
+    19: 'NOT_ENOUGH_REPLICAS',
+    20: 'NOT_ENOUGH_REPLICAS_AFTER_APPEND',
+    29: 'TOPIC_AUTHORIZATION_FAILED',
+    30: 'GROUP_AUTHORIZATION_FAILED',
+    31: 'CLUSTER_AUTHORIZATION_FAILED',
+    36: 'TOPIC_ALREADY_EXISTS',
+    37: 'INVALID_PARTITIONS',
+    38: 'INVALID_REPLICATION_FACTOR',
+    39: 'INVALID_REPLICA_ASSIGNMENT',
+    40: 'INVALID_CONFIG',
+    41: 'NOT_CONTROLLER',
+    42: 'INVALID_REQUEST',
+    44: 'POLICY_VIOLATION',
+    57: 'LOG_DIR_NOT_FOUND',
+    58: 'KAFKA_STORAGE_ERROR',
+    80: 'PREFERRED_LEADER_NOT_AVAILABLE',
+}
+
+DEFAULT_TIMEOUT_MS = 30000
+
+
+class KafkaAdminError(Exception):
+    def __init__(self, code, message=None):
+        self.code = code
+        self.name = ERRORS.get(code, 'ERROR_{}'.format(code))
+        super(KafkaAdminError, self).__init__(
+            '{}{}'.format(self.name, ': {}'.format(message) if message else '')
+        )
+
+
+def error_name(code):
+    return ERRORS.get(code, 'ERROR_{}'.format(code)) if code else None
+
+
+class Writer(object):
+    '''
+    Encodes the primitive types of the Kafka protocol.
+    '''
+
+    def __init__(self):
+        self.parts = []
+
+    def int8(self, value):
+        self.parts.append(struct.pack('>b', value))
+        return self
+
+    def int16(self, value):
+        self.parts.append(struct.pack('>h', value))
+        return self
+
+    def int32(self, value):
+        self.parts.append(struct.pack('>i', value))
+        return self
+
+    def int64(self, value):
+        self.parts.append(struct.pack('>q', value))
+        return self
+
+    def boolean(self, value):
+        return self.int8(1 if value else 0)
+
+    def string(self, value):
+        if value is None:
+            return self.int16(-1)
+        data = value.encode('utf-8')
+        self.int16(len(data))
+        self.parts.append(data)
+        return self
+
+    def bytes(self, value):
+        if value is None:
+            return self.int32(-1)
+        self.int32(len(value))
+        self.parts.append(value)
+        return self
+
+    def array(self, items, encode):
+        if items is None:
+            return self.int32(-1)
+        self.int32(len(items))
+        for item in items:
+            encode(self, item)
+        return self
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class Reader(object):
+    '''
+    Decodes the primitive types of the Kafka protocol.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def _unpack(self, fmt, size):
+        value = struct.unpack_from(fmt, self.data, self.pos)[0]
+        self.pos += size
+        return value
+
+    def int8(self):
+        return self._unpack('>b', 1)
+
+    def int16(self):
+        return self._unpack('>h', 2)
+
+    def int32(self):
+        return self._unpack('>i', 4)
+
+    def int64(self):
+        return self._unpack('>q', 8)
+
+    def boolean(self):
+        return self.int8() != 0
+
+    def string(self):
+        length = self.int16()
+        if length < 0:
+            return None
+        value = self.data[self.pos:self.pos + length].decode('utf-8')
+        self.pos += length
+        return value
+
+    def bytes(self):
+        length = self.int32()
+        if length < 0:
+            return None
+        value = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return value
+
+    def array(self, decode):
+        count = self.int32()
+        if count < 0:
+            return None
+        return [decode(self) for _ in range(count)]
+
+
+class BrokerConnection(object):
+    '''
+    A blocking connection to a single broker.
+    '''
+
+    def __init__(self, host, port, ssl_context=None, client_id='juju-kafka',
+                 timeout=60):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.correlation_id = 0
+        sock = socket.create_connection((host, port), timeout=timeout)
+        if ssl_context:
+            sock = ssl_context.wrap_socket(sock, server_hostname=host)
+        self.sock = sock
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def _recv_exactly(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(min(size, 1048576))
+            if not chunk:
+                raise ConnectionError('connection closed by {}:{}'.format(
+                    self.host, self.port))
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def send(self, api_key, api_version, body):
+        '''
+        Sends a request without waiting for its response. Returns the
+        correlation id to pass to receive().
+        '''
+        self.correlation_id += 1
+        header = Writer().int16(api_key).int16(api_version).int32(
+            self.correlation_id).string(self.client_id).getvalue()
+        payload = header + body
+        self.sock.sendall(struct.pack('>i', len(payload)) + payload)
+        return self.correlation_id
+
+    def receive(self, correlation_id):
+        size = struct.unpack('>i', self._recv_exactly(4))[0]
+        reader = Reader(self._recv_exactly(size))
+        received = reader.int32()
+        if received != correlation_id:
+            raise ConnectionError(
+                'unexpected correlation id {} (expected {})'.format(
+                    received, correlation_id))
+        return reader
+
+    def request(self, api_key, api_version, body):
+        return self.receive(self.send(api_key, api_version, body))
+
+
+def ssl_context(cafile=None, certfile=None, keyfile=None):
+    '''
+    Returns an SSL context trusting cafile and presenting the client
+    certificate. Host names are not checked since brokers are reached by
+    the addresses they advertise, which may not be in their certificate.
+    '''
+    context = ssl.create_default_context(cafile=cafile)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED if cafile else ssl.CERT_NONE
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+class KafkaAdmin(object):
+    '''
+    Admin client over the Kafka protocol. Connections to the bootstrap
+    broker and to the other brokers of the cluster are opened on first use
+    and kept until close(), so a whole action runs over the same sockets.
+
+        with KafkaAdmin('10.0.0.1:9093', ssl_context(...)) as admin:
+            admin.create_topics([{'name': 'foo', 'partitions': 3,
+                                  'replication': 2}])
+    '''
+
+    def __init__(self, bootstrap, ssl_context=None, timeout=60):
+        host, port = bootstrap.rsplit(':', 1)
+        self.bootstrap = (host, int(port))
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.connections = {}
+        self.brokers = {}
+        self.controller_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+    def connection(self, node_id=None):
+        '''
+        Returns the connection to node_id, or to the bootstrap broker when
+        node_id is None.
+        '''
+        if node_id is None:
+            address = self.bootstrap
+        else:
+            if node_id not in self.brokers:
+                self.metadata([])
+            if node_id not in self.brokers:
+                raise KafkaAdminError(
+                    -1, 'broker {} is not in the cluster'.format(node_id))
+            broker = self.brokers[node_id]
+            address = (broker['host'], broker['port'])
+
+        if address not in self.connections:
+            self.connections[address] = BrokerConnection(
+                address[0], address[1], self.ssl_context,
+                timeout=self.timeout)
+        return self.connections[address]
+
+    def drop(self, conn):
+        '''
+        Closes a connection whose stream is out of sync, the next request
+        reconnects.
+        '''
+        conn.close()
+        self.connections = {
+            a: c for a, c in self.connections.items() if c is not conn
+        }
+
+    def request(self, api_key, api_version, body, node_id=None):
+        return self.receive(self.send(api_key, api_version, body, node_id))
+
+    def send(self, api_key, api_version, body, node_id=None):
+        '''
+        Sends a request without waiting for its response, so that several
+        can be in flight on a connection. Returns the handle to pass to
+        receive(), which must be called in the order of the sends.
+        '''
+        conn = self.connection(node_id)
+        try:
+            return conn, conn.send(api_key, api_version, body)
+        except (OSError, struct.error):
+            self.drop(conn)
+            raise
+
+    def receive(self, pending):
+        conn, correlation_id = pending
+        try:
+            return conn.receive(correlation_id)
+        except (OSError, struct.error):
+            self.drop(conn)
+            raise
+
+    def controller(self):
+        if self.controller_id is None:
+            self.metadata([])
+        return self.controller_id
+
+    # Metadata v1
+
+    def metadata(self, topics=None):
+        '''
+        Returns {topic: {'error': code, 'internal': bool, 'partitions':
+        {partition: {'leader', 'replicas', 'isr', 'error'}}}} for the given
+        topics, every topic when topics is None. Also refreshes the known
+        brokers and controller.
+        '''
+        body = Writer().array(
+            topics, lambda w, t: w.string(t)).getvalue()
+        r = self.request(API_METADATA, 1, body)
+
+        def broker(r):
+            return {
+                'node_id': r.int32(),
+                'host': r.string(),
+                'port': r.int32(),
+                'rack': r.string(),
+            }
+
+        def partition(r):
+            return {
+                'error': r.int16(),
+                'partition': r.int32(),
+                'leader': r.int32(),
+                'replicas': r.array(lambda r: r.int32()),
+                'isr': r.array(lambda r: r.int32()),
+            }
+
+        def topic(r):
+            return {
+                'error': r.int16(),
+                'name': r.string(),
+                'internal': r.boolean(),
+                'partitions': r.array(partition),
+            }
+
+        self.brokers = {b['node_id']: b for b in r.array(broker)}
+        self.controller_id = r.int32()
+        result = {}
+        for t in r.array(topic):
+            result[t['name']] = {
+                'error': t['error'],
+                'internal': t['internal'],
+                'partitions': {p['partition']: p for p in t['partitions']},
+            }
+        return result
+
+    def list_topics(self, internal=True):
+        return sorted(
+            name for name, t in self.metadata().items()
+            if internal or not t['internal']
+        )
+
+    # CreateTopics v1
+
+    def create_topics(self, topics, timeout_ms=DEFAULT_TIMEOUT_MS,
+                      validate_only=False):
+        '''
+        Creates topics given as dicts with name, partitions, replication
+        and optionally configs ({name: value}) in a single request to the
+        controller. Returns {topic: (error_name or None, message)}.
+        '''
+        def encode_config(w, item):
+            w.string(item[0]).string(
+                None if item[1] is None else str(item[1]))
+
+        def encode_topic(w, t):
+            w.string(t['name'])
+            w.int32(t['partitions'])
+            w.int16(t['replication'])
+            w.array([], None)
+            w.array(sorted((t.get('configs') or {}).items()), encode_config)
+
+        body = Writer().array(topics, encode_topic).int32(
+            timeout_ms).boolean(validate_only).getvalue()
+        r = self.request(API_CREATE_TOPICS, 1, body, self.controller())
+
+        return dict(r.array(
+            lambda r: (r.string(), (error_name(r.int16()), r.string()))
+        ))
+
+    # DeleteTopics v0
+
+    def delete_topics(self, topics, timeout_ms=DEFAULT_TIMEOUT_MS):
+        '''
+        Deletes the given topics. Returns {topic: error_name or None}.
+        '''
+        body = Writer().array(
+            topics, lambda w, t: w.string(t)).int32(timeout_ms).getvalue()
+        r = self.request(API_DELETE_TOPICS, 0, body, self.controller())
+
+        return dict(r.array(lambda r: (r.string(), error_name(r.int16()))))
+
+    # CreatePartitions v0
+
+    def create_partitions(self, counts, timeout_ms=DEFAULT_TIMEOUT_MS,
+                          validate_only=False):
+        '''
+        Grows topics to the partition counts given as {topic: count}.
+        Returns {topic: (error_name or None, message)}.
+        '''
+        def encode(w, item):
+            w.string(item[0]).int32(item[1]).array(None, None)
+
+        body = Writer().array(sorted(counts.items()), encode).int32(
+            timeout_ms).boolean(validate_only).getvalue()
+        r = self.request(API_CREATE_PARTITIONS, 0, body, self.controller())
+        r.int32()  # throttle_time_ms
+
+        return dict(r.array(
+            lambda r: (r.string(), (error_name(r.int16()), r.string()))
+        ))
+
+    # DescribeConfigs v1
+
+    def describe_configs(self, resources, node_id=None):
+        '''
+        Describes configs of resources given as (resource_type, name).
+        Broker resources are sent to that broker. Returns
+        {(type, name): {config: {'value', 'read_only', 'source',
+        'sensitive'}}}, raising KafkaAdminError on resource errors.
+        '''
+        def encode(w, res):
+            w.int8(res[0]).string(str(res[1])).array(None, None)
+
+        def config(r):
+            entry = {
+                'name': r.string(),
+                'value': r.string(),
+                'read_only': r.boolean(),
+                'source': r.int8(),
+                'sensitive': r.boolean(),
+            }
+            r.array(lambda r: (r.string(), r.string(), r.int8()))
+            return entry
+
+        def result(r):
+            error, message = r.int16(), r.string()
+            key = (r.int8(), r.string())
+            configs = r.array(config)
+            if error:
+                raise KafkaAdminError(error, message)
+            return key, {c['name']: c for c in configs}
+
+        body = Writer().array(resources, encode).boolean(False).getvalue()
+        r = self.request(API_DESCRIBE_CONFIGS, 1, body, node_id)
+        r.int32()  # throttle_time_ms
+
+        return dict(r.array(result))
+
+    # AlterConfigs v0
+
+    def alter_configs(self, resources, node_id=None, validate_only=False):
+        '''
+        Sets the dynamic configs of resources given as {(type, name):
+        {config: value}}. Like the protocol, this replaces every dynamic
+        config of a resource, so callers merge the current ones first.
+        Returns {(type, name): (error_name or None, message)}.
+        '''
+        def encode_config(w, item):
+            w.string(item[0]).string(
+                None if item[1] is None else str(item[1]))
+
+        def encode(w, item):
+            (res_type, name), configs = item
+            w.int8(res_type).string(str(name))
+            w.array(sorted(configs.items()), encode_config)
+
+        def result(r):
+            error, message = error_name(r.int16()), r.string()
+            return (r.int8(), r.string()), (error, message)
+
+        body = Writer().array(sorted(resources.items()), encode).boolean(
+            validate_only).getvalue()
+        r = self.request(API_ALTER_CONFIGS, 0, body, node_id)
+        r.int32()  # throttle_time_ms
+
+        return dict(r.array(result))
+
+    # DescribeLogDirs v0
+
+    def describe_log_dirs(self, node_id, topics=None):
+        '''
+        Describes the log dirs of broker node_id. topics, given as {topic:
+        [partitions]}, limits the answer; None describes every replica.
+        Returns {log_dir: {'error': name or None, 'replicas': {(topic,
+        partition): {'size', 'offset_lag', 'future'}}}}.
+        '''
+        def encode(w, item):
+            w.string(item[0]).array(item[1], lambda w, p: w.int32(p))
+
+        def partition(r):
+            return r.int32(), {
+                'size': r.int64(),
+                'offset_lag': r.int64(),
+                'future': r.boolean(),
+            }
+
+        def topic(r):
+            return r.string(), r.array(partition)
+
+        def result(r):
+            error, log_dir = error_name(r.int16()), r.string()
+            replicas = {}
+            for name, partitions in r.array(topic):
+                for index, info in partitions:
+                    replicas[(name, index)] = info
+            return log_dir, {'error': error, 'replicas': replicas}
+
+        body = Writer().array(
+            None if topics is None else sorted(topics.items()),
+            encode).getvalue()
+        r = self.request(API_DESCRIBE_LOG_DIRS, 0, body, node_id)
+        r.int32()  # throttle_time_ms
+
+        return dict(r.array(result))
+
+    def replica_sizes(self):
+        '''
+        Returns {(topic, partition): {broker: bytes}} for every replica in
+        the cluster, asking each broker about its own log dirs.
+        '''
+        if not self.brokers:
+            self.metadata([])
+
+        sizes = {}
+        for node_id in sorted(self.brokers):
+            for log_dir in self.describe_log_dirs(node_id).values():
+                for key, info in log_dir['replicas'].items():
+                    if not info['future']:
+                        sizes.setdefault(key, {})[node_id] = info['size']
+
+        return sizes
+
+    # ElectPreferredLeaders v0
+
+    def elect_preferred_leaders(self, partitions,
+                                timeout_ms=DEFAULT_TIMEOUT_MS):
+        '''
+        Moves leadership of partitions, given as {topic: [partitions]}, back
+        to their preferred replica. Returns {(topic, partition):
+        (error_name or None, message)}.
+        '''
+        def encode(w, item):
+            w.string(item[0]).array(sorted(item[1]),
+                                    lambda w, p: w.int32(p))
+
+        def topic(r):
+            name = r.string()
+            return [((name, r.int32()), (error_name(r.int16()), r.string()))
+                    for _ in range(r.int32())]
+
+        body = Writer().array(sorted(partitions.items()), encode).int32(
+            timeout_ms).getvalue()
+        r = self.request(API_ELECT_PREFERRED_LEADERS, 0, body,
+                         self.controller())
+        r.int32()  # throttle_time_ms
+
+        results = {}
+        for items in r.array(topic):
+            results.update(items)
+        return results
+
+    # ListGroups v1
+
+    def list_groups(self, node_id):
+        '''
+        Returns {group: protocol_type} of the groups coordinated by broker
+        node_id.
+        '''
+        r = self.request(API_LIST_GROUPS, 1, b'', node_id)
+        r.int32()  # throttle_time_ms
+        error = r.int16()
+        groups = r.array(lambda r: (r.string(), r.string()))
+        if error:
+            raise KafkaAdminError(error)
+
+        return dict(groups)
+
+    # FindCoordinator v1
+
+    def find_coordinator(self, group):
+        '''
+        Returns the node id of the broker coordinating group.
+        '''
+        body = Writer().string(group).int8(0).getvalue()
+        r = self.request(API_FIND_COORDINATOR, 1, body)
+        r.int32()  # throttle_time_ms
+        error, message, node_id = r.int16(), r.string(), r.int32()
+        if error:
+            raise KafkaAdminError(error, message)
+
+        return node_id
+
+    # OffsetFetch v2
+
+    def offset_fetch(self, group, node_id):
+        '''
+        Returns {(topic, partition): offset} of every offset group committed,
+        asking its coordinator node_id.
+        '''
+        def partition(r):
+            index, offset = r.int32(), r.int64()
+            r.string()  # metadata
+            return index, offset, r.int16()
+
+        def topic(r):
+            return r.string(), r.array(partition)
+
+        body = Writer().string(group).array(None, None).getvalue()
+        r = self.request(API_OFFSET_FETCH, 2, body, node_id)
+        topics = r.array(topic)
+        error = r.int16()
+        if error:
+            raise KafkaAdminError(error)
+
+        return {
+            (name, index): offset
+            for name, partitions in topics
+            for index, offset, error in partitions
+            if not error and offset >= 0
+        }
+
+    # ListOffsets v1
+
+    def list_offsets(self, partitions, node_id, timestamp=LATEST_TIMESTAMP):
+        '''
+        Returns {(topic, partition): (error_name or None, offset)} for
+        partitions, given as {topic: [partitions]} led by node_id.
+        '''
+        def encode(w, item):
+            w.string(item[0]).array(
+                sorted(item[1]), lambda w, p: w.int32(p).int64(timestamp))
+
+        def partition(r):
+            index, error = r.int32(), error_name(r.int16())
+            r.int64()  # timestamp
+            return index, (error, r.int64())
+
+        def topic(r):
+            return r.string(), r.array(partition)
+
+        body = Writer().int32(-1).array(
+            sorted(partitions.items()), encode).getvalue()
+        r = self.request(API_LIST_OFFSETS, 1, body, node_id)
+
+        return {
+            (name, index): result
+            for name, results in r.array(topic)
+            for index, result in results
+        }
+
+    def end_offsets(self, keys):
+        '''
+        Returns {(topic, partition): log end offset} for the keys, with one
+        ListOffsets request per partition leader. Partitions without a
+        leader or offset are left out.
+        '''
+        metadata = self.metadata(sorted(set(topic for topic, _ in keys)))
+        by_leader = {}
+        for topic, index in keys:
+            info = metadata.get(topic, {}).get('partitions', {}).get(index)
+            if info and info['leader'] >= 0:
+                by_leader.setdefault(info['leader'], {}).setdefault(
+                    topic, []).append(index)
+
+        offsets = {}
+        for leader, partitions in sorted(by_leader.items()):
+            for key, (error, offset) in self.list_offsets(
+                    partitions, leader).items():
+                if not error:
+                    offsets[key] = offset
+
+        return offsets
+
+    # Fetch v4
+
+    def fetch(self, topic, partition, offset, node_id, max_bytes=1048576,
+              max_wait_ms=500):
+        '''
+        Fetches records of one partition from its leader node_id, starting
+        at offset. Returns (error_name or None, high watermark, record
+        bytes), the records possibly ending with a partial batch.
+        '''
+        body = Writer().int32(-1).int32(max_wait_ms).int32(1).int32(
+            max_bytes).int8(0).array([topic], lambda w, t: w.string(t).array(
+                [partition], lambda w, p: w.int32(p).int64(offset).int32(
+                    max_bytes))).getvalue()
+        r = self.request(API_FETCH, 4, body, node_id)
+        r.int32()  # throttle_time_ms
+
+        def partition_data(r):
+            index, error, high_watermark = r.int32(), r.int16(), r.int64()
+            r.int64()  # last_stable_offset
+            r.array(lambda r: (r.int64(), r.int64()))  # aborted txns
+            return index, error_name(error), high_watermark, r.bytes()
+
+        for name, partitions in r.array(
+                lambda r: (r.string(), r.array(partition_data))):
+            for index, error, high_watermark, records in partitions:
+                if name == topic and index == partition:
+                    return error, high_watermark, records or b''
+
+        raise KafkaAdminError(-1, 'no data for {}-{}'.format(
+            topic, partition))
+
+    # Produce v3
+
+    def send_produce(self, batches, node_id, acks=-1,
+                     timeout_ms=DEFAULT_TIMEOUT_MS):
+        '''
+        Sends batches, {(topic, partition): record batch}, to their leader
+        node_id without waiting for the response; acks is 1 or -1 (all
+        in-sync replicas), the broker does not answer with 0. Returns the
+        handle to pass to produce_result().
+        '''
+        topics = {}
+        for (topic, partition), batch in batches.items():
+            topics.setdefault(topic, []).append((partition, batch))
+
+        body = Writer().string(None).int16(acks).int32(timeout_ms).array(
+            sorted(topics.items()), lambda w, item: w.string(item[0]).array(
+                sorted(item[1]), lambda w, p: w.int32(p[0]).bytes(p[1]))
+        ).getvalue()
+        return self.send(API_PRODUCE, 3, body, node_id)
+
+    def produce_result(self, pending):
+        '''
+        Returns {(topic, partition): (error_name or None, base offset)} for
+        a produce request sent by send_produce().
+        '''
+        r = self.receive(pending)
+
+        def partition(r):
+            index, error, base_offset = r.int32(), r.int16(), r.int64()
+            r.int64()  # log_append_time
+            return index, error_name(error), base_offset
+
+        results = {}
+        for name, partitions in r.array(
+                lambda r: (r.string(), r.array(partition))):
+            for index, error, base_offset in partitions:
+                results[(name, index)] = (error, base_offset)
+
+        return results
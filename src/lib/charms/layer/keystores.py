@@ -0,0 +1,175 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Key and trust stores for the broker and its clients, written without
+# keytool so that no JVM is started from the hooks.
+
+import os
+import re
+import time
+import struct
+import hashlib
+
+from OpenSSL import crypto
+
+try:
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.serialization import pkcs12
+except ImportError:
+    pkcs12 = None
+
+from charmhelpers.core.hookenv import log
+
+from charms.layer.kafka import (KAFKA_APP_DATA, caKeystore, caPath,
+                                crtPath, keyPath, keystore, read_file)
+
+PEM_CERTIFICATE = re.compile(
+    r'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----', re.S)
+
+JKS_MAGIC = 0xFEEDFEED
+JKS_VERSION = 2
+JKS_TRUSTED_CERT = 2
+
+
+def legacy_keystore(cert_type):
+    '''
+    Path of the JKS keystores written by keytool in earlier revisions.
+    '''
+    return os.path.join(KAFKA_APP_DATA, 'kafka.{}.jks'.format(cert_type))
+
+
+def pem_certificates(text):
+    return PEM_CERTIFICATE.findall(text)
+
+
+def pkcs12_keystore(crt_pem, key_pem, password, alias):
+    '''
+    Returns a PKCS12 keystore holding the key and its certificate chain,
+    protected by password as the JVM expects for both store and key.
+    '''
+    certs = [crypto.load_certificate(crypto.FILETYPE_PEM, c)
+             for c in pem_certificates(crt_pem)]
+    if not certs:
+        raise ValueError('no certificate found')
+
+    key = crypto.load_privatekey(crypto.FILETYPE_PEM, key_pem)
+    secret = password.encode('utf-8')
+    if hasattr(crypto, 'PKCS12'):
+        store = crypto.PKCS12()
+        store.set_certificate(certs[0])
+        store.set_privatekey(key)
+        store.set_friendlyname(alias.encode('utf-8'))
+        if certs[1:]:
+            store.set_ca_certificates(certs[1:])
+        return store.export(secret)
+
+    # pyOpenSSL 23.3 dropped PKCS12, cryptography writes it instead
+    if hasattr(serialization.PrivateFormat, 'PKCS12'):
+        # the legacy algorithms every supported JVM can read
+        encryption = (
+            serialization.PrivateFormat.PKCS12.encryption_builder()
+            .kdf_rounds(50000)
+            .key_cert_algorithm(
+                pkcs12.PBES.PBESv1SHA1And3KeyTripleDESCBC)
+            .hmac_hash(hashes.SHA1())
+            .build(secret)
+        )
+    else:
+        encryption = serialization.BestAvailableEncryption(secret)
+
+    return pkcs12.serialize_key_and_certificates(
+        alias.encode('utf-8'),
+        key.to_cryptography_key(),
+        certs[0].to_cryptography(),
+        [c.to_cryptography() for c in certs[1:]] or None,
+        encryption
+    )
+
+
+def java_utf(value):
+    data = value.encode('utf-8')
+    return struct.pack('>H', len(data)) + data
+
+
+def jks_truststore(ca_pem, password, timestamp=None):
+    '''
+    Returns a JKS truststore with every certificate of ca_pem as a trusted
+    entry. Java (before 18) ignores the trusted certificates of PKCS12
+    stores written by OpenSSL, so the truststore stays JKS; the format is
+    simple enough to write directly.
+    '''
+    certs = pem_certificates(ca_pem)
+    if not certs:
+        raise ValueError('no CA certificate found')
+
+    millis = int((timestamp or time.time()) * 1000)
+    data = struct.pack('>III', JKS_MAGIC, JKS_VERSION, len(certs))
+    for i, pem in enumerate(certs):
+        der = crypto.dump_certificate(
+            crypto.FILETYPE_ASN1,
+            crypto.load_certificate(crypto.FILETYPE_PEM, pem))
+        alias = 'caroot' if i == 0 else 'caroot-{}'.format(i)
+        data += struct.pack('>I', JKS_TRUSTED_CERT) + java_utf(alias)
+        data += struct.pack('>q', millis) + java_utf('X.509')
+        data += struct.pack('>I', len(der)) + der
+
+    # keyed integrity check of the JDK's JavaKeyStore
+    digest = hashlib.sha1(
+        password.encode('utf-16-be') + b'Mighty Aphrodite' + data)
+
+    return data + digest.digest()
+
+
+def write_store(path, data):
+    tmp = '{}.tmp'.format(path)
+    with os.fdopen(
+            os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+            'wb') as f:
+        f.write(data)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+
+
+def write_keystore(cert_type, password):
+    '''
+    Writes the PKCS12 keystore of the server or client certificate.
+    Returns False while the certificate or key is missing.
+    '''
+    crt_pem = read_file(crtPath(cert_type))
+    key_pem = read_file(keyPath(cert_type))
+    if not crt_pem or not key_pem:
+        return False
+
+    path = keystore(cert_type)
+    write_store(path, pkcs12_keystore(crt_pem, key_pem, password, cert_type))
+    log('{} keystore written to {}'.format(cert_type, path))
+
+    return True
+
+
+def write_truststore(password):
+    '''
+    Writes the truststore holding the CA. Returns False while the CA
+    certificate is missing.
+    '''
+    ca_pem = read_file(caPath())
+    if not ca_pem:
+        return False
+
+    path = caKeystore()
+    write_store(path, jks_truststore(ca_pem, password))
+    log('truststore written to {}'.format(path))
+
+    return True
@@ -0,0 +1,180 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import json
+import shutil
+import yaml
+
+from charmhelpers.core import host, hookenv
+from charmhelpers.core.templating import render
+
+from charms.layer.kafka import (KAFKA_APP_DATA, caPath, crtPath, keyPath,
+                                get_ingress_address)
+from charms.layer.mirror import mirror_group
+
+LAG_APP = 'kafka-lag'
+LAG_SERVICE = '{}.service'.format(LAG_APP)
+LAG_UNIT = '/etc/systemd/system/{}'.format(LAG_SERVICE)
+LAG_HOME = '/usr/local/lib/{}'.format(LAG_APP)
+LAG_CONFIG = os.path.join(KAFKA_APP_DATA, 'lag.json')
+LAG_SNAPSHOT = '/var/lib/kafka-charm/consumer-lag.json'
+
+# object names written by files/kafka_lag.py
+LAG_STATUS_OBJECT = 'kafka.charm:type=ConsumerLagStatus'
+LAG_GROUP_OBJECT = 'kafka.charm:type=ConsumerLag,group={}'
+MIRROR_OBJECT = 'kafka.charm:type=MirrorMaker'
+
+ALL_GROUPS = '*'
+THRESHOLD_KEYS = ('warn', 'crit', 'warn_seconds', 'crit_seconds')
+
+
+class ThresholdsError(ValueError):
+    pass
+
+
+def parse_thresholds(text):
+    '''
+    Parses consumer_lag_thresholds, a YAML mapping of group names ('*' for
+    every other group) to warn and crit lags in messages and warn_seconds
+    and crit_seconds lags in time.
+    '''
+    try:
+        data = yaml.safe_load(text or '') or {}
+    except yaml.YAMLError as e:
+        raise ThresholdsError('cannot parse thresholds: {}'.format(e))
+    if not isinstance(data, dict):
+        raise ThresholdsError('thresholds must be a mapping of groups')
+
+    return {str(group): check_limits(group, limits)
+            for group, limits in data.items()}
+
+
+def check_limits(name, limits):
+    '''
+    Validates the warn, crit, warn_seconds and crit_seconds thresholds of
+    one group, returns them.
+    '''
+    if not isinstance(limits, dict):
+        raise ThresholdsError('{}: thresholds must be a mapping'.format(name))
+    unknown = sorted(set(limits) - set(THRESHOLD_KEYS))
+    if unknown:
+        raise ThresholdsError('{}: unknown thresholds {}'.format(
+            name, ', '.join(unknown)))
+    for key, value in limits.items():
+        if not isinstance(value, (int, float)) or value < 0:
+            raise ThresholdsError('{}: {} must be a positive number'.format(
+                name, key))
+
+    return limits
+
+
+def mirror_settings(config):
+    '''
+    Returns what the collector needs to follow the MirrorMaker group on
+    the source cluster, None when nothing is mirrored.
+    '''
+    if not config['mirror_source_bootstrap']:
+        return None
+    try:
+        limits = yaml.safe_load(config['mirror_lag_thresholds'] or '') or {}
+    except yaml.YAMLError as e:
+        raise ThresholdsError('cannot parse mirror thresholds: {}'.format(e))
+
+    return {
+        'bootstrap': config['mirror_source_bootstrap'].split(',')[0],
+        'ssl': config['mirror_source_protocol'] == 'SSL',
+        'group': mirror_group(),
+        'thresholds': check_limits('mirror', limits),
+    }
+
+
+def group_label(group):
+    '''
+    The group as it appears in object names, see label() in
+    files/kafka_lag.py.
+    '''
+    return re.sub(r'[,=:"*?]', '_', group)
+
+
+class LagCollector(object):
+    def settings(self):
+        '''
+        Returns the collector settings derived from the charm config.
+        '''
+        config = hookenv.config()
+        return {
+            'bootstrap': '{}:{}'.format(get_ingress_address('listener'),
+                                        config['port']),
+            'broker_id': int(hookenv.local_unit().split('/', 1)[1]),
+            'cafile': caPath(),
+            'certfile': crtPath('client'),
+            'keyfile': keyPath('client'),
+            'interval': config['consumer_lag_interval'],
+            'snapshot': LAG_SNAPSHOT,
+            'thresholds': parse_thresholds(
+                config['consumer_lag_thresholds']),
+            'mirror': mirror_settings(config),
+        }
+
+    def install(self, settings):
+        '''
+        Installs the collector with the admin client it uses, its settings
+        and the systemd unit, then (re)starts the service.
+        '''
+        os.makedirs(LAG_HOME, mode=0o755, exist_ok=True)
+        os.makedirs(os.path.dirname(LAG_SNAPSHOT), mode=0o755,
+                    exist_ok=True)
+        charm_dir = hookenv.charm_dir()
+        for source in (os.path.join('files', 'kafka_lag.py'),
+                       os.path.join('lib', 'charms', 'layer',
+                                    'kafka_admin.py')):
+            shutil.copy(os.path.join(charm_dir, source), LAG_HOME)
+
+        host.write_file(
+            LAG_CONFIG,
+            json.dumps(settings, indent=2).encode('utf-8'),
+            perms=0o644
+        )
+
+        render(
+            source=LAG_SERVICE,
+            target=LAG_UNIT,
+            owner='root',
+            perms=0o644,
+            context={
+                'lag_home': LAG_HOME,
+                'lag_config': LAG_CONFIG,
+            }
+        )
+
+        host.service('daemon-reload', '')
+        host.service('enable', LAG_SERVICE)
+        host.service_restart(LAG_SERVICE)
+
+    def remove(self):
+        '''
+        Stops the collector and removes its systemd unit.
+        '''
+        if not os.path.exists(LAG_UNIT):
+            return
+        host.service_stop(LAG_SERVICE)
+        host.service('disable', LAG_SERVICE)
+        os.remove(LAG_UNIT)
+        host.service('daemon-reload', '')
+
+    def is_running(self):
+        return host.service_running(LAG_SERVICE)
@@ -0,0 +1,159 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Partition leadership per broker and preferred replica elections to even
+# it out, e.g. after the rolling restarts which leave leadership on the
+# brokers restarted first.
+
+import os
+import json
+import time
+
+from collections import OrderedDict
+
+# written on update-status, read by the nagios check and the exporter
+LEADER_SNAPSHOT = '/var/lib/kafka-charm/leader-balance.json'
+LEADER_OBJECT = 'kafka.charm:type=LeaderBalance'
+
+# seconds between two election batches
+ELECTION_PAUSE = 5
+
+
+def skew(counts):
+    '''
+    Returns {broker: percent} deviation of each count from the mean.
+    '''
+    mean = sum(counts.values()) / float(len(counts)) if counts else 0
+    return {b: round(100.0 * (c - mean) / mean, 1) if mean else 0.0
+            for b, c in counts.items()}
+
+
+def leader_stats(metadata, brokers, sizes=None):
+    '''
+    Computes from metadata the leaders, preferred leaderships and bytes
+    led (the log size of the led partitions, from replica_sizes()) of
+    every broker. 'electable' lists the partitions led by another replica
+    while their preferred one is in sync.
+    '''
+    sizes = sizes or {}
+    leaders = {b: 0 for b in brokers}
+    preferred = {b: 0 for b in brokers}
+    led_bytes = {b: 0 for b in brokers}
+    electable = []
+    for topic, info in sorted(metadata.items()):
+        for index, p in sorted(info['partitions'].items()):
+            leader, replicas = p['leader'], p['replicas']
+            if leader in leaders:
+                leaders[leader] += 1
+                led_bytes[leader] += sizes.get((topic, index), {}).get(
+                    leader, 0)
+            if replicas and replicas[0] in preferred:
+                preferred[replicas[0]] += 1
+                if leader != replicas[0] and replicas[0] in p['isr']:
+                    electable.append((topic, index))
+
+    leader_skew, preferred_skew = skew(leaders), skew(preferred)
+    return OrderedDict((
+        ('brokers', OrderedDict((b, OrderedDict((
+            ('leaders', leaders[b]),
+            ('preferred', preferred[b]),
+            ('leader-bytes', led_bytes[b]),
+            ('skew', leader_skew[b]),
+        ))) for b in sorted(brokers))),
+        ('max-skew', max([abs(s) for s in leader_skew.values()] or [0])),
+        ('preferred-skew',
+         max([abs(s) for s in preferred_skew.values()] or [0])),
+        ('electable', electable),
+    ))
+
+
+def collect(admin):
+    metadata = admin.metadata()
+    return leader_stats(metadata, admin.brokers, admin.replica_sizes())
+
+
+def needs_election(stats, threshold):
+    return bool(stats['electable']) and stats['max-skew'] > threshold
+
+
+def elect(admin, partitions, batch_size, pause=ELECTION_PAUSE):
+    '''
+    Runs preferred replica elections for [(topic, partition)] in batches
+    of batch_size, each answered once its elections completed. Returns
+    the number of partitions elected and {'topic-partition': error}.
+    '''
+    elected, errors = 0, {}
+    for start in range(0, len(partitions), batch_size):
+        if start:
+            time.sleep(pause)
+        batch = {}
+        for topic, index in partitions[start:start + batch_size]:
+            batch.setdefault(topic, []).append(index)
+        results = admin.elect_preferred_leaders(batch)
+        for (topic, index), (error, message) in sorted(results.items()):
+            if error:
+                errors['{}-{}'.format(topic, index)] = '{}{}'.format(
+                    error, ': {}'.format(message) if message else '')
+            else:
+                elected += 1
+
+    return elected, errors
+
+
+def balance(admin, threshold, batch_size, dry_run=False):
+    '''
+    Elects the preferred leaders of the electable partitions when the
+    leader skew is above threshold percent. Returns the stats before and
+    after, with the election outcome.
+    '''
+    before = collect(admin)
+    report = OrderedDict((('before', before), ('elected', 0),
+                          ('errors', {}), ('after', before)))
+    if dry_run or not needs_election(before, threshold):
+        return report
+
+    report['elected'], report['errors'] = elect(
+        admin, before['electable'], batch_size)
+    report['after'] = collect(admin)
+    return report
+
+
+def write_snapshot(stats, broker_id, path=LEADER_SNAPSHOT):
+    '''
+    Writes the stats in the layout of the nagios JMX snapshot, the local
+    broker's skew as LocalSkewPercent.
+    '''
+    local = stats['brokers'].get(broker_id, {})
+    metrics = {LEADER_OBJECT: {
+        'MaxSkewPercent': stats['max-skew'],
+        'PreferredSkewPercent': stats['preferred-skew'],
+        'LocalSkewPercent': abs(local.get('skew', 0)),
+        'ElectablePartitions': len(stats['electable']),
+    }}
+    for broker, entry in stats['brokers'].items():
+        metrics['{},broker={}'.format(LEADER_OBJECT, broker)] = {
+            'Leaders': entry['leaders'],
+            'PreferredLeaders': entry['preferred'],
+            'LeaderBytes': entry['leader-bytes'],
+            'SkewPercent': entry['skew'],
+        }
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump({'timestamp': time.time(), 'objects': sorted(metrics),
+                   'metrics': metrics}, f)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
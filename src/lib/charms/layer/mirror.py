@@ -0,0 +1,255 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# MirrorMaker as a systemd service consuming from a source cluster and
+# producing into the local one. Every unit runs it in the same consumer
+# group, the source partitions are shared among their streams.
+
+import os
+import re
+import math
+import time
+import shutil
+
+from charmhelpers.core import host, hookenv, unitdata
+from charmhelpers.core.templating import render
+
+from charms.layer import sizing
+from charms.layer.kafka import (KAFKA_APP_DATA, KAFKA_BIN, caKeystore,
+                                caPath, crtPath, get_ingress_address,
+                                keyPath, keystore, keystore_password)
+from charms.layer.kafka_admin import KafkaAdmin, KafkaAdminError, ssl_context
+
+MIRROR_APP = 'kafka-mirror'
+MIRROR_SERVICE = '{}.service'.format(MIRROR_APP)
+MIRROR_UNIT = '/etc/systemd/system/{}'.format(MIRROR_SERVICE)
+MIRROR_LOG_DIR = '/var/log/{}'.format(MIRROR_APP)
+MIRROR_CONSUMER = os.path.join(KAFKA_APP_DATA, 'mirror-consumer.properties')
+MIRROR_PRODUCER = os.path.join(KAFKA_APP_DATA, 'mirror-producer.properties')
+
+# streams per core at most, each is a consumer thread feeding the producer
+MIRROR_STREAMS_PER_CORE = 2
+# seconds between two partition counts of the source cluster
+MIRROR_SIZING_INTERVAL = 3600
+SIZING_KEY = 'kafka.mirror.sizing'
+# what the running service was installed with, for mirror-status
+INSTALLED_KEY = 'kafka.mirror.installed'
+INSTALLED_SETTINGS = ('source', 'whitelist', 'group', 'streams',
+                      'source_partitions')
+
+
+class MirrorError(ValueError):
+    pass
+
+
+def mirror_group():
+    '''
+    The consumer group of the mirror on the source cluster, shared by the
+    units of the application.
+    '''
+    return (hookenv.config()['mirror_group_id'] or
+            'juju-mirror-{}'.format(hookenv.service_name()))
+
+
+def whitelist_pattern(whitelist):
+    '''
+    Compiles the whitelist as MirrorMaker reads it, commas standing for
+    alternatives.
+    '''
+    whitelist = (whitelist or '.*').replace(',', '|').replace(' ', '')
+    try:
+        return re.compile(whitelist)
+    except re.error as e:
+        raise MirrorError('invalid mirror_whitelist {}: {}'.format(
+            whitelist, e))
+
+
+def systemd_quote(value):
+    '''
+    Quotes an ExecStart argument so that systemd passes it unchanged.
+    '''
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return '"{}"'.format(value.replace('$', '$$').replace('%', '%%'))
+
+
+def num_streams(partitions, units, cores=None):
+    '''
+    Sizes the streams of one unit so that the units together have a
+    consumer per source partition, within MIRROR_STREAMS_PER_CORE per
+    core. Without a partition count every core gets a stream.
+    '''
+    cores = cores or sizing.cpu_count()
+    if not partitions:
+        return cores
+    return sizing.clamp(int(math.ceil(partitions / float(max(1, units)))),
+                        1, cores * MIRROR_STREAMS_PER_CORE)
+
+
+def cluster_size():
+    units = 1
+    for rid in hookenv.relation_ids('cluster'):
+        units += len(hookenv.related_units(rid))
+    return units
+
+
+def source_partitions(bootstrap, use_ssl, pattern):
+    '''
+    Returns the number of partitions of the source topics matched by the
+    whitelist, internal topics aside.
+    '''
+    context = None
+    if use_ssl:
+        context = ssl_context(caPath(), crtPath('client'), keyPath('client'))
+    with KafkaAdmin(bootstrap.split(',')[0], context, timeout=30) as admin:
+        metadata = admin.metadata()
+
+    return sum(len(info['partitions']) for name, info in metadata.items()
+               if not info['internal'] and pattern.fullmatch(name))
+
+
+def cached_source_partitions(bootstrap, use_ssl, whitelist):
+    '''
+    Counts the source partitions at most every MIRROR_SIZING_INTERVAL,
+    falling back to the last count while the source is unreachable.
+    '''
+    kv = unitdata.kv()
+    cached = kv.get(SIZING_KEY) or {}
+    key = [bootstrap, whitelist]
+    if (cached.get('key') == key and
+            time.time() - cached.get('time', 0) < MIRROR_SIZING_INTERVAL):
+        return cached['partitions']
+
+    try:
+        partitions = source_partitions(bootstrap, use_ssl,
+                                       whitelist_pattern(whitelist))
+    except (KafkaAdminError, OSError) as e:
+        hookenv.log('Cannot count the partitions of {}: {}'.format(
+            bootstrap, e), hookenv.WARNING)
+        return cached.get('partitions') if cached.get('key') == key else None
+
+    kv.set(SIZING_KEY, {'key': key, 'time': time.time(),
+                        'partitions': partitions})
+    kv.flush()
+    return partitions
+
+
+class MirrorMaker(object):
+    def settings(self):
+        '''
+        Returns the mirror settings derived from the charm config and the
+        size of the source cluster.
+        '''
+        config = hookenv.config()
+        source = config['mirror_source_bootstrap']
+        use_ssl = config['mirror_source_protocol'] == 'SSL'
+        whitelist = config['mirror_whitelist'] or '.*'
+        whitelist_pattern(whitelist)
+
+        partitions = None
+        streams = config['mirror_num_streams']
+        if not streams:
+            partitions = cached_source_partitions(source, use_ssl, whitelist)
+            streams = num_streams(partitions, cluster_size())
+
+        return {
+            'source': source,
+            'ssl': use_ssl,
+            'whitelist': whitelist,
+            'group': mirror_group(),
+            'client_id': '{}-{}'.format(
+                MIRROR_APP, hookenv.local_unit().replace('/', '-')),
+            'source_partitions': partitions,
+            'streams': streams,
+            'heap_mb': config['mirror_heap_mb'],
+            'compression': config['mirror_compression'],
+            'batch_size': config['mirror_batch_size'],
+            'linger_ms': config['mirror_linger_ms'],
+            'consumer_properties': config['mirror_consumer_properties'] or '',
+            'producer_properties': config['mirror_producer_properties'] or '',
+            'target': '{}:{}'.format(get_ingress_address('listener'),
+                                     config['port']),
+        }
+
+    def install(self, settings):
+        '''
+        Writes the consumer and producer configs and the systemd unit,
+        then (re)starts the service.
+        '''
+        os.makedirs(MIRROR_LOG_DIR, mode=0o755, exist_ok=True)
+        shutil.chown(MIRROR_LOG_DIR, user='kafka')
+
+        context = dict(settings)
+        context.update({
+            'keystore_password': keystore_password(),
+            'ca_keystore': caKeystore(),
+            'client_keystore': keystore('client'),
+        })
+        for target, template, extra in (
+                (MIRROR_CONSUMER, 'mirror-consumer.properties',
+                 settings['consumer_properties']),
+                (MIRROR_PRODUCER, 'mirror-producer.properties',
+                 settings['producer_properties'])):
+            # the properties of the config options come last and win
+            content = render(source=template, target=None, context=context)
+            host.write_file(
+                target,
+                '{}\n{}\n'.format(content.rstrip(), extra.strip()).encode(
+                    'utf-8'),
+                owner='root',
+                group='kafka',
+                perms=0o440
+            )
+
+        render(
+            source=MIRROR_SERVICE,
+            target=MIRROR_UNIT,
+            owner='root',
+            perms=0o644,
+            context={
+                'source': settings['source'],
+                'heap_mb': settings['heap_mb'],
+                'log_dir': MIRROR_LOG_DIR,
+                'mirror_maker': os.path.join(KAFKA_BIN,
+                                             'kafka-mirror-maker.sh'),
+                'consumer_config': MIRROR_CONSUMER,
+                'producer_config': MIRROR_PRODUCER,
+                'streams': settings['streams'],
+                'whitelist': systemd_quote(settings['whitelist']),
+            }
+        )
+
+        host.service('daemon-reload', '')
+        host.service('enable', MIRROR_SERVICE)
+        host.service_restart(MIRROR_SERVICE)
+
+        kv = unitdata.kv()
+        kv.set(INSTALLED_KEY, {key: settings[key]
+                               for key in INSTALLED_SETTINGS})
+        kv.flush()
+
+    def remove(self):
+        '''
+        Stops the mirror and removes its systemd unit.
+        '''
+        if not os.path.exists(MIRROR_UNIT):
+            return
+        host.service_stop(MIRROR_SERVICE)
+        host.service('disable', MIRROR_SERVICE)
+        os.remove(MIRROR_UNIT)
+        host.service('daemon-reload', '')
+        unitdata.kv().unset(INSTALLED_KEY)
+
+    def is_running(self):
+        return host.service_running(MIRROR_SERVICE)
@@ -0,0 +1,348 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Partition reassignment planner. Starting from the current placement it
+# moves as few bytes as it can to balance replicas, bytes and preferred
+# leaders over the target brokers, keeping replicas in distinct racks.
+
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+class PlanError(ValueError):
+    pass
+
+
+class Planner(object):
+    '''
+    Plans a reassignment of assignment, {(topic, partition): [replicas]},
+    onto the brokers list. sizes gives the bytes of each partition and
+    racks the rack of each broker; racks are ignored unless every target
+    broker has one. Bytes are balanced within tolerance (a fraction of the
+    mean) once replica counts differ by at most one.
+    '''
+
+    def __init__(self, assignment, sizes, brokers, racks=None,
+                 tolerance=0.1):
+        self.brokers = sorted(set(brokers))
+        if not self.brokers:
+            raise PlanError('no target brokers')
+        racks = racks or {}
+        if all(racks.get(b) for b in self.brokers):
+            self.racks = {b: racks[b] for b in self.brokers}
+        else:
+            self.racks = None
+        self.rack_count = len(set(self.racks.values())) if self.racks else 0
+        self.sizes = {key: sizes.get(key, 0) for key in assignment}
+        self.tolerance = tolerance
+        self.current = {key: list(r) for key, r in assignment.items()}
+        self.target = {key: list(r) for key, r in assignment.items()}
+
+        for key, replicas in self.target.items():
+            if len(replicas) > len(self.brokers):
+                raise PlanError('{}-{} has {} replicas but only {} target '
+                                'brokers'.format(key[0], key[1],
+                                                 len(replicas),
+                                                 len(self.brokers)))
+
+        self.count = {b: 0 for b in self.brokers}
+        self.bytes = {b: 0 for b in self.brokers}
+        self.hosted = {b: set() for b in self.brokers}
+        for key, replicas in self.target.items():
+            for b in replicas:
+                if b in self.count:
+                    self.count[b] += 1
+                    self.bytes[b] += self.sizes[key]
+                    self.hosted[b].add(key)
+
+    def distinct_racks(self, replicas):
+        return len(set(self.racks[b] for b in replicas if b in self.racks))
+
+    def can_move(self, key, src, dst):
+        '''
+        A replica may move to a broker not holding the partition yet, as
+        long as the partition does not end up in fewer racks.
+        '''
+        replicas = self.target[key]
+        if dst in replicas or dst not in self.count:
+            return False
+        if not self.racks:
+            return True
+        after = [dst if b == src else b for b in replicas]
+        return self.distinct_racks(after) >= self.distinct_racks(replicas)
+
+    def move(self, key, src, dst):
+        replicas = self.target[key]
+        replicas[replicas.index(src)] = dst
+        size = self.sizes[key]
+        if src in self.count:
+            self.count[src] -= 1
+            self.bytes[src] -= size
+            self.hosted[src].discard(key)
+        self.count[dst] += 1
+        self.bytes[dst] += size
+        self.hosted[dst].add(key)
+
+    def evacuate(self):
+        '''
+        Moves every replica off brokers which are not targets, preferring
+        destinations that add a rack, then the least loaded ones.
+        '''
+        for key in sorted(self.target, key=lambda k: -self.sizes[k]):
+            for src in list(self.target[key]):
+                if src in self.count:
+                    continue
+                candidates = [b for b in self.brokers
+                              if self.can_move(key, src, b)]
+                if not candidates:
+                    candidates = [b for b in self.brokers
+                                  if b not in self.target[key]]
+
+                def rank(b):
+                    after = [b if r == src else r for r in self.target[key]]
+                    racks = -self.distinct_racks(after) if self.racks else 0
+                    return (racks, self.count[b], self.bytes[b], b)
+
+                self.move(key, src, min(candidates, key=rank))
+
+    def count_bounds(self):
+        total = sum(self.count.values())
+        low = total // len(self.brokers)
+        return low, low + (1 if total % len(self.brokers) else 0)
+
+    def byte_bounds(self):
+        mean = sum(self.bytes.values()) / float(len(self.brokers))
+        return mean * (1 - self.tolerance), mean * (1 + self.tolerance)
+
+    def replicas_on(self, broker):
+        return sorted(self.hosted[broker])
+
+    def balance_counts(self):
+        '''
+        Evens out replica counts. Each move takes the partition whose size
+        is closest to what the receiving broker still lacks per missing
+        replica, so that bytes end up balanced without further moves.
+        '''
+        low, high = self.count_bounds()
+        mean = sum(self.bytes.values()) / float(len(self.brokers))
+        while True:
+            over = [b for b in self.brokers if self.count[b] > high]
+            under = [b for b in self.brokers if self.count[b] < low]
+            if not over and not under:
+                return
+            src = max(over or self.brokers,
+                      key=lambda b: (self.count[b], self.bytes[b]))
+            dst = min(under or self.brokers,
+                      key=lambda b: (self.count[b], self.bytes[b]))
+            if self.count[src] - self.count[dst] < 2:
+                return
+
+            wanted = max(0, mean - self.bytes[dst]) / max(
+                1, low - self.count[dst])
+            candidates = [k for k in self.replicas_on(src)
+                          if self.can_move(k, src, dst)]
+            if not candidates:
+                return
+            self.move(min(candidates, key=lambda k: (
+                abs(self.sizes[k] - wanted), self.sizes[k], k)), src, dst)
+
+    def best_transfer(self, src, dst, single):
+        '''
+        Returns (score, bytes moved, key, swapped key) for the move or swap
+        from src to dst whose net transfer is closest to half their gap.
+        '''
+        gap = self.bytes[src] - self.bytes[dst]
+        best = None
+        src_keys = [k for k in self.replicas_on(src)
+                    if self.can_move(k, src, dst)]
+        if single:
+            for k in src_keys:
+                s = self.sizes[k]
+                if 0 < s < gap:
+                    cand = (abs(gap - 2 * s), s, k, None)
+                    best = min(best, cand) if best else cand
+
+        # swap k for q, ideally sizes[q] == sizes[k] - gap / 2
+        dst_keys = sorted((self.sizes[q], q) for q in self.replicas_on(dst)
+                          if self.can_move(q, dst, src))
+        dst_sizes = [size for size, _ in dst_keys]
+        for k in src_keys:
+            i = bisect_left(dst_sizes, self.sizes[k] - gap / 2.0)
+            for size, q in dst_keys[max(0, i - 1):i + 1]:
+                net = self.sizes[k] - size
+                if q != k and 0 < net < gap:
+                    cand = (abs(gap - 2 * net), self.sizes[k] + size, k, q)
+                    best = min(best, cand) if best else cand
+
+        return best
+
+    def balance_bytes(self, max_rounds=None):
+        '''
+        Narrows the byte spread with single moves where counts allow it and
+        with swaps otherwise, starting with the fullest and emptiest brokers
+        and falling back to other pairs when racks forbid every transfer.
+        '''
+        low, high = self.count_bounds()
+        byte_low, byte_high = self.byte_bounds()
+        rounds = max_rounds or 4 * len(self.target) + 1
+        for _ in range(rounds):
+            ranked = sorted(self.brokers, key=lambda b: self.bytes[b])
+            if (self.bytes[ranked[-1]] <= byte_high and
+                    self.bytes[ranked[0]] >= byte_low):
+                return
+            pairs = sorted(
+                ((src, dst) for src in ranked for dst in ranked
+                 if self.bytes[src] > byte_high or self.bytes[dst] < byte_low),
+                key=lambda p: self.bytes[p[1]] - self.bytes[p[0]])
+            for src, dst in pairs:
+                if self.bytes[src] <= self.bytes[dst]:
+                    break
+                single = self.count[src] > low and self.count[dst] < high
+                best = self.best_transfer(src, dst, single)
+                if best and best[0] < self.bytes[src] - self.bytes[dst]:
+                    _, _, k, q = best
+                    self.move(k, src, dst)
+                    if q is not None:
+                        self.move(q, dst, src)
+                    break
+            else:
+                return
+
+    def balance_leaders(self):
+        '''
+        Reorders replicas so that every broker is the preferred leader of an
+        even share of partitions. Only the order changes, no data moves.
+        '''
+        partitions = sorted(self.target)
+        total = len(partitions)
+        high = -(-total // len(self.brokers))
+        leaders = {b: 0 for b in self.brokers}
+        pending = []
+        for key in partitions:
+            first = self.target[key][0]
+            if leaders.get(first, high) < high:
+                leaders[first] += 1
+            else:
+                pending.append(key)
+        for key in pending:
+            replicas = self.target[key]
+            best = min(replicas, key=lambda b: (leaders.get(b, total), b))
+            replicas.remove(best)
+            replicas.insert(0, best)
+            leaders[best] = leaders.get(best, 0) + 1
+
+        # the greedy pass can leave a broker above its share while the
+        # followers of its partitions are not below theirs, hand leadership
+        # down chains of partitions until no broker is over
+        low = total // len(self.brokers)
+        for _ in range(total):
+            over = [b for b in self.brokers if leaders[b] > high]
+            if not over:
+                return
+            if not self.shift_leadership(over[0], leaders, low):
+                return
+
+    def shift_leadership(self, start, leaders, low):
+        '''
+        Finds a chain start -> b1 -> ... -> bn of preferred leaderships to
+        hand over, ending on a broker below the mean, and applies it.
+        '''
+        led = {}
+        for key in sorted(self.target):
+            led.setdefault(self.target[key][0], []).append(key)
+
+        parents = {start: None}
+        queue = [start]
+        while queue:
+            broker = queue.pop(0)
+            for key in led.get(broker, []):
+                for follower in self.target[key][1:]:
+                    if follower in parents or follower not in leaders:
+                        continue
+                    parents[follower] = (broker, key)
+                    if leaders[follower] < low or (
+                            leaders[follower] < leaders[start] - 1):
+                        while parents[follower]:
+                            previous, key = parents[follower]
+                            replicas = self.target[key]
+                            replicas.remove(follower)
+                            replicas.insert(0, follower)
+                            leaders[follower] += 1
+                            leaders[previous] -= 1
+                            follower = previous
+                        return True
+                    queue.append(follower)
+        return False
+
+    def plan(self):
+        self.evacuate()
+        self.balance_counts()
+        self.balance_bytes()
+        self.balance_leaders()
+        return self.report()
+
+    def stats(self, assignment):
+        stats = OrderedDict((b, OrderedDict((
+            ('replicas', 0), ('leaders', 0), ('bytes', 0))))
+            for b in sorted(set(self.brokers).union(
+                *[set(r) for r in assignment.values()])))
+        for key, replicas in assignment.items():
+            for i, b in enumerate(replicas):
+                stats[b]['replicas'] += 1
+                stats[b]['bytes'] += self.sizes[key]
+                if i == 0:
+                    stats[b]['leaders'] += 1
+        return stats
+
+    def report(self):
+        '''
+        Returns the reassignment (changed partitions only, in the format of
+        kafka-reassign-partitions), the rollback assignment and the moves.
+        '''
+        partitions, rollback, moves = [], [], []
+        bytes_moved = 0
+        for key in sorted(self.target):
+            new, old = self.target[key], self.current[key]
+            if new == old:
+                continue
+            partitions.append(OrderedDict((
+                ('topic', key[0]), ('partition', key[1]), ('replicas', new))))
+            rollback.append(OrderedDict((
+                ('topic', key[0]), ('partition', key[1]), ('replicas', old))))
+            added = [b for b in new if b not in old]
+            if added:
+                moved = self.sizes[key] * len(added)
+                bytes_moved += moved
+                moves.append(OrderedDict((
+                    ('topic', key[0]),
+                    ('partition', key[1]),
+                    ('from', [b for b in old if b not in new]),
+                    ('to', added),
+                    ('bytes', moved),
+                )))
+
+        return OrderedDict((
+            ('reassignment', {'version': 1, 'partitions': partitions}),
+            ('rollback', {'version': 1, 'partitions': rollback}),
+            ('moves', moves),
+            ('bytes_moved', bytes_moved),
+            ('replicas_moved', sum(len(m['to']) for m in moves)),
+            ('before', self.stats(self.current)),
+            ('after', self.stats(self.target)),
+        ))
+
+
+def plan(assignment, sizes, brokers, racks=None, tolerance=0.1):
+    return Planner(assignment, sizes, brokers, racks, tolerance).plan()
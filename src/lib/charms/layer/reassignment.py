@@ -0,0 +1,368 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Executes a partition reassignment in batches under a replication
+# throttle. Progress is kept in the unit's kv store so that update-status
+# and later actions can poll it, submit the next batch and report.
+
+import os
+import time
+import json
+import tempfile
+
+from collections import OrderedDict
+from subprocess import check_output, CalledProcessError, STDOUT
+
+from charmhelpers.core import unitdata
+
+from charms.layer.kafka import (KAFKA_APP_DATA, KAFKA_BIN, parse_properties,
+                                read_file)
+from charms.layer.broker_config import (BrokerConfigError,
+                                        alter_broker_configs,
+                                        alter_topic_configs)
+
+STATE_KEY = 'kafka.reassignment'
+ACTIVE = ('running', 'cancelling')
+
+# seconds without a copied byte before a moving partition is reported
+STUCK_AFTER = 900
+
+BROKER_THROTTLES = ('leader.replication.throttled.rate',
+                    'follower.replication.throttled.rate')
+TOPIC_THROTTLES = ('leader.replication.throttled.replicas',
+                   'follower.replication.throttled.replicas')
+
+
+class ReassignmentError(Exception):
+    pass
+
+
+def load():
+    return unitdata.kv().get(STATE_KEY)
+
+
+def save(state):
+    kv = unitdata.kv()
+    kv.set(STATE_KEY, state)
+    kv.flush()
+
+
+def active():
+    state = load()
+    return bool(state and state['state'] in ACTIVE)
+
+
+def added(partition):
+    return [b for b in partition['replicas']
+            if b not in partition['original']]
+
+
+def next_batch(partitions, max_partitions, max_bytes):
+    '''
+    Takes pending partitions in plan order up to max_partitions and
+    max_bytes to copy; the first one is always taken so that a partition
+    larger than max_bytes still moves, alone.
+    '''
+    batch, total = [], 0
+    for partition in partitions:
+        if partition['status'] != 'pending':
+            continue
+        if len(batch) >= max_partitions:
+            break
+        if batch and total + partition['bytes'] > max_bytes:
+            continue
+        batch.append(partition)
+        total += partition['bytes']
+
+    return batch
+
+
+def throttled_replicas(batch):
+    '''
+    Returns the topic throttle configs of a batch: the current replicas
+    lead the copy and the added ones follow, as kafka-reassign-partitions
+    sets them.
+    '''
+    replicas = {}
+    for p in batch:
+        leaders, followers = replicas.setdefault(p['topic'], ([], []))
+        leaders += ['{}:{}'.format(p['partition'], b) for b in p['original']]
+        followers += ['{}:{}'.format(p['partition'], b) for b in added(p)]
+
+    return {
+        topic: dict(zip(TOPIC_THROTTLES, (','.join(leaders),
+                                          ','.join(followers))))
+        for topic, (leaders, followers) in replicas.items()
+    }
+
+
+def apply_throttles(state, batch):
+    if not state['throttle']:
+        return
+
+    topics = throttled_replicas(batch)
+    for topic in state['throttled']['topics']:
+        if topic not in topics:
+            alter_topic_configs(topic, dict.fromkeys(TOPIC_THROTTLES))
+    for topic, configs in sorted(topics.items()):
+        alter_topic_configs(topic, configs)
+
+    brokers = set(state['throttled']['brokers'])
+    for p in batch:
+        for broker in set(p['original'] + p['replicas']) - brokers:
+            alter_broker_configs(
+                dict.fromkeys(BROKER_THROTTLES, state['throttle']), broker)
+            brokers.add(broker)
+
+    state['throttled'] = {'topics': sorted(topics),
+                          'brokers': sorted(brokers)}
+
+
+def remove_throttles(state):
+    for topic in state['throttled']['topics']:
+        alter_topic_configs(topic, dict.fromkeys(TOPIC_THROTTLES))
+    for broker in state['throttled']['brokers']:
+        alter_broker_configs(dict.fromkeys(BROKER_THROTTLES), broker)
+    state['throttled'] = {'topics': [], 'brokers': []}
+
+
+def submit(batch):
+    '''
+    Starts the reassignment of a batch with kafka-reassign-partitions,
+    which refuses to start while another reassignment is running.
+    '''
+    server = parse_properties(
+        read_file(os.path.join(KAFKA_APP_DATA, 'server.properties')))
+    content = {'version': 1, 'partitions': [
+        {'topic': p['topic'], 'partition': p['partition'],
+         'replicas': p['replicas']} for p in batch]}
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+        json.dump(content, f)
+        f.flush()
+        try:
+            check_output([
+                os.path.join(KAFKA_BIN, 'kafka-reassign-partitions.sh'),
+                '--execute',
+                '--reassignment-json-file', f.name,
+                '--zookeeper', server.get('zookeeper.connect', ''),
+            ], stderr=STDOUT)
+        except CalledProcessError as e:
+            raise ReassignmentError(e.output.decode('utf-8', 'replace'))
+
+
+def start(admin, reassignment, throttle, max_partitions, max_bytes,
+          now=None):
+    '''
+    Records the partitions of reassignment (the kafka-reassign-partitions
+    format) which differ from the cluster and submits the first batch.
+    throttle is the replication rate in bytes per second, 0 for none.
+    '''
+    state = load()
+    if state and state['state'] in ACTIVE:
+        raise ReassignmentError(
+            'a reassignment is already {}'.format(state['state']))
+
+    try:
+        entries = [(str(e['topic']), int(e['partition']),
+                    [int(b) for b in e['replicas']])
+                   for e in reassignment['partitions']]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ReassignmentError('invalid reassignment: {}'.format(e))
+
+    metadata = admin.metadata(sorted(set(e[0] for e in entries)))
+    sizes = admin.replica_sizes()
+    partitions = []
+    for topic, index, replicas in entries:
+        info = metadata.get(topic, {}).get('partitions', {}).get(index)
+        if not info:
+            raise ReassignmentError('unknown partition {}-{}'.format(
+                topic, index))
+        unknown = sorted(set(replicas) - set(admin.brokers))
+        if unknown or len(set(replicas)) != len(replicas):
+            raise ReassignmentError('invalid replicas {} for {}-{}'.format(
+                replicas, topic, index))
+        if info['replicas'] == replicas:
+            continue
+
+        size = max(sizes.get((topic, index), {}).values() or [0])
+        partition = {
+            'topic': topic,
+            'partition': index,
+            'original': info['replicas'],
+            'replicas': replicas,
+            'size': size,
+            'status': 'pending',
+            'copied': 0,
+        }
+        partition['bytes'] = size * len(added(partition))
+        partitions.append(partition)
+
+    now = now or time.time()
+    save({
+        'state': 'running',
+        'started': now,
+        'updated': now,
+        'finished': None,
+        'throttle': throttle,
+        'max_partitions': max_partitions,
+        'max_bytes': max_bytes,
+        'batches': 0,
+        'partitions': partitions,
+        'throttled': {'topics': [], 'brokers': []},
+        'error': None,
+    })
+
+    return step(admin, now)
+
+
+def poll(state, admin, now):
+    '''
+    Updates the copied bytes of the moving partitions from the log dirs
+    of the new replicas and marks those whose replicas are all in sync.
+    '''
+    moving = [p for p in state['partitions'] if p['status'] == 'moving']
+    if not moving:
+        return
+
+    metadata = admin.metadata(sorted(set(p['topic'] for p in moving)))
+    sizes = admin.replica_sizes()
+    for p in moving:
+        topic = metadata.get(p['topic'], {})
+        info = topic.get('partitions', {}).get(p['partition'])
+        if not info:
+            # deleted while moving
+            p.update(status='skipped', done=now)
+            continue
+
+        copied = sum(min(sizes.get((p['topic'], p['partition']), {})
+                         .get(b, 0), p['size']) for b in added(p))
+        if (info['replicas'] == p['replicas'] and
+                set(p['replicas']) <= set(info['isr'])):
+            p.update(status='done', done=now)
+            copied = p['bytes']
+        if copied > p['copied']:
+            p.update(copied=copied, progress_at=now)
+
+
+def step(admin, now=None):
+    '''
+    Advances the recorded reassignment: polls the moving batch and, once
+    it is done, submits the next one or, when none is left or it was
+    cancelled, removes the throttles. Returns the state.
+    '''
+    state = load()
+    if not state or state['state'] not in ACTIVE:
+        return state
+
+    now = now or time.time()
+    try:
+        poll(state, admin, now)
+        if not any(p['status'] == 'moving' for p in state['partitions']):
+            batch = []
+            if state['state'] == 'running':
+                batch = next_batch(state['partitions'],
+                                   state['max_partitions'],
+                                   state['max_bytes'])
+            if batch:
+                apply_throttles(state, batch)
+                save(state)
+                submit(batch)
+                for p in batch:
+                    p.update(status='moving', submitted=now,
+                             progress_at=now)
+                state['batches'] += 1
+            else:
+                remove_throttles(state)
+                state['state'] = ('cancelled' if state['state'] ==
+                                  'cancelling' else 'completed')
+                state['finished'] = now
+        state['error'] = None
+    except (ReassignmentError, BrokerConfigError) as e:
+        state['error'] = str(e)
+        raise ReassignmentError(str(e))
+    finally:
+        state['updated'] = now
+        save(state)
+
+    return state
+
+
+def cancel():
+    '''
+    Stops submitting batches. A batch already submitted cannot be safely
+    aborted and completes; throttles are removed once it has.
+    '''
+    state = load()
+    if not state or state['state'] not in ACTIVE:
+        raise ReassignmentError('no reassignment in progress')
+    state['state'] = 'cancelling'
+    save(state)
+
+    return state
+
+
+def progress(state, now=None, stuck_after=STUCK_AFTER):
+    '''
+    Summarises a reassignment state: percent of bytes copied, an ETA from
+    the average rate so far and the moving partitions which copied
+    nothing for stuck_after seconds.
+    '''
+    now = now or time.time()
+    partitions = state['partitions']
+    counts = OrderedDict((status, 0) for status in
+                         ('pending', 'moving', 'done', 'skipped'))
+    for p in partitions:
+        counts[p['status']] += 1
+
+    total = sum(p['bytes'] for p in partitions)
+    copied = sum(p['copied'] for p in partitions)
+    if total:
+        percent = 100.0 * copied / total
+    else:
+        finished = counts['done'] + counts['skipped']
+        percent = 100.0 * finished / len(partitions) if partitions else 100.0
+
+    # bytes still to copy before the reassignment stops
+    remaining = sum(p['bytes'] - p['copied'] for p in partitions
+                    if p['status'] == 'moving' or (
+                        p['status'] == 'pending' and
+                        state['state'] == 'running'))
+    elapsed = (state['finished'] or now) - state['started']
+    rate = copied / elapsed if elapsed > 0 else 0
+    eta = None
+    if state['state'] in ACTIVE and rate:
+        eta = int(remaining / rate)
+
+    stuck = ['{}-{}'.format(p['topic'], p['partition'])
+             for p in partitions if p['status'] == 'moving' and
+             now - p['progress_at'] > stuck_after]
+
+    return OrderedDict((
+        ('state', state['state']),
+        ('percent', round(percent, 1)),
+        ('partitions', counts),
+        ('batches', state['batches']),
+        ('bytes-total', total),
+        ('bytes-copied', copied),
+        ('rate', int(rate)),
+        ('eta-seconds', eta),
+        ('elapsed-seconds', int(elapsed)),
+        ('stuck', stuck),
+        ('moving', ['{}-{}'.format(p['topic'], p['partition'])
+                    for p in partitions if p['status'] == 'moving']),
+        ('throttle', state['throttle']),
+        ('error', state['error']),
+    ))
@@ -0,0 +1,295 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Kafka record batches (magic 2) and legacy message sets (magic 0 and 1),
+# decoded and encoded with the standard library. gzip is the only
+# compression codec the standard library provides, batches using another
+# one are reported.
+
+import gzip
+import time
+import struct
+
+try:
+    # C implementation of CRC-32C, much faster than the table below
+    from crc32c import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+COMPRESSION_CODECS = {0: 'none', 1: 'gzip', 2: 'snappy', 3: 'lz4', 4: 'zstd'}
+COMPRESSION_MASK = 0x07
+CONTROL_FLAG = 0x20
+
+# baseOffset int64, batchLength int32, then the magic after 4 more bytes
+LOG_OVERHEAD = 12
+BATCH_HEADER = struct.Struct('>qiibIhiqqqhii')
+LEGACY_HEADER = struct.Struct('>qiIbb')
+
+# the batch CRC covers everything after the crc field itself
+CRC_OFFSET = 21
+
+NO_PRODUCER_ID = -1
+NO_SEQUENCE = -1
+NO_PARTITION_LEADER_EPOCH = -1
+
+
+def _crc32c_tables():
+    '''
+    Lookup tables of CRC-32C for 8 bytes at a time (slicing-by-8).
+    '''
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    tables = [table]
+    for _ in range(7):
+        tables.append([(crc >> 8) ^ table[crc & 0xFF] for crc in tables[-1]])
+    return tables
+
+
+CRC32C_TABLES = _crc32c_tables()
+
+
+class RecordsError(ValueError):
+    pass
+
+
+def crc32c(data):
+    '''
+    CRC-32C (Castagnoli) of data, the checksum of magic 2 record batches.
+    '''
+    if _crc32c:
+        return _crc32c(data)
+    t0, t1, t2, t3, t4, t5, t6, t7 = CRC32C_TABLES
+    data = bytes(data)
+    crc = 0xFFFFFFFF
+    words = len(data) // 8 * 2
+    lows = iter(struct.unpack_from('<{}I'.format(words), data))
+    for low, high in zip(lows, lows):
+        low ^= crc
+        crc = (t7[low & 0xFF] ^ t6[(low >> 8) & 0xFF] ^
+               t5[(low >> 16) & 0xFF] ^ t4[low >> 24] ^
+               t3[high & 0xFF] ^ t2[(high >> 8) & 0xFF] ^
+               t1[(high >> 16) & 0xFF] ^ t0[high >> 24])
+    for byte in data[words * 4:]:
+        crc = t0[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def write_varint(value):
+    '''
+    Returns the zigzag encoded varint of value.
+    '''
+    value = (value << 1) ^ (value >> 63)
+    out = bytearray()
+    while value & ~0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def write_varbytes(value):
+    if value is None:
+        return write_varint(-1)
+    return write_varint(len(value)) + value
+
+
+def read_varint(data, pos):
+    '''
+    Reads a zigzag encoded varint, returns (value, next position).
+    '''
+    shift = result = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return (result >> 1) ^ -(result & 1), pos
+
+
+def read_varbytes(data, pos):
+    length, pos = read_varint(data, pos)
+    if length < 0:
+        return None, pos
+    return bytes(data[pos:pos + length]), pos + length
+
+
+def compress(codec, data):
+    if codec == 0:
+        return data
+    if codec == 1:
+        # the default level of the Java producer
+        return gzip.compress(data, 6)
+    raise RecordsError('{} compression is not supported'.format(
+        COMPRESSION_CODECS.get(codec, codec)))
+
+
+def decompress(codec, data):
+    if codec == 0:
+        return data
+    if codec == 1:
+        return gzip.decompress(bytes(data))
+    raise RecordsError('{} compressed records cannot be decoded'.format(
+        COMPRESSION_CODECS.get(codec, codec)))
+
+
+def decode_records(data, count, base_offset, first_timestamp):
+    pos, records = 0, []
+    for _ in range(count):
+        length, pos = read_varint(data, pos)
+        end = pos + length
+        pos += 1  # attributes
+        timestamp_delta, pos = read_varint(data, pos)
+        offset_delta, pos = read_varint(data, pos)
+        key, pos = read_varbytes(data, pos)
+        value, pos = read_varbytes(data, pos)
+        header_count, pos = read_varint(data, pos)
+        headers = []
+        for _ in range(header_count):
+            name, pos = read_varbytes(data, pos)
+            header, pos = read_varbytes(data, pos)
+            headers.append((name.decode('utf-8', 'replace'), header))
+        records.append({
+            'offset': base_offset + offset_delta,
+            'timestamp': first_timestamp + timestamp_delta,
+            'key': key,
+            'value': value,
+            'headers': headers,
+        })
+        pos = end
+
+    return records
+
+
+def decode_legacy(data, magic, attributes, pos, offset):
+    '''
+    Decodes the message of a magic 0 or 1 entry; compressed wrappers hold
+    a message set whose offsets, in magic 1, are relative to the last one.
+    '''
+    timestamp = -1
+    if magic == 1:
+        timestamp = struct.unpack_from('>q', data, pos)[0]
+        pos += 8
+    key_length = struct.unpack_from('>i', data, pos)[0]
+    pos += 4
+    key = bytes(data[pos:pos + key_length]) if key_length >= 0 else None
+    pos += max(key_length, 0)
+    value_length = struct.unpack_from('>i', data, pos)[0]
+    pos += 4
+    value = bytes(data[pos:pos + value_length]) if value_length >= 0 else None
+
+    codec = attributes & COMPRESSION_MASK
+    if not codec:
+        return [{'offset': offset, 'timestamp': timestamp, 'key': key,
+                 'value': value, 'headers': []}]
+
+    inner = []
+    for _, records in decode_batches(decompress(codec, value or b'')):
+        inner.extend(records)
+    if magic == 1 and inner:
+        shift = offset - inner[-1]['offset']
+        for record in inner:
+            record['offset'] += shift
+    return inner
+
+
+def decode_batches(data):
+    '''
+    Yields (next offset, records) for every complete batch or legacy
+    message in data, as returned by Fetch; a partial batch at the end is
+    ignored. Control batches yield no records.
+    '''
+    data = memoryview(data)
+    pos = 0
+    while pos + LOG_OVERHEAD + 5 <= len(data):
+        base_offset, length = struct.unpack_from('>qi', data, pos)
+        end = pos + LOG_OVERHEAD + length
+        if end > len(data):
+            return
+        magic = data[pos + 16]
+
+        if magic < 2:
+            _, _, _, magic, attributes = LEGACY_HEADER.unpack_from(data, pos)
+            records = decode_legacy(data, magic, attributes,
+                                    pos + LEGACY_HEADER.size, base_offset)
+            next_offset = (records[-1]['offset'] if records else
+                           base_offset) + 1
+            yield next_offset, records
+            pos = end
+            continue
+
+        (_, _, _, _, _, attributes, last_delta, first_timestamp, _, _, _, _,
+         count) = BATCH_HEADER.unpack_from(data, pos)
+        next_offset = base_offset + last_delta + 1
+        if attributes & CONTROL_FLAG:
+            yield next_offset, []
+        else:
+            body = decompress(attributes & COMPRESSION_MASK,
+                              data[pos + BATCH_HEADER.size:end])
+            yield next_offset, decode_records(
+                memoryview(body), count, base_offset, first_timestamp)
+        pos = end
+
+
+def encode_record(offset_delta, timestamp_delta, key, value, headers=()):
+    body = b''.join([
+        b'\x00',  # attributes
+        write_varint(timestamp_delta),
+        write_varint(offset_delta),
+        write_varbytes(key),
+        write_varbytes(value),
+        write_varint(len(headers)),
+    ] + [write_varbytes(name.encode('utf-8')) + write_varbytes(header)
+         for name, header in headers])
+    return write_varint(len(body)) + body
+
+
+def encode_batch(records, codec=0):
+    '''
+    Returns a magic 2 record batch of records, (key, value, headers,
+    timestamp) tuples, ready for Produce; records without a timestamp (ms)
+    are stamped with the current time. The broker assigns the offsets.
+    '''
+    if not records:
+        raise RecordsError('empty record batch')
+    now = int(time.time() * 1000)
+    timestamps = [now if r[3] is None else r[3] for r in records]
+    first = min(timestamps)
+    body = b''.join(
+        encode_record(i, timestamp - first, key, value, headers)
+        for i, ((key, value, headers, _), timestamp) in enumerate(
+            zip(records, timestamps)))
+    body = compress(codec, body)
+
+    header = BATCH_HEADER.pack(
+        0,                                  # base offset
+        BATCH_HEADER.size - LOG_OVERHEAD + len(body),
+        NO_PARTITION_LEADER_EPOCH,
+        2,                                  # magic
+        0,                                  # crc, set below
+        codec,                              # attributes
+        len(records) - 1,                   # last offset delta
+        first, max(timestamps),
+        NO_PRODUCER_ID, -1, NO_SEQUENCE,    # producer id, epoch, sequence
+        len(records),
+    )
+    crc = crc32c(header[CRC_OFFSET:] + body)
+    return (header[:CRC_OFFSET - 4] + struct.pack('>I', crc) +
+            header[CRC_OFFSET:] + body)
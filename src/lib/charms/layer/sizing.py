@@ -0,0 +1,199 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import math
+
+from collections import OrderedDict
+from subprocess import check_output, CalledProcessError
+
+from charmhelpers.core import host, hookenv
+
+# assumed when the link speed cannot be read, e.g. on virtual NICs
+DEFAULT_NIC_SPEED = 1000
+
+CGROUP_MEMORY_LIMIT = '/sys/fs/cgroup/memory/memory.limit_in_bytes'
+
+# share of the memory given to the heap, the rest is left to the page cache
+HEAP_RATIO = 0.25
+MIN_HEAP_MB = 512
+
+
+def clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def cpu_count():
+    return os.cpu_count() or 1
+
+
+def interface_for_address(address):
+    '''
+    Returns the name of the interface holding the given IPv4 address, or
+    None if it cannot be found.
+    '''
+    try:
+        output = check_output(['ip', '-o', '-4', 'addr', 'show'])
+    except (CalledProcessError, OSError):
+        return None
+
+    for line in output.decode('utf-8').splitlines():
+        fields = line.split()
+        # 2: eth0    inet 10.0.0.5/24 brd ...
+        if len(fields) > 3 and fields[3].split('/')[0] == address:
+            return fields[1].split('@')[0]
+
+    return None
+
+
+def nic_speed(address):
+    '''
+    Returns the link speed in Mbit/s of the interface carrying address.
+    '''
+    iface = interface_for_address(address)
+    if not iface:
+        return DEFAULT_NIC_SPEED
+
+    try:
+        with open('/sys/class/net/{}/speed'.format(iface)) as f:
+            speed = int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return DEFAULT_NIC_SPEED
+
+    return speed if speed > 0 else DEFAULT_NIC_SPEED
+
+
+def recovery_threads(dir_count, cores=None):
+    '''
+    Threads per data dir used for log recovery at startup and flushing at
+    shutdown, spread so that all data dirs together use every core.
+    '''
+    return max(1, (cores or cpu_count()) // max(1, dir_count))
+
+
+def broker_threads(cores, nic_mbps, dir_count):
+    '''
+    Derives the broker thread pools and socket buffers from the hardware.
+
+    - network threads follow the link speed (about one per 2.5 Gbit/s) and
+      the cores, never exceeding half of them but at least two;
+    - I/O threads cover every core and at least two per data dir;
+    - replica fetchers, background and log cleaner threads grow slowly with
+      the cores, the cleaner also being bounded by the data dirs;
+    - 10 Gbit/s and faster links get 1 MiB socket buffers.
+    '''
+    nic_gbps = nic_mbps / 1000.0
+    network = max(cores // 4, int(math.ceil(nic_gbps / 2.5)) + 2)
+
+    tuning = OrderedDict()
+    network_max = max(2, cores // 2)
+    tuning['num.network.threads'] = clamp(
+        network, min(3, network_max), network_max)
+    tuning['num.io.threads'] = clamp(max(cores, 2 * dir_count), 4, 64)
+    tuning['num.replica.fetchers'] = clamp(cores // 8, 1, 8)
+    tuning['background.threads'] = clamp(cores // 2, 4, 16)
+    tuning['log.cleaner.threads'] = clamp(min(dir_count, cores // 4), 1, 8)
+    tuning['num.recovery.threads.per.data.dir'] = recovery_threads(
+        dir_count, cores)
+    buffer_bytes = 1048576 if nic_mbps >= 10000 else 102400
+    tuning['socket.send.buffer.bytes'] = buffer_bytes
+    tuning['socket.receive.buffer.bytes'] = buffer_bytes
+
+    return tuning
+
+
+def broker_tuning(log_dirs, bind_addr, overrides={}):
+    '''
+    Returns the sized broker settings for this machine, leaving out every
+    key the operator set explicitly in overrides (extra_config).
+    '''
+    cores = cpu_count()
+    speed = nic_speed(bind_addr)
+    tuning = broker_threads(cores, speed, len(log_dirs))
+    hookenv.log('Sized broker for {} cores, {} Mbit/s, {} data dirs'.format(
+        cores, speed, len(log_dirs)))
+
+    return OrderedDict(
+        (k, v) for k, v in tuning.items() if k not in overrides
+    )
+
+
+def total_memory_mb():
+    '''
+    Returns the memory available to the broker in MiB, honouring the cgroup
+    limit when running in a container.
+    '''
+    total = host.get_total_ram()
+    try:
+        with open(CGROUP_MEMORY_LIMIT) as f:
+            total = min(total, int(f.read().strip()))
+    except (IOError, OSError, ValueError):
+        pass
+
+    return total // (1024 * 1024)
+
+
+def heap_size_mb(total_mb, max_heap_mb):
+    '''
+    A quarter of the memory, at least MIN_HEAP_MB and at most max_heap_mb,
+    so that most of the RAM is left to the page cache.
+    '''
+    heap = int(total_mb * HEAP_RATIO)
+
+    return max(MIN_HEAP_MB, min(heap, max_heap_mb))
+
+
+def jvm_tuning(total_mb, max_heap_mb, pause_target_ms):
+    '''
+    Returns the heap and G1 options for a broker on a machine with total_mb
+    of memory. Xms equals Xmx so the heap is never resized at runtime.
+    '''
+    heap = heap_size_mb(total_mb, max_heap_mb)
+    heap_opts = '-Xms{0}m -Xmx{0}m'.format(heap)
+
+    performance_opts = [
+        '-server',
+        '-XX:+UseG1GC',
+        '-XX:MaxGCPauseMillis={}'.format(pause_target_ms),
+        '-XX:InitiatingHeapOccupancyPercent=35',
+        '-XX:+ParallelRefProcEnabled',
+        '-XX:+ExplicitGCInvokesConcurrent',
+        '-XX:MetaspaceSize=96m',
+        '-XX:MinMetaspaceFreeRatio=50',
+        '-XX:MaxMetaspaceFreeRatio=80',
+        '-Djava.awt.headless=true',
+    ]
+    if heap >= 8192:
+        # fewer, larger regions keep humongous allocations of big batches
+        # out of the old generation
+        performance_opts.insert(3, '-XX:G1HeapRegionSize=16M')
+
+    return {
+        'total_memory_mb': total_mb,
+        'heap_mb': heap,
+        'heap_opts': heap_opts,
+        'jvm_performance_opts': ' '.join(performance_opts),
+    }
+
+
+def broker_jvm(max_heap_mb, pause_target_ms):
+    '''
+    Returns the JVM settings sized for this machine.
+    '''
+    tuning = jvm_tuning(total_memory_mb(), max_heap_mb, pause_target_ms)
+    hookenv.log('Sized broker heap to {} MiB of {} MiB'.format(
+        tuning['heap_mb'], tuning['total_memory_mb']))
+
+    return tuning
@@ -0,0 +1,490 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reading and writing topics over the wire protocol for the topic actions.
+# Records are streamed, so that memory stays bounded by one fetch when
+# reading and by the batches in flight when writing.
+
+import json
+import time
+import struct
+import calendar
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict, deque
+
+from charms.layer.kafka_admin import LATEST_TIMESTAMP
+from charms.layer.records import decode_batches, encode_batch
+
+READ_DIR = '/var/lib/kafka-charm/read-topic'
+
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+# errors after which the partition leader is looked up again
+LEADER_ERRORS = ('NOT_LEADER_FOR_PARTITION', 'LEADER_NOT_AVAILABLE')
+
+# largest fetch when a single batch does not fit in the default one
+MAX_FETCH_BYTES = 64 * 1048576
+
+# produce errors worth a retry once the leaders are looked up again
+RETRIABLE_ERRORS = LEADER_ERRORS + (
+    'REQUEST_TIMED_OUT', 'NOT_ENOUGH_REPLICAS',
+    'NOT_ENOUGH_REPLICAS_AFTER_APPEND', 'CONNECTION_ERROR')
+RETRY_BACKOFF = 1
+
+# per record bytes of a batch besides key and value, roughly
+RECORD_OVERHEAD = 16
+
+INPUT_FORMATS = ('lines', 'length', 'json')
+
+
+class TopicIOError(Exception):
+    pass
+
+
+def parse_timestamp(value):
+    '''
+    Returns milliseconds since the epoch for a number of milliseconds or
+    a UTC date and time such as 2020-05-01T12:00:00Z.
+    '''
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            parsed = time.strptime(value.rstrip('Z'), fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(parsed) * 1000
+    raise TopicIOError('cannot parse timestamp {}'.format(value))
+
+
+def partition_leader(admin, topic, partition):
+    info = admin.metadata([topic]).get(topic)
+    if not info or info['error']:
+        raise TopicIOError('unknown topic {}'.format(topic))
+    entry = info['partitions'].get(partition)
+    if not entry:
+        raise TopicIOError('{} has no partition {}'.format(topic, partition))
+    if entry['leader'] < 0:
+        raise TopicIOError('{}-{} has no leader'.format(topic, partition))
+    return entry['leader']
+
+
+def offset_for(admin, topic, partition, leader, timestamp):
+    '''
+    Returns the first offset at or after timestamp (ms), or the earliest
+    or latest offset for EARLIEST_TIMESTAMP and LATEST_TIMESTAMP.
+    '''
+    error, offset = admin.list_offsets(
+        {topic: [partition]}, leader, timestamp)[(topic, partition)]
+    if error:
+        raise TopicIOError('cannot list offsets of {}-{}: {}'.format(
+            topic, partition, error))
+    if offset < 0:
+        # no record at or after timestamp
+        return offset_for(admin, topic, partition, leader, LATEST_TIMESTAMP)
+    return offset
+
+
+def encode_field(entry, name, value):
+    if value is None:
+        entry[name] = None
+        return
+    try:
+        entry[name] = value.decode('utf-8')
+    except UnicodeDecodeError:
+        entry['{}_base64'.format(name)] = b64encode(value).decode('ascii')
+
+
+def record_json(record):
+    '''
+    Returns a record as a JSON-ready mapping: keys and values as text when
+    they are UTF-8, base64 otherwise.
+    '''
+    entry = OrderedDict((('offset', record['offset']),
+                         ('timestamp', record['timestamp'])))
+    encode_field(entry, 'key', record['key'])
+    encode_field(entry, 'value', record['value'])
+    if record['headers']:
+        headers = []
+        for name, value in record['headers']:
+            header = OrderedDict((('name', name),))
+            encode_field(header, 'value', value)
+            headers.append(header)
+        entry['headers'] = headers
+    return entry
+
+
+def read_partition(admin, topic, partition, start, end, deadline,
+                   follow=False, fetch_bytes=1048576, position=None):
+    '''
+    Yields the records of a partition with offsets in [start, end), one
+    fetch at a time. Stops at the end of the log unless follow is set,
+    in which case it waits for new records until deadline. position, a
+    dict, gets the 'offset' following the batches read so far.
+    '''
+    leader = partition_leader(admin, topic, partition)
+    offset = start
+    position = {} if position is None else position
+    while offset < end and time.time() < deadline:
+        error, _, data = admin.fetch(topic, partition, offset, leader,
+                                     fetch_bytes)
+        if error in LEADER_ERRORS:
+            time.sleep(1)
+            leader = partition_leader(admin, topic, partition)
+            continue
+        if error:
+            raise TopicIOError('cannot fetch {}-{} at {}: {}'.format(
+                topic, partition, offset, error))
+
+        progressed = False
+        for next_offset, records in decode_batches(data):
+            for record in records:
+                if offset <= record['offset'] < end:
+                    yield record
+            offset = position['offset'] = max(offset, next_offset)
+            progressed = True
+
+        if not progressed:
+            if data and fetch_bytes < MAX_FETCH_BYTES:
+                # a batch larger than the fetch
+                fetch_bytes *= 2
+            elif not follow:
+                return
+
+
+def dump_partition(admin, topic, partition, start, end, write,
+                   max_messages, max_bytes, timeout, follow=False,
+                   preview=5):
+    '''
+    Passes the records of [start, end) to write as JSON-ready mappings
+    until a limit is reached. Returns a summary with the next offset to
+    read, the reason reading stopped and the first preview records.
+    '''
+    deadline = time.time() + timeout
+    position = {'offset': start}
+    summary = OrderedDict((('messages', 0), ('bytes', 0),
+                           ('next-offset', start), ('stopped', 'end'),
+                           ('preview', [])))
+    for record in read_partition(admin, topic, partition, start, end,
+                                 deadline, follow, position=position):
+        if summary['messages'] >= max_messages:
+            summary['stopped'] = 'max-messages'
+            break
+        size = len(record['key'] or b'') + len(record['value'] or b'')
+        if summary['bytes'] + size > max_bytes and summary['messages']:
+            summary['stopped'] = 'max-bytes'
+            break
+
+        entry = record_json(record)
+        write(entry)
+        summary['messages'] += 1
+        summary['bytes'] += size
+        summary['next-offset'] = record['offset'] + 1
+        if len(summary['preview']) < preview:
+            summary['preview'].append(entry)
+    else:
+        # past skipped control records too
+        summary['next-offset'] = min(end, position['offset'])
+        if summary['next-offset'] < end:
+            summary['stopped'] = ('timeout' if time.time() >= deadline
+                                  else 'end-of-log')
+
+    return summary
+
+
+def decode_field(entry, name):
+    if '{}_base64'.format(name) in entry:
+        return b64decode(entry['{}_base64'.format(name)])
+    value = entry.get(name)
+    return None if value is None else value.encode('utf-8')
+
+
+def json_record(entry):
+    '''
+    Returns the (key, value, headers, timestamp) of a mapping written by
+    record_json(), so that a dump of read-topic can be replayed.
+    '''
+    headers = [(h['name'], decode_field(h, 'value'))
+               for h in entry.get('headers') or []]
+    timestamp = entry.get('timestamp')
+    if timestamp is not None and timestamp < 0:
+        timestamp = None
+    return (decode_field(entry, 'key'), decode_field(entry, 'value'),
+            headers, timestamp)
+
+
+def read_exactly(f, size, what):
+    data = f.read(size)
+    if len(data) < size:
+        raise TopicIOError('truncated input in {}'.format(what))
+    return data
+
+
+def read_records(f, fmt='lines', key_separator=None):
+    '''
+    Yields (key, value, headers, timestamp) from the binary file f, in one
+    of the INPUT_FORMATS:
+
+    - lines: a value per line, or key, key_separator and value
+    - length: values prefixed by their length as a big-endian int32 (-1
+      for null), each preceded by its key the same way with key_separator
+    - json: the JSON lines written by read-topic
+    '''
+    if fmt == 'lines':
+        separator = key_separator.encode('utf-8') if key_separator else None
+        for number, line in enumerate(f, 1):
+            if line.endswith(b'\n'):
+                line = line[:-1]
+            if separator is None:
+                yield None, line, (), None
+                continue
+            key, found, value = line.partition(separator)
+            if not found:
+                raise TopicIOError(
+                    'no key separator on line {}'.format(number))
+            yield key, value, (), None
+
+    elif fmt == 'length':
+        fields = 2 if key_separator else 1
+        while True:
+            record = []
+            for i in range(fields):
+                prefix = f.read(4)
+                if not prefix and not record:
+                    return
+                if len(prefix) < 4:
+                    raise TopicIOError('truncated input in length prefix')
+                size = struct.unpack('>i', prefix)[0]
+                record.append(None if size < 0 else
+                              read_exactly(f, size, 'record'))
+            key = record[0] if fields == 2 else None
+            yield key, record[-1], (), None
+
+    elif fmt == 'json':
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json_record(json.loads(line.decode('utf-8')))
+            except (ValueError, KeyError, TypeError) as e:
+                raise TopicIOError('invalid record on line {}: {}'.format(
+                    number, e))
+
+    else:
+        raise TopicIOError('unknown input format {}'.format(fmt))
+
+
+def murmur2(data):
+    '''
+    The murmur2 hash of the Java client, which its default partitioner
+    applies to record keys.
+    '''
+    m = 0x5bd1e995
+    length = len(data)
+    h = 0x9747b28c ^ length
+    tail = length & ~3
+    for i in range(0, tail, 4):
+        k = struct.unpack_from('<I', data, i)[0]
+        k = (k * m) & 0xFFFFFFFF
+        k ^= k >> 24
+        k = (k * m) & 0xFFFFFFFF
+        h = ((h * m) & 0xFFFFFFFF) ^ k
+    extra = length & 3
+    if extra == 3:
+        h ^= data[tail + 2] << 16
+    if extra >= 2:
+        h ^= data[tail + 1] << 8
+    if extra >= 1:
+        h ^= data[tail]
+        h = (h * m) & 0xFFFFFFFF
+    h ^= h >> 13
+    h = (h * m) & 0xFFFFFFFF
+    h ^= h >> 15
+    return h
+
+
+def key_partition(key, partitions):
+    return (murmur2(key) & 0x7FFFFFFF) % partitions
+
+
+class Producer(object):
+    '''
+    Writes records to a topic in batches of up to batch_bytes per
+    partition, keeping up to max_in_flight produce requests outstanding
+    per broker. Keyed records go to the partition the Java client would
+    pick, the others fill the batch of one partition after the other, or
+    go to partition when given. Batches failing with a retriable error are
+    sent again to the current leader, up to retries times; as with the
+    Java client, retries may reorder records when several requests are in
+    flight. Metadata is only refreshed once no request is in flight, as it
+    may share a connection with them.
+    '''
+
+    def __init__(self, admin, topic, partition=None, codec=0,
+                 batch_bytes=524288, max_in_flight=5, acks=-1, retries=3,
+                 timeout_ms=30000):
+        self.admin = admin
+        self.topic = topic
+        self.codec = codec
+        self.batch_bytes = batch_bytes
+        self.max_in_flight = max(1, max_in_flight)
+        self.acks = acks
+        self.retries = retries
+        self.timeout_ms = timeout_ms
+        self.leaders = {}
+        self.refresh()
+        if partition is not None and partition not in self.leaders:
+            raise TopicIOError('{} has no partition {}'.format(
+                topic, partition))
+        self.partition = partition
+        self.partitions = sorted(self.leaders)
+        self.sticky = 0
+        self.batches = {}
+        self.in_flight = {}
+        self.retrying = []
+        self.stats = OrderedDict((
+            ('records', 0), ('bytes', 0), ('failed', 0), ('batches', 0),
+            ('retries', 0), ('errors', {})))
+
+    def refresh(self):
+        info = self.admin.metadata([self.topic]).get(self.topic)
+        if not info or info['error'] or not info['partitions']:
+            raise TopicIOError('unknown topic {}'.format(self.topic))
+        self.leaders = {p: entry['leader']
+                        for p, entry in info['partitions'].items()}
+
+    def send(self, key, value, headers=(), timestamp=None):
+        if self.partition is not None:
+            partition = self.partition
+        elif key is not None:
+            partition = key_partition(key, len(self.partitions))
+        else:
+            partition = self.partitions[self.sticky % len(self.partitions)]
+
+        size = len(key or b'') + len(value or b'') + RECORD_OVERHEAD
+        batch = self.batches.setdefault(partition, [[], 0])
+        if batch[0] and batch[1] + size > self.batch_bytes:
+            self.flush(partition)
+            batch = self.batches.setdefault(partition, [[], 0])
+        batch[0].append((key, value, headers, timestamp))
+        batch[1] += size
+
+    def flush(self, partition):
+        records, _ = self.batches.pop(partition)
+        if partition == self.partitions[self.sticky % len(self.partitions)]:
+            self.sticky += 1
+        self.dispatch(partition, records, 0)
+        if self.retrying:
+            self.retry()
+
+    def dispatch(self, partition, records, attempt):
+        leader = self.leaders.get(partition, -1)
+        if leader < 0:
+            self.failed(records, 'LEADER_NOT_AVAILABLE', attempt, partition)
+            return
+
+        pending = self.in_flight.setdefault(leader, deque())
+        while len(pending) >= self.max_in_flight:
+            self.complete(leader)
+        try:
+            handle = self.admin.send_produce(
+                {(self.topic, partition): encode_batch(records, self.codec)},
+                leader, self.acks, self.timeout_ms)
+        except OSError:
+            self.failed(records, 'CONNECTION_ERROR', attempt, partition)
+            return
+        pending.append((handle, partition, records, attempt))
+        self.stats['batches'] += 1
+
+    def complete(self, leader):
+        '''
+        Waits for the oldest produce request in flight to leader.
+        '''
+        handle, partition, records, attempt = self.in_flight[leader].popleft()
+        try:
+            error = self.admin.produce_result(handle).get(
+                (self.topic, partition), ('UNKNOWN_SERVER_ERROR',))[0]
+        except (OSError, struct.error):
+            error = 'CONNECTION_ERROR'
+        if error:
+            self.failed(records, error, attempt, partition)
+            return
+        self.stats['records'] += len(records)
+        self.stats['bytes'] += sum(len(r[0] or b'') + len(r[1] or b'')
+                                   for r in records)
+
+    def failed(self, records, error, attempt, partition):
+        if error in RETRIABLE_ERRORS and attempt < self.retries:
+            self.stats['retries'] += 1
+            self.retrying.append((partition, records, attempt + 1))
+            return
+        errors = self.stats['errors']
+        errors[error] = errors.get(error, 0) + len(records)
+        self.stats['failed'] += len(records)
+
+    def drain(self):
+        while any(self.in_flight.values()):
+            for leader, pending in list(self.in_flight.items()):
+                if pending:
+                    self.complete(leader)
+
+    def retry(self):
+        '''
+        Waits for every request in flight, so that the metadata request
+        reads its own response, then sends the failed batches again to the
+        current leaders.
+        '''
+        while self.retrying:
+            self.drain()
+            time.sleep(RETRY_BACKOFF)
+            try:
+                self.refresh()
+            except (TopicIOError, OSError):
+                pass
+            retrying, self.retrying = self.retrying, []
+            for partition, records, attempt in retrying:
+                self.dispatch(partition, records, attempt)
+
+    def close(self):
+        '''
+        Sends the partial batches and waits for every request in flight.
+        Returns the counts of records and bytes written and failed.
+        '''
+        for partition in sorted(self.batches):
+            self.flush(partition)
+        self.drain()
+        while self.retrying:
+            self.retry()
+            self.drain()
+        return self.stats
+
+
+def write_records(admin, topic, records, **options):
+    '''
+    Writes (key, value, headers, timestamp) records to topic with a
+    Producer. Returns its counts, with the elapsed time and throughput.
+    '''
+    started = time.time()
+    producer = Producer(admin, topic, **options)
+    for key, value, headers, timestamp in records:
+        producer.send(key, value, headers, timestamp)
+    stats = producer.close()
+    elapsed = max(time.time() - started, 0.001)
+    stats['elapsed'] = round(elapsed, 3)
+    stats['records-per-second'] = round(stats['records'] / elapsed, 1)
+    stats['bytes-per-second'] = round(stats['bytes'] / elapsed, 1)
+    return stats
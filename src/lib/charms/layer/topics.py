@@ -0,0 +1,215 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import binascii
+import yaml
+
+from base64 import b64decode
+from collections import OrderedDict
+
+from charms.layer.kafka_admin import RESOURCE_TOPIC, SOURCE_DYNAMIC_TOPIC
+
+
+class SpecError(ValueError):
+    pass
+
+
+def config_value(value):
+    '''
+    Formats a spec value the way the broker reports it.
+    '''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (list, tuple)):
+        return ','.join(str(v) for v in value)
+    return str(value)
+
+
+def parse_spec(encoded):
+    '''
+    Decodes a base64 YAML or JSON topic spec:
+
+        defaults:
+          replication: 3
+          configs: {min.insync.replicas: 2}
+        topics:
+          orders: {partitions: 12, configs: {retention.ms: 86400000}}
+          audit: {partitions: 3, replication: 2}
+
+    topics may also be a list of mappings with a name. Returns an ordered
+    {name: {'partitions', 'replication', 'configs'}}.
+    '''
+    try:
+        data = yaml.safe_load(b64decode(encoded, validate=True))
+    except (binascii.Error, ValueError, yaml.YAMLError) as e:
+        raise SpecError('cannot decode spec: {}'.format(e))
+
+    if not isinstance(data, dict) or 'topics' not in data:
+        raise SpecError('spec must be a mapping with a topics entry')
+
+    defaults = data.get('defaults') or {}
+    topics = data['topics'] or {}
+    if isinstance(topics, list):
+        items = []
+        for topic in topics:
+            if not isinstance(topic, dict) or 'name' not in topic:
+                raise SpecError('topic list entries need a name')
+            items.append((topic['name'], topic))
+    elif isinstance(topics, dict):
+        items = list(topics.items())
+    else:
+        raise SpecError('topics must be a mapping or a list')
+
+    spec = OrderedDict()
+    for name, topic in items:
+        name = str(name)
+        topic = topic or {}
+        if name in spec:
+            raise SpecError('topic {} is defined twice'.format(name))
+
+        configs = dict(defaults.get('configs') or {})
+        configs.update(topic.get('configs') or {})
+        entry = {
+            'partitions': topic.get('partitions', defaults.get('partitions')),
+            'replication': topic.get('replication',
+                                     defaults.get('replication')),
+            'configs': {k: config_value(v) for k, v in configs.items()},
+        }
+        for key in ('partitions', 'replication'):
+            if not isinstance(entry[key], int) or entry[key] < 1:
+                raise SpecError('{}: {} must be a positive integer'.format(
+                    name, key))
+        spec[name] = entry
+
+    return spec
+
+
+def plan(spec, metadata, configs):
+    '''
+    Diffs the spec against the cluster metadata and the topic configs
+    returned by DescribeConfigs. Returns an ordered {name: step} where step
+    holds the planned 'actions' and, for the batched requests, 'create',
+    'partitions' and 'configs' (the full set of dynamic configs to set).
+    '''
+    steps = OrderedDict()
+    for name, wanted in spec.items():
+        step = {'actions': [], 'warnings': [], 'errors': []}
+        steps[name] = step
+        current = metadata.get(name)
+
+        if not current or current['error']:
+            step['actions'].append('create')
+            step['create'] = wanted
+            continue
+
+        partitions = len(current['partitions'])
+        if wanted['partitions'] > partitions:
+            step['actions'].append('expand {} -> {}'.format(
+                partitions, wanted['partitions']))
+            step['partitions'] = wanted['partitions']
+        elif wanted['partitions'] < partitions:
+            step['errors'].append(
+                'cannot shrink from {} to {} partitions'.format(
+                    partitions, wanted['partitions']))
+
+        replication = max(len(p['replicas'])
+                          for p in current['partitions'].values())
+        if replication != wanted['replication']:
+            step['warnings'].append(
+                'replication is {}, use reassign-topics to change it'.format(
+                    replication))
+
+        entries = configs.get((RESOURCE_TOPIC, name), {})
+        changed = sorted(
+            key for key, value in wanted['configs'].items()
+            if key not in entries or entries[key]['value'] != value
+        )
+        if changed:
+            dynamic = {
+                key: entry['value'] for key, entry in entries.items()
+                if entry['source'] == SOURCE_DYNAMIC_TOPIC
+            }
+            hidden = sorted(k for k, v in dynamic.items()
+                            if v is None and k not in wanted['configs'])
+            if hidden:
+                # AlterConfigs replaces every dynamic config and sensitive
+                # values are not returned, they would be lost
+                step['errors'].append(
+                    'cannot preserve sensitive configs {}'.format(
+                        ','.join(hidden)))
+            else:
+                dynamic.update(wanted['configs'])
+                step['actions'].append('set {}'.format(','.join(changed)))
+                step['configs'] = dynamic
+
+    return steps
+
+
+def provision(admin, spec, dry_run=False, timeout_ms=60000):
+    '''
+    Brings the cluster in line with spec using one Metadata, one
+    DescribeConfigs and at most one CreateTopics, CreatePartitions and
+    AlterConfigs request. With dry_run the brokers only validate the
+    changes. Returns plan() steps with a 'result' for every topic.
+    '''
+    metadata = admin.metadata()
+    existing = [name for name in spec
+                if name in metadata and not metadata[name]['error']]
+    configs = {}
+    if existing:
+        configs = admin.describe_configs(
+            [(RESOURCE_TOPIC, name) for name in existing])
+
+    steps = plan(spec, metadata, configs)
+
+    def record(results):
+        for name, (error, message) in results.items():
+            if isinstance(name, tuple):
+                name = name[1]
+            if error:
+                steps[name]['errors'].append('{}{}'.format(
+                    error, ': {}'.format(message) if message else ''))
+
+    create = [
+        dict(step['create'], name=name)
+        for name, step in steps.items() if 'create' in step
+    ]
+    if create:
+        record(admin.create_topics(create, timeout_ms=timeout_ms,
+                                   validate_only=dry_run))
+
+    expand = {name: step['partitions'] for name, step in steps.items()
+              if 'partitions' in step and not step['errors']}
+    if expand:
+        record(admin.create_partitions(expand, timeout_ms=timeout_ms,
+                                       validate_only=dry_run))
+
+    alter = {(RESOURCE_TOPIC, name): step['configs']
+             for name, step in steps.items()
+             if 'configs' in step and not step['errors']}
+    if alter:
+        record(admin.alter_configs(alter, validate_only=dry_run))
+
+    for step in steps.values():
+        if step['errors']:
+            step['result'] = 'failed'
+        elif not step['actions']:
+            step['result'] = 'unchanged'
+        else:
+            step['result'] = 'validated' if dry_run else 'applied'
+        for key in ('create', 'partitions', 'configs'):
+            step.pop(key, None)
+
+    return steps
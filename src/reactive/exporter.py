@@ -0,0 +1,39 @@
+from charmhelpers.core import hookenv
+
+from charms.reactive import when, when_not, set_state, remove_state
+from charms.reactive.helpers import data_changed
+
+from charms.layer.exporter import Exporter
+
+
+@when('kafka.started')
+def configure_exporter():
+    exporter = Exporter()
+    if not hookenv.config()['exporter_port']:
+        if data_changed('kafka.exporter', None):
+            exporter.remove()
+        remove_state('kafka.exporter.started')
+        return
+
+    settings = exporter.settings()
+    if not data_changed('kafka.exporter', settings) and exporter.is_running():
+        return
+
+    hookenv.log('Configuring kafka metrics exporter')
+    exporter.install(settings)
+    set_state('kafka.exporter.started')
+    # advertise a possibly new port to prometheus
+    remove_state('kafka.exporter.registered')
+
+
+@when('prometheus.available', 'kafka.exporter.started')
+@when_not('kafka.exporter.registered')
+def register_prometheus_target(prometheus):
+    prometheus.configure(port=hookenv.config()['exporter_port'])
+    set_state('kafka.exporter.registered')
+
+
+@when('kafka.exporter.registered')
+@when_not('prometheus.available')
+def prometheus_departed():
+    remove_state('kafka.exporter.registered')
@@ -0,0 +1,74 @@
+from charmhelpers.core import host, hookenv, unitdata
+
+from charms.reactive import when, hook, is_state, remove_state
+from charms.reactive.helpers import data_changed
+
+from charms.layer.kafka import get_log_dirs
+from charms.layer.host_tuning import HostTuning, HostTuningError, TUNING_KEY
+
+# drifted settings named in the workload status, the rest are counted
+STATUS_DRIFT_NAMES = 3
+READY_STATUS = 'ready'
+DRIFT_STATUS = 'ready, host tuning drift: '
+
+
+@when('apt.installed.kafka')
+def configure_host_tuning():
+    if host.is_container():
+        # the kernel belongs to the machine hosting the container
+        if data_changed('kafka.host_tuning', 'container'):
+            hookenv.log('Running in a container, host tuning skipped')
+        return
+
+    tuning = HostTuning()
+    try:
+        settings = tuning.settings(get_log_dirs())
+    except HostTuningError as e:
+        hookenv.log('Invalid host tuning: {}'.format(e), hookenv.ERROR)
+        return
+
+    if not data_changed('kafka.host_tuning', settings):
+        return
+
+    # the drift check is registered with the profile
+    remove_state('kafka.nrpe_helper.registered')
+    if settings is None:
+        hookenv.log('Removing host tuning')
+        tuning.remove()
+        return
+
+    hookenv.log('Applying the {} host tuning profile'.format(
+        settings['profile']))
+    tuning.install(settings)
+
+
+@hook('update-status')
+def check_host_tuning():
+    '''
+    Reports the settings of the tuning profile the host no longer has,
+    e.g. reset by another package or a replaced disk, to the nagios check
+    and the exporter, and in the workload status while it shows ready.
+    '''
+    applied = unitdata.kv().get(TUNING_KEY)
+    if not applied or host.is_container():
+        return
+
+    found = HostTuning().check(applied['settings'])
+    if not is_state('kafka.started'):
+        return
+
+    # only replace the ready status or an earlier drift report, other
+    # handlers' messages (restart pending, storage) stay
+    message = hookenv.status_get()[1] or ''
+    if message != READY_STATUS and not message.startswith(DRIFT_STATUS):
+        return
+
+    if not found:
+        status = READY_STATUS
+    else:
+        names = list(found)[:STATUS_DRIFT_NAMES]
+        if len(found) > len(names):
+            names.append('{} more'.format(len(found) - len(names)))
+        status = '{}{}'.format(DRIFT_STATUS, ', '.join(names))
+    if status != message:
+        hookenv.status_set('active', status)
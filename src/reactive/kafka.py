@@ -17,15 +17,21 @@ import os, sys, stat
 import socket
 import json
 import base64
-import tempfile
-from OpenSSL import crypto
-from subprocess import check_call
 from pathlib import Path
 import charms.coordinator
 from charms.layer.kafka import Kafka
-from charms.layer.kafka import keystore_password, KAFKA_APP_DATA
+from charms.layer.kafka import (keystore, keystore_password, keystoreSecret,
+                                get_log_dirs)
+from charms.layer import keystores
 from charms.layer import tls_client
-from charmhelpers.core import hookenv, unitdata
+from charms.layer import broker_config
+from charms.layer import reassignment
+from charms.layer import leaders
+from charms.layer.kafka import admin_client, broker_rack
+from charms.layer.kafka import (KAFKA_APP_DATA, parse_properties, read_file,
+                                replication_plan, replication_state)
+from charms.layer.kafka_admin import KafkaAdminError
+from charmhelpers.core import hookenv
 from charms.reactive import (when, when_not, hook, when_file_changed,
                              remove_state, set_state, endpoint_from_flag,
                              set_flag, is_state)
@@ -73,39 +79,32 @@ def waiting_for_certificates():
 @when('config.changed.ssl_key_password', 'kafka.started')
 def change_ssl_key():
     config = hookenv.config()
-    password = keystore_password()
     new_password = config['ssl_key_password']
     if not( data_changed('storepasswd', new_password)):
         return
-    for jks_type in ('server', 'client', 'server.truststore'):
-        jks_path = os.path.join(
-            KAFKA_APP_DATA,
-            "kafka.{}.jks".format(jks_type)
-        )
-        log('modifying password')
-        # import the pkcs12 into the keystore
-        check_call([
-            'keytool',
-            '-v', '-storepasswd',
-            '-new', new_password,
-            '-storepass', password,
-            '-keystore', jks_path
-        ])
-    path = os.path.join(
-        KAFKA_APP_DATA,
-        'keystore.secret'
-    )
+    # the stores are rewritten from the PEM files with the new password
+    path = keystoreSecret()
     if os.path.isfile(path):
         os.remove(path)
-        with os.fdopen(
-                os.open(path, os.O_WRONLY | os.O_CREAT, 0o440),
-                'wb') as f:
-            if config['ssl_key_password']:
-                token = config['ssl_key_password'].encode("utf-8")
-                f.write(token)
-    import_srv_crt_to_keystore()
-    import_ca_crt_to_keystore()
+    password = keystore_password()
+    log('modifying password')
+    for cert_type in ('server', 'client'):
+        keystores.write_keystore(cert_type, password)
+    keystores.write_truststore(password)
+    # a keystore reloaded live has its old password stored in zookeeper,
+    # which would win over server.properties after the restart
+    broker_id = hookenv.local_unit().split('/', 1)[1]
+    try:
+        broker_config.reload_keystore(
+            broker_id, keystore('server'), password)
+    except broker_config.BrokerConfigError:
+        try:
+            broker_config.drop_keystore_configs(broker_id)
+        except broker_config.BrokerConfigError as e:
+            log('Could not reset dynamic keystore configs: {}'.format(e),
+                hookenv.WARNING)
     remove_state('config.changed.ssl_key_password')
+    set_state('kafka.force-reconfigure')
     remove_state('kafka.started')
 
 
@@ -118,21 +117,29 @@ def change_ssl_key():
 @when_not('kafka.started')
 def configure_kafka(zk):
     hookenv.status_set('maintenance', 'setting up kafka')
-    if hookenv.config()['log_dir']:
-       log_dir = hookenv.config()['log_dir']
-    else:
-       log_dir = unitdata.kv().get('kafka.storage.log_dir')
+    log_dirs = get_log_dirs()
     kafka = Kafka()
     zks = zk.zookeepers()
-    data_changed('kafka.storage.log_dir', log_dir)
+    data_changed('kafka.storage.log_dirs', log_dirs)
     data_changed('zookeepers', zks),
-    if log_dir:
-        kafka.install(zk_units=zks, log_dir=log_dir)
+    written = {}
+    if log_dirs:
+        written = kafka.install(zk_units=zks, log_dirs=log_dirs)
     else:
         hookenv.status_set(
             'blocked',
             'unable to get storage dir')
-    charms.coordinator.acquire('restart')
+
+    # keystores, package upgrades and storage changes are not visible in
+    # the rendered files, they set kafka.force-reconfigure instead
+    if (is_state('kafka.force-reconfigure') or not kafka.is_running() or
+            kafka.restart_needed(written)):
+        remove_state('kafka.force-reconfigure')
+        request_restart(written)
+    else:
+        log('Broker configuration unchanged, no restart needed')
+        hookenv.status_set('active', 'ready')
+        set_state('kafka.started')
 
 
 @when('coordinator.granted.restart')
@@ -158,9 +165,60 @@ def config_changed(zk):
                                                     v):
             # Trigger a reconfig of nagios if relation established
             remove_state('kafka.nrpe_helper.registered')
-    # Something must have changed if this hook fired, trigger reconfig
     remove_state('config.changed')
-    remove_state('kafka.started')
+
+    kafka = Kafka()
+    zks = zk.zookeepers()
+    log_dirs = get_log_dirs()
+    changes, changed_files = kafka.pending_changes(
+        zk_units=zks, log_dirs=log_dirs)
+    cluster, broker, static = broker_config.classify(changes)
+
+    if static or changed_files:
+        # read-only settings, trigger reconfig and a rolling restart. The
+        # dynamic ones changed alongside are applied all the same: values
+        # set earlier through ZooKeeper would override server.properties
+        # after the restart.
+        log('Restart required by {}'.format(
+            ', '.join(sorted(static) + changed_files)))
+        apply_dynamic_configs(cluster, broker)
+        remove_state('kafka.started')
+        return
+
+    if not (cluster or broker):
+        return
+
+    if not apply_dynamic_configs(cluster, broker):
+        log('Restarting to apply the broker configs', hookenv.ERROR)
+        remove_state('kafka.started')
+        return
+
+    # keep server.properties in line for the next restart
+    kafka.install(zk_units=zks, log_dirs=log_dirs)
+
+
+def apply_dynamic_configs(cluster, broker):
+    '''
+    Applies the cluster wide changes from the leader unit and the per
+    broker ones to the local broker. Returns False when they failed.
+    '''
+    if not ((cluster and hookenv.is_leader()) or broker):
+        return True
+
+    log('Applying dynamic broker configs {}'.format(
+        ', '.join(sorted(cluster) + sorted(broker))))
+    try:
+        if cluster and hookenv.is_leader():
+            broker_config.alter_broker_configs(cluster)
+        if broker:
+            broker_config.alter_broker_configs(
+                broker_config.listener_configs(broker),
+                hookenv.local_unit().split('/', 1)[1])
+    except broker_config.BrokerConfigError as e:
+        log('Dynamic config update failed: {}'.format(e), hookenv.ERROR)
+        return False
+
+    return True
 
 
 @when(
@@ -175,19 +233,36 @@ def configure_kafka_zookeepers(zk):
     changes, restart Kafka and set appropriate status messages.
     """
     zks = zk.zookeepers()
-    if hookenv.config()['log_dir']:
-       log_dir = hookenv.config()['log_dir']
-    else:
-       log_dir = unitdata.kv().get('kafka.storage.log_dir')
+    log_dirs = get_log_dirs()
     if not(any((
             data_changed('zookeepers', zks),
-            data_changed('kafka.storage.log_dir', log_dir)))):
+            data_changed('kafka.storage.log_dirs', log_dirs)))):
+        return
+    if not log_dirs:
         return
 
     hookenv.log('Checking Zookeeper configuration')
     hookenv.status_set('maintenance', 'updating zookeeper instances')
     kafka = Kafka()
-    kafka.install(zk_units=zks, log_dir=log_dir)
+    written = kafka.install(zk_units=zks, log_dirs=log_dirs)
+    if kafka.restart_needed(written):
+        request_restart(written)
+    else:
+        hookenv.status_set('active', 'ready')
+
+
+def request_restart(written):
+    '''
+    Requests the rolling restart lock, reporting the changed keys.
+    '''
+    keys = sorted(set(k for keys in written.values() for k in keys))
+    files = sorted(os.path.basename(t) for t, keys in written.items()
+                   if not keys)
+    if keys or files:
+        log('Restart requested for {}'.format(', '.join(keys + files)))
+        hookenv.status_set('waiting', 'restart pending: {}'.format(
+            ', '.join((keys + files)[:3]) +
+            (', ...' if len(keys + files) > 3 else '')))
     charms.coordinator.acquire('restart')
 
 
@@ -209,9 +284,44 @@ def serve_client(client, zookeeper):
             hookenv.unit_public_ip())
 
     client.send_zookeepers(zookeeper.zookeepers())
+    publish_rack()
     hookenv.log('Sent Kafka configuration to client')
 
 
+def publish_rack():
+    '''
+    Every broker publishes its id and rack on the client relation, so that
+    clients in the same zone can set client.rack and fetch from it.
+    '''
+    rack = broker_rack() or ''
+    broker_id = hookenv.local_unit().split('/', 1)[1]
+    for rid in hookenv.relation_ids('client'):
+        hookenv.relation_set(rid, {'broker-id': broker_id, 'rack': rack})
+
+
+@when('kafka.started')
+def switch_replication_listener():
+    '''
+    Publishes the replication listener state of the running broker to the
+    peers and restarts once it differs from replication_plan(), which moves
+    the cluster to the listener, or off it, in two rolling restarts.
+    '''
+    server = parse_properties(
+        read_file(os.path.join(KAFKA_APP_DATA, 'server.properties')))
+    current = replication_state(server)
+    for rid in hookenv.relation_ids('cluster'):
+        hookenv.relation_set(rid, {
+            'replication-listener': str(current[0]).lower(),
+            'replication-inter-broker': str(current[1]).lower(),
+        })
+
+    planned = replication_plan()
+    if planned != current:
+        log('Switching the replication listener from {} to {}'.format(
+            current, planned))
+        remove_state('kafka.started')
+
+
 @when('kafka.started',
       'endpoint.grafana.joined')
 def register_grafana_dashboards():
@@ -222,3 +332,59 @@ def register_grafana_dashboards():
     for dash_file in dash_dir.glob('kafka.json'):
         dashboard = dash_file.read_text()
         grafana.register_dashboard(dash_file.stem, json.loads(dashboard))
+
+
+@hook('update-status')
+def advance_reassignment():
+    '''
+    Polls the reassignment executed from this unit, submitting the next
+    batch once the moving one is in sync and lifting the throttles at the
+    end.
+    '''
+    if not is_state('kafka.started') or not reassignment.active():
+        return
+
+    try:
+        with admin_client() as admin:
+            state = reassignment.step(admin)
+    except (reassignment.ReassignmentError, KafkaAdminError, OSError) as e:
+        log('reassignment step failed: {}'.format(e), hookenv.WARNING)
+        return
+
+    log('reassignment {}: {} batches submitted'.format(
+        state['state'], state['batches']))
+
+
+@hook('update-status')
+def check_leader_balance():
+    '''
+    Refreshes the leader skew snapshot read by the nagios check and the
+    exporter and, with leader_balance_auto, has the leader unit elect
+    preferred leaders once the skew exceeds the threshold.
+    '''
+    if not is_state('kafka.started'):
+        return
+
+    config = hookenv.config()
+    try:
+        with admin_client() as admin:
+            stats = leaders.collect(admin)
+            if (config['leader_balance_auto'] and hookenv.is_leader() and
+                    leaders.needs_election(
+                        stats, config['leader_balance_threshold'])):
+                elected, errors = leaders.elect(
+                    admin, stats['electable'],
+                    config['leader_balance_batch_size'])
+                log('elected {} preferred leaders, leader skew was '
+                    '{}%'.format(elected, stats['max-skew']))
+                if errors:
+                    log('preferred leader elections failed: {}'.format(
+                        errors), hookenv.WARNING)
+                stats = leaders.collect(admin)
+    except (KafkaAdminError, OSError) as e:
+        log('unable to check the leader balance: {}'.format(e),
+            hookenv.WARNING)
+        return
+
+    broker_id = int(hookenv.local_unit().split('/', 1)[1])
+    leaders.write_snapshot(stats, broker_id)
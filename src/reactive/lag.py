@@ -0,0 +1,32 @@
+from charmhelpers.core import hookenv
+
+from charms.reactive import when, set_state, remove_state
+from charms.reactive.helpers import data_changed
+
+from charms.layer.lag import LagCollector, ThresholdsError
+
+
+@when('kafka.started')
+def configure_lag_collector():
+    collector = LagCollector()
+    if not hookenv.config()['consumer_lag_interval']:
+        if data_changed('kafka.lag', None):
+            collector.remove()
+        remove_state('kafka.lag.started')
+        return
+
+    try:
+        settings = collector.settings()
+    except ThresholdsError as e:
+        hookenv.log('Invalid consumer_lag_thresholds: {}'.format(e),
+                    hookenv.ERROR)
+        return
+
+    if not data_changed('kafka.lag', settings) and collector.is_running():
+        return
+
+    hookenv.log('Configuring consumer lag collector')
+    collector.install(settings)
+    set_state('kafka.lag.started')
+    # register the checks of newly listed groups
+    remove_state('kafka.nrpe_helper.registered')
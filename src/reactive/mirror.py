@@ -0,0 +1,35 @@
+from charmhelpers.core import hookenv
+
+from charms.reactive import when, set_state, remove_state
+from charms.reactive.helpers import data_changed
+
+from charms.layer.mirror import MirrorMaker, MirrorError
+
+
+@when('kafka.started')
+def configure_mirror():
+    mirror = MirrorMaker()
+    if not hookenv.config()['mirror_source_bootstrap']:
+        if data_changed('kafka.mirror', None):
+            mirror.remove()
+        remove_state('kafka.mirror.started')
+        return
+
+    try:
+        settings = mirror.settings()
+    except MirrorError as e:
+        hookenv.log('Invalid mirror configuration: {}'.format(e),
+                    hookenv.ERROR)
+        return
+
+    # the source partition count only sizes the streams, MirrorMaker picks
+    # up new topics and partitions of the whitelist by itself
+    changed = data_changed('kafka.mirror', {
+        k: v for k, v in settings.items() if k != 'source_partitions'})
+    if not changed and mirror.is_running():
+        return
+
+    hookenv.log('Configuring MirrorMaker from {} with {} streams'.format(
+        settings['source'], settings['streams']))
+    mirror.install(settings)
+    set_state('kafka.mirror.started')
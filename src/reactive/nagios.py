@@ -1,11 +1,25 @@
 import os
+import re
+import json
 import shutil
 
-from charmhelpers.core import hookenv
+from charmhelpers.core import host, hookenv
 
-from charms.reactive import when, when_not, set_state
+from charms.reactive import when, when_not, set_state, remove_state, hook
 
-from charms.layer.kafka import KAFKA_APP
+from charms.layer.kafka import KAFKA_APP, KAFKA_APP_DATA
+from charms.layer.host_tuning import (PROFILE_OFF, TUNING_OBJECT,
+                                      TUNING_SNAPSHOT)
+from charms.layer.leaders import LEADER_OBJECT, LEADER_SNAPSHOT
+from charms.layer.lag import (ALL_GROUPS, LAG_GROUP_OBJECT, LAG_SNAPSHOT,
+                              LAG_STATUS_OBJECT, MIRROR_OBJECT,
+                              ThresholdsError, group_label, parse_thresholds)
+
+JMX_METRICS = os.path.join(KAFKA_APP_DATA, 'nagios-jmx-metrics.json')
+JMX_SNAPSHOT = '/var/lib/nagios/kafka-jmx-snapshot.json'
+
+# snapshots the charm writes on update-status are stale after this long
+CHARM_SNAPSHOT_TTL = 3600
 
 
 @when('local-monitors.available')
@@ -54,20 +68,57 @@ type=SocketServer',
         'crit': 'val <= {}'.format(
             config['nagios_avg_network_processor_idle_crit']
         )
+    }, {
+        'name': 'leader_skew',
+        'object_name': LEADER_OBJECT,
+        'attribute': 'LocalSkewPercent',
+        'snapshot': LEADER_SNAPSHOT,
+        'description': 'Deviation of the leader count from the cluster mean',
+        'warn': 'val >= {}'.format(config['nagios_leader_skew_warn']),
+        'crit': 'val >= {}'.format(config['nagios_leader_skew_crit'])
     }]
+    if config['consumer_lag_interval']:
+        checks += lag_checks(config)
+    if config['tuning_profile'] != PROFILE_OFF and not host.is_container():
+        checks.append({
+            'name': 'host_tuning_drift',
+            'object_name': TUNING_OBJECT,
+            'attribute': 'Drift',
+            'snapshot': TUNING_SNAPSHOT,
+            'description': 'Kernel settings differing from the {} '
+                           'tuning profile'.format(config['tuning_profile']),
+            'warn': 'val >= 1'
+        })
+
+    # All checks share one JmxTool session per polling cycle through the
+    # on-disk snapshot, instead of starting a JVM each.
+    write_jmx_metrics(checks)
 
     check_cmd = [
-        'python3', '/usr/local/lib/nagios/plugins/check_kafka_jmx.py'
+        'python3', '/usr/local/lib/nagios/plugins/check_kafka_jmx.py',
+        '--run-path',
+        '/usr/lib/kafka/bin/kafka-run-class.sh'.format(
+            KAFKA_APP
+        ),
+        '--jmx-url',
+        'service:jmx:rmi:///jndi/rmi://localhost:{}/jmxrmi'.format(
+            config['kafka_jmx_port']
+        ),
+        '--metrics', JMX_METRICS,
+        '--snapshot', JMX_SNAPSHOT,
+        '--ttl', str(config['nagios_jmx_cache_ttl'])
     ]
 
     for check in checks:
-        cmd = check_cmd + [
-            '--run-path',
-            '/usr/lib/kafka/bin/kafka-run-class.sh'.format(
-                KAFKA_APP
-            ),
-            '--object-name', check['object_name']
-        ]
+        if 'snapshot' in check:
+            cmd = check_cmd[:2] + [
+                '--static',
+                '--snapshot', check['snapshot'],
+                '--ttl', str(check.get('ttl', CHARM_SNAPSHOT_TTL)),
+            ]
+        else:
+            cmd = list(check_cmd)
+        cmd += ['--object-name', check['object_name']]
         if 'warn' in check:
             cmd += ['-w', "'{}'".format(check['warn'])]
         if 'crit' in check:
@@ -89,6 +140,71 @@ type=SocketServer',
     set_state('kafka.nrpe_helper.registered')
 
 
+def lag_checks(config):
+    '''
+    Returns the consumer lag checks: one over the groups coordinated by
+    the unit's broker, one per group named in consumer_lag_thresholds and
+    one for the mirror group on its source cluster. The collector
+    evaluates the thresholds, the checks read its status.
+    '''
+    # missing three collections makes the snapshot stale
+    ttl = 3 * config['consumer_lag_interval']
+    checks = [{
+        'name': 'consumer_lag',
+        'object_name': LAG_STATUS_OBJECT,
+        'attribute': 'Status',
+        'snapshot': LAG_SNAPSHOT,
+        'ttl': ttl,
+        'description': 'Consumer groups past their lag thresholds',
+        'warn': 'val >= 1',
+        'crit': 'val >= 2'
+    }]
+    try:
+        groups = parse_thresholds(config['consumer_lag_thresholds'])
+    except ThresholdsError:
+        groups = {}
+    for group in sorted(groups):
+        if group == ALL_GROUPS:
+            continue
+        checks.append({
+            'name': 'consumer_lag_{}'.format(
+                re.sub(r'[^a-zA-Z0-9_]', '_', group)),
+            'object_name': LAG_GROUP_OBJECT.format(group_label(group)),
+            'attribute': 'Status',
+            'snapshot': LAG_SNAPSHOT,
+            'ttl': ttl,
+            'description': 'Lag of consumer group {}'.format(group),
+            'warn': 'val >= 1',
+            'crit': 'val >= 2'
+        })
+    if config['mirror_source_bootstrap']:
+        checks.append({
+            'name': 'mirror_lag',
+            'object_name': MIRROR_OBJECT,
+            'attribute': 'Status',
+            'snapshot': LAG_SNAPSHOT,
+            'ttl': ttl,
+            'description': 'Lag of MirrorMaker behind {}'.format(
+                config['mirror_source_bootstrap']),
+            'warn': 'val >= 1',
+            'crit': 'val >= 2'
+        })
+
+    return checks
+
+
+def write_jmx_metrics(checks):
+    '''
+    Write the list of MBeans read by the checks, collected together by
+    check_kafka_jmx.py into a single snapshot.
+    '''
+    objects = sorted(set(check['object_name'] for check in checks
+                         if 'snapshot' not in check))
+    with open(JMX_METRICS, 'w') as f:
+        json.dump(objects, f)
+    os.chmod(JMX_METRICS, 0o644)
+
+
 @when('kafka.nrpe_helper.registered')
 @when_not('kafka.nrpe_helper.installed')
 def install_nrpe_helper():
@@ -100,3 +216,10 @@ def install_nrpe_helper():
     shutil.copy(src, dst)
     os.chmod(dst, 0o755)
     set_state('kafka.nrpe_helper.installed')
+
+
+@hook('upgrade-charm')
+def refresh_nrpe_helper():
+    # pick up a new version of the check script and its arguments
+    remove_state('kafka.nrpe_helper.installed')
+    remove_state('kafka.nrpe_helper.registered')
@@ -1,10 +1,11 @@
 import os
 
-from charms.layer.kafka import Kafka
+from charms.layer.kafka import Kafka, get_log_dirs
 
 from charmhelpers.core import hookenv, unitdata
 
 from charms.reactive import remove_state, hook, set_flag
+from charms.reactive.helpers import data_changed
 
 from charmhelpers.core.hookenv import log
 
@@ -20,34 +21,72 @@ def init_brokerid(log_dir):
             f.write(broker_id)
 
 
+def storage_log_dir(storageid=None):
+    mount = hookenv.storage_get('location', storageid)
+    if not mount:
+        return None
+    return os.path.join(mount, "logs")
+
+
 @hook('logs-storage-attached')
 def storage_attach():
     storageids = hookenv.storage_list('logs')
     if not storageids:
         hookenv.status_set('blocked', 'cannot locate attached storage')
         return
-    storageid = storageids[0]
-
-    mount = hookenv.storage_get('location', storageid)
-    if not mount:
-        hookenv.status_set('blocked', 'cannot locate attached storage mount')
-        return
 
-    log_dir = os.path.join(mount, "logs")
-    unitdata.kv().set('kafka.storage.log_dir', log_dir)
-    hookenv.log('Kafka logs storage attached at {}'.format(log_dir))
+    # every attached volume becomes one log.dirs entry (JBOD)
+    log_dirs = []
+    for storageid in storageids:
+        log_dir = storage_log_dir(storageid)
+        if not log_dir:
+            hookenv.status_set('blocked',
+                               'cannot locate attached storage mount')
+            return
+        init_brokerid(log_dir)
+        log_dirs.append(log_dir)
+
+    unitdata.kv().set('kafka.storage.log_dirs', sorted(log_dirs))
+    unitdata.kv().unset('kafka.storage.log_dir')
+    hookenv.log('Kafka logs storage attached at {}'.format(
+        ','.join(sorted(log_dirs))))
 
-    init_brokerid(log_dir)
+    # configure_kafka_zookeepers notices the new log.dirs and requests a
+    # rolling restart; the broker keeps serving until then.
     set_flag('kafka.storage.logs.attached')
-    # Stop Kafka; removing the kafka.started state will trigger
-    # a reconfigure if/when it's ready
-    remove_state('kafka.configured')
-    set_flag('kafka.force-reconfigure')
 
 
 @hook('logs-storage-detaching')
 def storage_detaching():
-    unitdata.kv().unset('kafka.storage.log_dir')
+    kv = unitdata.kv()
+    log_dir = storage_log_dir()
+    # the attached storage, whatever the log_dir option says
+    attached = kv.get('kafka.storage.log_dirs')
+    if attached is None:
+        # storage attached by a previous charm revision
+        attached = [kv.get('kafka.storage.log_dir')]
+    attached = sorted(d for d in attached if d and d != log_dir)
+    kv.set('kafka.storage.log_dirs', attached)
+    kv.unset('kafka.storage.log_dir')
+
+    if hookenv.config()['log_dir']:
+        # the broker uses the directories of the log_dir option
+        log('log storage {} detaching, not in use'.format(log_dir))
+        return
+
+    log_dirs = get_log_dirs()
+    if log_dirs:
+        # The volume goes away once this hook returns, so the broker has
+        # to drop it now rather than wait for the restart lock. Replicas
+        # that lived on it are re-replicated from the other brokers.
+        log('log storage {} detaching, removing it from log.dirs'.format(
+            log_dir))
+        kafka = Kafka()
+        kafka.stop()
+        kafka.install(log_dirs=log_dirs)
+        data_changed('kafka.storage.log_dirs', log_dirs)
+        kafka.start()
+        return
 
     Kafka().stop()
 
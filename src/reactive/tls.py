@@ -1,19 +1,16 @@
 import os
 import socket
-import tempfile
 
-from OpenSSL import crypto
-from subprocess import check_call
-
-from charms.layer import tls_client
+from charms.layer import broker_config, keystores, tls_client
 from charms.layer.kafka import (keystore_password, caKeystore,
                                 caPath, crtPath, keyPath,
-                                keystore, keystoreSecret)
+                                keystore, keystoreSecret, read_file,
+                                get_ingress_address)
 
 from charmhelpers.core import hookenv, unitdata
 
 from charms.reactive import (when, when_file_changed, remove_state,
-                             when_not, set_state)
+                             when_not, set_state, hook)
 from charms.reactive.helpers import data_changed
 
 from charmhelpers.core.hookenv import log
@@ -61,6 +58,9 @@ def send_data():
             hookenv.unit_public_ip(),
             socket.gethostname(),
             socket.getfqdn(),
+            # brokers check the names of the replication listener too
+            get_ingress_address('listener'),
+            get_ingress_address('replication'),
         ]
 
         # maybe they have extra names they want as SANs
@@ -80,71 +80,54 @@ def send_data():
 
 
 @when_file_changed(keystore('server'))
-@when_file_changed(keystore('client'))
 @when('kafka.started')
-def restart_when_keystore_changed():
-    remove_state('kafka.started')
+def reload_server_keystore():
+    '''
+    Applies a renewed server certificate through the dynamic listener
+    keystore config and waits until the listener serves it. The broker is
+    only restarted when that fails. The client keystore needs neither, the
+    tools and actions read it when they start.
+    '''
+    broker_id = hookenv.local_unit().split('/', 1)[1]
+    try:
+        broker_config.reload_keystore(
+            broker_id, keystore('server'), keystore_password())
+        broker_config.wait_for_certificate(
+            hookenv.unit_private_ip(), hookenv.config()['port'],
+            read_file(crtPath('server')))
+    except (broker_config.BrokerConfigError, ValueError) as e:
+        log('Live keystore reload failed, restarting: {}'.format(e),
+            hookenv.WARNING)
+        set_state('kafka.force-reconfigure')
+        remove_state('kafka.started')
+        return
+
+    log('server certificate rotated without restart')
 
 
 @when('tls_client.certs.changed')
 def import_srv_crt_to_keystore():
+    password = keystore_password()
     for cert_type in ('server', 'client'):
-        password = keystore_password()
         crt_path = crtPath(cert_type)
         key_path = keyPath(cert_type)
 
-        if os.path.isfile(crt_path) and os.path.isfile(key_path):
-            with open(crt_path, 'rt') as f:
-                cert = f.read()
-                loaded_cert = crypto.load_certificate(
-                    crypto.FILETYPE_PEM,
-                    cert
-                )
-                if not data_changed(
-                    'kafka_{}_certificate'.format(cert_type),
-                    cert
-                ):
-                    log('server certificate of key file missing')
-                    return
-
-            with open(key_path, 'rt') as f:
-                loaded_key = crypto.load_privatekey(
-                    crypto.FILETYPE_PEM,
-                    f.read()
-                )
-
-            with tempfile.NamedTemporaryFile() as tmp:
-                log('server certificate changed')
-
-                keystore_path = keystore(cert_type)
-
-                pkcs12 = crypto.PKCS12Type()
-                pkcs12.set_certificate(loaded_cert)
-                pkcs12.set_privatekey(loaded_key)
-                pkcs12_data = pkcs12.export(password)
-                log('opening tmp file {}'.format(tmp.name))
-
-                # write cert and private key to the pkcs12 file
-                tmp.write(pkcs12_data)
-                tmp.flush()
-
-                log('importing pkcs12')
-                # import the pkcs12 into the keystore
-                check_call([
-                    'keytool',
-                    '-v', '-importkeystore',
-                    '-srckeystore', str(tmp.name),
-                    '-srcstorepass', password,
-                    '-srcstoretype', 'PKCS12',
-                    '-destkeystore', keystore_path,
-                    '-deststoretype', 'JKS',
-                    '-deststorepass', password,
-                    '--noprompt'
-                ])
-                os.chmod(keystore_path, 0o444)
-
-                remove_state('tls_client.certs.changed')
-                set_state('kafka.{}.keystore.saved'.format(cert_type))
+        if not (os.path.isfile(crt_path) and os.path.isfile(key_path)):
+            log('{} certificate or key file missing'.format(cert_type))
+            continue
+
+        with open(crt_path, 'rt') as f:
+            if not data_changed(
+                'kafka_{}_certificate'.format(cert_type),
+                f.read()
+            ):
+                continue
+
+        log('{} certificate changed'.format(cert_type))
+        if keystores.write_keystore(cert_type, password):
+            set_state('kafka.{}.keystore.saved'.format(cert_type))
+
+    remove_state('tls_client.certs.changed')
 
 
 @when('tls_client.ca_installed')
@@ -156,21 +139,35 @@ def import_ca_crt_to_keystore():
         with open(ca_path, 'rt') as f:
             changed = data_changed('ca_certificate', f.read())
 
-        if changed:
-            ca_keystore = caKeystore()
-            check_call([
-                'keytool',
-                '-import', '-trustcacerts', '-noprompt',
-                '-keystore', ca_keystore,
-                '-storepass', keystore_password(),
-                '-file', ca_path
-            ])
-            os.chmod(ca_keystore, 0o444)
-
+        if changed and keystores.write_truststore(keystore_password()):
             remove_state('tls_client.ca_installed')
             set_state('kafka.ca.keystore.saved')
 
 
+@hook('upgrade-charm')
+def migrate_jks_keystores():
+    '''
+    Earlier revisions converted the keystores to JKS with keytool; write
+    them as PKCS12 and restart the broker on them.
+    '''
+    legacy = [keystores.legacy_keystore(cert_type)
+              for cert_type in ('server', 'client')]
+    if not any(os.path.exists(path) for path in legacy):
+        return
+
+    password = keystore_password()
+    for cert_type in ('server', 'client'):
+        keystores.write_keystore(cert_type, password)
+    keystores.write_truststore(password)
+    for path in legacy:
+        if os.path.exists(path):
+            os.remove(path)
+
+    log('keystores migrated from JKS to PKCS12')
+    set_state('kafka.force-reconfigure')
+    remove_state('kafka.started')
+
+
 @when('endpoint.certificates.departed')
 def clear_certificates():
     ca_path = caPath()
@@ -187,13 +184,10 @@ def clear_certificates():
     for cert_type in ('server', 'client'):
         crt_path = crtPath(cert_type)
         key_path = keyPath(cert_type)
-        keystore_path = keystore(cert_type)
-        if os.path.exists(crt_path):
-            os.remove(crt_path)
-        if os.path.exists(key_path):
-            os.remove(key_path)
-        if os.path.exists(keystore_path):
-            os.remove(keystore_path)
+        for path in (crt_path, key_path, keystore(cert_type),
+                     keystores.legacy_keystore(cert_type)):
+            if os.path.exists(path):
+                os.remove(path)
         remove_state('kafka.{}.keystore.saved'.format(cert_type))
         data_changed('kafka_{}_certificate'.format(cert_type), {})
 
@@ -231,3 +225,5 @@ def clear_certificates():
     )
     for s in cleanup_states:
         remove_state(s)
+    # the broker still holds the removed keystores
+    set_state('kafka.force-reconfigure')
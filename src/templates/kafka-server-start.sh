@@ -33,7 +33,22 @@ if [ "x$KAFKA_HEAP_OPTS" = "x" ]; then
     export KAFKA_HEAP_OPTS="-Xmx1G -Xms1G"
 fi
 
+{% if gc_log -%}
+# Rotating GC log under the kafka log dir, 10 files of 100M, instead of the
+# 100K files kafka-run-class.sh uses with -loggc on java 9 and later.
+LOG_DIR=${LOG_DIR:-$base_dir/../logs}
+mkdir -p "$LOG_DIR"
+JAVA_MAJOR_VERSION=$(java -version 2>&1 | sed -E -n 's/.* version "([0-9]*).*$/\1/p')
+if [ "${JAVA_MAJOR_VERSION:-8}" -ge "9" ] 2>/dev/null; then
+    export KAFKA_GC_LOG_OPTS="-Xlog:gc*:file=$LOG_DIR/kafkaServer-gc.log:time,uptime,level,tags:filecount=10,filesize=100M"
+else
+    export KAFKA_GC_LOG_OPTS="-Xloggc:$LOG_DIR/kafkaServer-gc.log -verbose:gc -XX:+PrintGCDetails -XX:+PrintGCDateStamps -XX:+PrintGCTimeStamps -XX:+UseGCLogFileRotation -XX:NumberOfGCLogFiles=10 -XX:GCLogFileSize=100M"
+fi
+
+EXTRA_ARGS=${EXTRA_ARGS-'-name kafkaServer'}
+{% else -%}
 EXTRA_ARGS=${EXTRA_ARGS-'-name kafkaServer -loggc'}
+{% endif %}
 
 COMMAND=$1
 case $COMMAND in